@@ -4,4 +4,23 @@ const api = axios.create({
   baseURL: "http://localhost:8000",
 });
 
+// the strava athlete this browser session belongs to, saved after strava auth
+export const getAthleteId = () => sessionStorage.getItem("athleteId");
+
+export const setAthleteId = (athleteId) =>
+  sessionStorage.setItem("athleteId", athleteId);
+
+// every request says which athlete it is for
+api.interceptors.request.use((config) => {
+  const athleteId = getAthleteId();
+  if (athleteId) {
+    config.params = { athlete_id: athleteId, ...config.params };
+  }
+  return config;
+});
+
+// EventSource can't use the interceptor, stream urls carry the athlete themselves
+export const streamUrl = (path) =>
+  `${api.defaults.baseURL}${path}?athlete_id=${getAthleteId()}`;
+
 export default api;
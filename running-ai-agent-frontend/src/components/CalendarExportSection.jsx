@@ -1,5 +1,5 @@
 import React, { useEffect, useState } from "react";
-import api from "../api";
+import api, { getAthleteId } from "../api";
 import CalendarInfo from "./CalendarInfo";
 
 const CalendarExportSection = () => {
@@ -9,7 +9,7 @@ const CalendarExportSection = () => {
   const handleClick = async () => {
     try {
       const res = await api.get("/google-auth", {
-        params: { user_id: "1234test" },
+        params: { user_id: getAthleteId() },
       });
       const authUrl = res.data.auth_url;
       window.location.href = authUrl;
@@ -1,7 +1,7 @@
 import React, { useState } from "react";
 
 import { motion, useTime, useTransform } from "motion/react";
-import api from "../api";
+import { streamUrl } from "../api";
 import Loader from "./loader";
 import AnalysisComponent from "./AnalysisComponent";
 
@@ -21,22 +21,31 @@ const GeminiAnalysisSection = ({ setGemAnalysed }) => {
   const [loadedAnalysis, setLoadedAnalysis] = useState(false);
   const [mdContent, setMdContent] = useState();
 
-  const handleClick = async () => {
+  const handleClick = () => {
     setClicked(true);
     setLoading(true);
-    try {
-      const res = await api.get("/gemini-analysis");
-      if (res) {
-        console.log(res.data.analysis);
-        setGemAnalysed(() => res.data.success);
-        setLoadedAnalysis(true);
-        setMdContent(res.data.analysis);
-      }
-    } catch (error) {
+
+    // analysis is streamed over server sent events so it renders as it is written
+    let analysisText = "";
+    const source = new EventSource(streamUrl("/gemini-analysis/stream"));
+
+    source.addEventListener("chunk", (event) => {
+      analysisText += JSON.parse(event.data).text;
+      setLoading(false);
+      setLoadedAnalysis(true);
+      setMdContent(analysisText);
+    });
+
+    source.addEventListener("done", () => {
+      setGemAnalysed(() => true);
+      source.close();
+    });
+
+    source.addEventListener("error", (error) => {
       console.log("An Unexpected Error Occured", error);
-    } finally {
       setLoading(false);
-    }
+      source.close();
+    });
   };
 
   return (
@@ -1,5 +1,5 @@
 import React, { useEffect, useRef, useState } from "react";
-import api from "../api";
+import { streamUrl } from "../api";
 import Loader from "./loader";
 import { motion, AnimatePresence } from "motion/react";
 import RenderCalendarCell from "./RenderCalendarCell";
@@ -178,7 +178,7 @@ const GeminiPlanSection = ({ gemAnalysed }) => {
   const hasFetched = useRef(false);
   const [calendar, setCalendar] = useState([]);
 
-  const getGemPlan = async () => {
+  const getGemPlan = () => {
     console.log("Fetching");
     if (hasFetched.current) {
       console.log("Already fetched, skipping...");
@@ -188,25 +188,40 @@ const GeminiPlanSection = ({ gemAnalysed }) => {
     hasFetched.current = true;
 
     setloading(true);
-    try {
-      const res = await api.get("/gemini-plan");
-      console.log("fetching plan");
-      if (res) {
-        const data = res.data;
-        setPlan(data.planData);
-        setPlanLoaded(true);
-        formatCalendar(data.planData);
-      }
-    } catch (error) {
+
+    // weeks are streamed over server sent events as each one is generated
+    const weeks = [];
+    const source = new EventSource(streamUrl("/gemini-plan/stream"));
+
+    source.addEventListener("week", (event) => {
+      weeks.push(JSON.parse(event.data));
+      const planData = { weeks: [...weeks] };
+      setPlan(planData);
+      setPlanLoaded(true);
+      formatCalendar(planData);
+    });
+
+    // the done event holds the whole plan, which is the local plan in place of any
+    // streamed weeks when gemini was too slow or failed
+    source.addEventListener("done", (event) => {
+      const data = JSON.parse(event.data);
+      setPlan(data.planData);
+      setPlanLoaded(true);
+      formatCalendar(data.planData);
+      setloading(false);
+      source.close();
+    });
+
+    source.addEventListener("error", (error) => {
       console.error(
         "An Unexpected Error Occured when trying to retrieve plan",
         error
       );
       setError(error);
       hasFetched.current = false;
-    } finally {
       setloading(false);
-    }
+      source.close();
+    });
   };
 
   useEffect(() => {
@@ -277,7 +292,7 @@ const GeminiPlanSection = ({ gemAnalysed }) => {
     <div className="relative text-white w-full flex justify-center p-4 mb-15">
       <div className="w-full max-w-6xl">
         <div className="flex justify-center">
-          {loading && (
+          {loading && !planLoaded && (
             <div className="flex flex-col items-center">
               <h1 className="text-3xl font-rubik">
                 Generating your 5 week plan{" "}
@@ -1,5 +1,5 @@
 import React, { useEffect, useState } from "react";
-import api from "../api";
+import api, { setAthleteId } from "../api";
 import Loader from "./loader";
 import { motion } from "motion/react";
 
@@ -42,6 +42,7 @@ const StravaImportSection = ({ setStravaData }) => {
     const authStatus = params.get("auth");
 
     if (authStatus === "success") {
+      setAthleteId(params.get("athlete_id"));
       const section = document.getElementById("strava-data");
       if (section) section.scrollIntoView({ behavior: "smooth" });
       setClicked(true);
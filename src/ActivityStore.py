@@ -0,0 +1,176 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Sync bookkeeping for each athlete, when they last synced and which activities they
+# have with their start times and whether an edit made them stale. The activities
+# themselves are kept once, in the columnar store.
+
+
+class ActivityStore:
+    def __init__(self, dbPath="strava_activities.db"):
+        self.dbPath = dbPath
+        self._lock = threading.Lock()
+        self._createTables()
+
+    @contextmanager
+    def _connect(self):
+        with self._lock:
+            conn = sqlite3.connect(self.dbPath)
+            try:
+                yield conn
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _createTables(self):
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS athletes (
+                    athlete_id INTEGER PRIMARY KEY,
+                    firstname TEXT,
+                    lastname TEXT,
+                    email TEXT,
+                    last_sync_at REAL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS activities (
+                    athlete_id INTEGER NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    start_ts REAL,
+                    stale INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (athlete_id, activity_id)
+                )
+                """
+            )
+            # databases from before the columnar store held a copy of every activity
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(activities)")]
+            if "payload" in columns:
+                conn.execute("ALTER TABLE activities DROP COLUMN payload")
+
+    # Athletes
+
+    def saveAthlete(self, athleteInfo):
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO athletes (athlete_id, firstname, lastname, email)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(athlete_id) DO UPDATE SET
+                    firstname = excluded.firstname,
+                    lastname = excluded.lastname,
+                    email = excluded.email
+                """,
+                (
+                    athleteInfo["id"],
+                    athleteInfo["firstname"],
+                    athleteInfo["lastname"],
+                    athleteInfo["email"],
+                ),
+            )
+
+    def getAthlete(self, athleteId):
+        """Returns the athlete info dict in the same shape as getAthleteinfo"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT athlete_id, firstname, lastname, email FROM athletes WHERE athlete_id = ?",
+                (athleteId,),
+            ).fetchone()
+
+        if not row:
+            return None
+        return {"id": row[0], "firstname": row[1], "lastname": row[2], "email": row[3]}
+
+    def markSynced(self, athleteId, syncedAt=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE athletes SET last_sync_at = ? WHERE athlete_id = ?",
+                (syncedAt if syncedAt is not None else time.time(), athleteId),
+            )
+
+    def markOutOfDate(self, athleteId):
+        """Forces the next request for this athlete to sync with strava"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE athletes SET last_sync_at = NULL WHERE athlete_id = ?",
+                (athleteId,),
+            )
+
+    def isFresh(self, athleteId, maxAge):
+        """True when the athlete synced within maxAge seconds and nothing is invalidated"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT last_sync_at FROM athletes WHERE athlete_id = ?", (athleteId,)
+            ).fetchone()
+            staleCount = conn.execute(
+                "SELECT COUNT(*) FROM activities WHERE athlete_id = ? AND stale = 1",
+                (athleteId,),
+            ).fetchone()[0]
+
+        if not row or row[0] is None:
+            return False
+        return staleCount == 0 and time.time() - row[0] < maxAge
+
+    # Activities
+
+    def recordActivities(self, athleteId, activityIds, startTimes=None):
+        """
+        Records synced activities as up to date, startTimes maps activity id to a
+        unix timestamp. Activities re-fetched after an edit keep their stored start time.
+        """
+        startTimes = startTimes or {}
+        rows = [
+            (athleteId, activityId, startTimes.get(activityId))
+            for activityId in activityIds
+        ]
+        with self._connect() as conn:
+            conn.executemany(
+                """
+                INSERT INTO activities (athlete_id, activity_id, start_ts, stale)
+                VALUES (?, ?, ?, 0)
+                ON CONFLICT(athlete_id, activity_id) DO UPDATE SET
+                    start_ts = COALESCE(excluded.start_ts, activities.start_ts),
+                    stale = 0
+                """,
+                rows,
+            )
+
+    def latestStartTime(self, athleteId):
+        """Unix timestamp of the newest cached activity, None if nothing is cached"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT MAX(start_ts) FROM activities WHERE athlete_id = ?",
+                (athleteId,),
+            ).fetchone()
+        return row[0]
+
+    def getStaleActivityIds(self, athleteId):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT activity_id FROM activities WHERE athlete_id = ? AND stale = 1",
+                (athleteId,),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def invalidateActivity(self, athleteId, activityId):
+        """Marks an edited activity so the next sync fetches it again"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE activities SET stale = 1 WHERE athlete_id = ? AND activity_id = ?",
+                (athleteId, activityId),
+            )
+
+    def deleteActivity(self, athleteId, activityId):
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM activities WHERE athlete_id = ? AND activity_id = ?",
+                (athleteId, activityId),
+            )
+
+
+activityStore = ActivityStore()
@@ -0,0 +1,104 @@
+import os
+import shutil
+
+import numpy as np
+
+# Per second activity streams kept as one small .npy file per stream so they can be
+# memory mapped. An hour long run is ~3600 samples, around 60KB across every stream.
+STREAM_DTYPES = {
+    "time": np.uint16,  # seconds from the start, widened for runs over 18 hours
+    "distance": np.float32,
+    "velocity_smooth": np.float32,
+    "altitude": np.float32,
+    "heartrate": np.uint8,
+    "cadence": np.uint8,
+}
+
+
+def _asArray(streamType, data):
+    dtype = STREAM_DTYPES[streamType]
+    values = np.asarray(data)
+    if streamType == "time" and values.size and values.max() > np.iinfo(dtype).max:
+        dtype = np.uint32
+    if np.issubdtype(dtype, np.integer):
+        values = np.clip(np.rint(values), 0, np.iinfo(dtype).max)
+    return values.astype(dtype)
+
+
+def fetchActivityStreams(client, activityId, types=tuple(STREAM_DTYPES)):
+    """
+    Fetches an activities streams from strava at full resolution as typed arrays.
+    Streams the activity was not recorded with are left out.
+    """
+    streams = client.get_activity_streams(
+        activityId, types=list(types), resolution="high", series_type="time"
+    )
+
+    arrays = {}
+    for streamType, stream in (streams or {}).items():
+        streamType = str(getattr(streamType, "value", streamType))
+        if streamType in STREAM_DTYPES and stream.data:
+            arrays[streamType] = _asArray(streamType, stream.data)
+    return arrays
+
+
+class ActivityStreamStore:
+    """One directory per activity holding a .npy file for each of its streams"""
+
+    def __init__(self, rootDir="activity_streams"):
+        self.rootDir = rootDir
+
+    def _activityDir(self, athleteId, activityId):
+        return os.path.join(self.rootDir, str(athleteId), str(activityId))
+
+    def has(self, athleteId, activityId):
+        return os.path.isdir(self._activityDir(athleteId, activityId))
+
+    def save(self, athleteId, activityId, streams):
+        """Writes the streams, replacing any saved for the activity before"""
+        activityDir = self._activityDir(athleteId, activityId)
+        tmpDir = activityDir + ".tmp"
+        shutil.rmtree(tmpDir, ignore_errors=True)
+        os.makedirs(tmpDir)
+
+        for streamType, values in streams.items():
+            np.save(os.path.join(tmpDir, f"{streamType}.npy"), values)
+
+        shutil.rmtree(activityDir, ignore_errors=True)
+        os.rename(tmpDir, activityDir)
+
+    def load(self, athleteId, activityId, types=None):
+        """Memory maps the requested streams, nothing is read until it is sliced"""
+        activityDir = self._activityDir(athleteId, activityId)
+        if not os.path.isdir(activityDir):
+            return {}
+
+        streams = {}
+        for streamType in types or STREAM_DTYPES:
+            path = os.path.join(activityDir, f"{streamType}.npy")
+            if os.path.exists(path):
+                streams[streamType] = np.load(path, mmap_mode="r")
+        return streams
+
+    def window(self, athleteId, activityId, start=0, end=None, types=None):
+        """
+        Streams between start and end seconds as views onto the mapped files,
+        the time stream is always included to locate the window.
+        """
+        wanted = set(types or STREAM_DTYPES) | {"time"}
+        streams = self.load(athleteId, activityId, wanted)
+        if "time" not in streams:
+            return {}
+
+        time = streams["time"]
+        first = int(np.searchsorted(time, start, side="left"))
+        last = len(time) if end is None else int(np.searchsorted(time, end, "right"))
+        return {
+            streamType: values[first:last] for streamType, values in streams.items()
+        }
+
+    def delete(self, athleteId, activityId):
+        shutil.rmtree(self._activityDir(athleteId, activityId), ignore_errors=True)
+
+
+activityStreams = ActivityStreamStore()
@@ -0,0 +1,8 @@
+import random
+
+# Retry waits shared by every upstream client, strava auth and gemini alike.
+
+
+def backoffDelay(attempt, base, cap):
+    """Full jitter, so clients retrying together spread out instead of stampeding"""
+    return random.uniform(0, min(cap, base * 2**attempt))
@@ -0,0 +1,494 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+import numpy as np
+
+from GatherData import parseDistance, parseDuration, parsePace
+from Telemetry import traced
+
+# Append-only columnar storage for processed activities. Every append writes a new
+# immutable segment directory holding one .npy file per column, which readers
+# memory map so a query only touches the columns and segments it needs. The
+# manifest lists segments in order, later segments replace earlier versions of an
+# activity and tombstone entries hide deleted ones. Once an athlete has more than a
+# few segments they are compacted back into one holding only the live versions.
+
+EPOCH = np.datetime64("1970-01-01", "D")
+
+# Appends an athlete may make before their segments are merged back into one
+COMPACT_AFTER_SEGMENTS = int(os.getenv("STORE_COMPACT_AFTER_SEGMENTS", "8"))
+
+# Written once the old single user json file has been dealt with, so it is never imported twice
+LEGACY_MARKER = "legacy_migrated.json"
+
+ACTIVITY_COLUMNS = {
+    "id": np.int64,
+    "day": np.int32,  # days since 1970-01-01
+    "distance_dam": np.int32,  # decametres, exact for the 2dp kilometre totals
+    "moving_s": np.int32,
+    "pace_s": np.uint16,  # seconds per kilometre
+    "avg_hr": np.float32,  # nan when the run has no heart rate
+    "max_hr": np.float32,
+}
+
+SPLIT_COLUMNS = {
+    "split_no": np.uint16,
+    "split_distance": np.float32,
+    "split_time_s": np.uint32,
+    "split_pace_s": np.uint16,
+    "split_elevation": np.float32,
+    "split_hr": np.uint16,
+}
+
+
+TEXT_COLUMNS = ("name", "description")
+
+ALL_COLUMNS = (*ACTIVITY_COLUMNS, *SPLIT_COLUMNS, *TEXT_COLUMNS)
+
+
+def _dayNumber(date):
+    """'dd-mm-YYYY' as days since the epoch"""
+    iso = f"{date[6:10]}-{date[3:5]}-{date[0:2]}"
+    return int((np.datetime64(iso, "D") - EPOCH).astype(np.int64))
+
+
+def _dayString(day):
+    return (EPOCH + np.timedelta64(int(day), "D")).astype(object).strftime("%d-%m-%Y")
+
+
+def _formatPace(seconds):
+    # the same format as convertSpeed
+    return f"{int(seconds) // 60}:{int(seconds) % 60:02d}/km"
+
+
+def _asDict(activity):
+    return activity.model_dump() if hasattr(activity, "model_dump") else activity
+
+
+class ColumnarActivityStore:
+    def __init__(
+        self, rootDir="activity_segments", compactAfter=COMPACT_AFTER_SEGMENTS
+    ):
+        self.rootDir = rootDir
+        self.compactAfter = compactAfter
+        self._lock = threading.Lock()
+        self._migrateLock = threading.Lock()
+
+    def _athleteDir(self, athleteId):
+        return os.path.join(self.rootDir, str(athleteId))
+
+    def _manifestPath(self, athleteId):
+        return os.path.join(self._athleteDir(athleteId), "manifest.jsonl")
+
+    def _manifest(self, athleteId):
+        try:
+            with open(self._manifestPath(athleteId), "r") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def _appendManifest(self, athleteId, entry):
+        with open(self._manifestPath(athleteId), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _replaceManifest(self, athleteId, entries):
+        athleteDir = self._athleteDir(athleteId)
+        fd, tmpPath = tempfile.mkstemp(dir=athleteDir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, self._manifestPath(athleteId))
+
+    def hasData(self, athleteId):
+        return any("segment" in entry for entry in self._manifest(athleteId))
+
+    def segmentCount(self, athleteId):
+        return sum("segment" in entry for entry in self._manifest(athleteId))
+
+    # Writing
+
+    def _nextSegment(self, athleteId):
+        """Numbers keep rising across compactions so a new segment never reuses a name"""
+        numbers = [
+            int(name[4:])
+            for name in os.listdir(self._athleteDir(athleteId))
+            if name.startswith("seg-")
+        ]
+        return f"seg-{max(numbers, default=0) + 1:06d}"
+
+    def _writeSegment(self, athleteId, columns, splitColumns, splitStart, text):
+        """Writes one segment directory from column arrays, returns its manifest entry"""
+        athleteDir = self._athleteDir(athleteId)
+        os.makedirs(athleteDir, exist_ok=True)
+        segment = self._nextSegment(athleteId)
+        tmpDir = os.path.join(athleteDir, f".{segment}.tmp")
+        shutil.rmtree(tmpDir, ignore_errors=True)
+        os.makedirs(tmpDir)
+
+        for name, dtype in ACTIVITY_COLUMNS.items():
+            np.save(
+                os.path.join(tmpDir, f"{name}.npy"), np.asarray(columns[name], dtype)
+            )
+        for name, dtype in SPLIT_COLUMNS.items():
+            np.save(
+                os.path.join(tmpDir, f"{name}.npy"),
+                np.asarray(splitColumns[name], dtype),
+            )
+        np.save(
+            os.path.join(tmpDir, "split_start.npy"), np.asarray(splitStart, np.int64)
+        )
+        with open(os.path.join(tmpDir, "text.json"), "w") as f:
+            json.dump(text, f)
+
+        os.rename(tmpDir, os.path.join(athleteDir, segment))
+        return {
+            "segment": segment,
+            "rows": len(text),
+            "minDay": int(np.min(columns["day"])),
+            "maxDay": int(np.max(columns["day"])),
+        }
+
+    @traced("store.append")
+    def append(self, athleteId, activities):
+        """Writes the activities as a new segment, earlier versions of them are superseded"""
+        activities = [_asDict(activity) for activity in activities]
+        if not activities:
+            return None
+
+        columns = {name: [] for name in ACTIVITY_COLUMNS}
+        splitColumns = {name: [] for name in SPLIT_COLUMNS}
+        splitStart = [0]
+        text = []
+
+        for activity in activities:
+            columns["id"].append(activity["id"])
+            columns["day"].append(_dayNumber(activity["date"]))
+            columns["distance_dam"].append(
+                round(parseDistance(activity["distanceTotal"]) * 100)
+            )
+            columns["moving_s"].append(parseDuration(activity["movingTime"]))
+            columns["pace_s"].append(parsePace(activity["averageSpeed"]))
+            columns["avg_hr"].append(
+                np.nan if activity["avgHr"] is None else activity["avgHr"]
+            )
+            columns["max_hr"].append(
+                np.nan if activity["maxHr"] is None else activity["maxHr"]
+            )
+
+            for split in activity["splits"]:
+                splitColumns["split_no"].append(split["id"])
+                splitColumns["split_distance"].append(split["distance"])
+                splitColumns["split_time_s"].append(parseDuration(split["time"]))
+                splitColumns["split_pace_s"].append(parsePace(split["avgSpeed"]))
+                splitColumns["split_elevation"].append(split["elevationDiff"])
+                splitColumns["split_hr"].append(split["avgHr"])
+            splitStart.append(splitStart[-1] + len(activity["splits"]))
+
+            text.append([activity["name"], activity["description"]])
+
+        with self._lock:
+            entry = self._writeSegment(
+                athleteId, columns, splitColumns, splitStart, text
+            )
+            self._appendManifest(athleteId, entry)
+
+        if self.compactAfter and self.segmentCount(athleteId) > self.compactAfter:
+            self.compact(athleteId)
+        return entry["segment"]
+
+    def delete(self, athleteId, activityIds):
+        """Hides activities from every earlier segment"""
+        with self._lock:
+            os.makedirs(self._athleteDir(athleteId), exist_ok=True)
+            self._appendManifest(athleteId, {"tombstones": list(activityIds)})
+
+    @traced("store.compact")
+    def compact(self, athleteId):
+        """
+        Rewrites the live version of every activity into a single segment and swaps
+        the manifest over to it. Superseded versions and tombstones are dropped. The
+        replaced segments are kept until the next compaction so reads already under
+        way can finish.
+        """
+        with self._lock:
+            manifest = self._manifest(athleteId)
+            data = self.query(athleteId, ALL_COLUMNS)
+            if data["id"].size == 0:
+                return None
+
+            # oldest first, the order appends would have written them in
+            order = np.lexsort((data["id"], data["day"]))
+            splitCounts = np.bincount(data["split_row"], minlength=data["id"].size)
+            splitOffsets = np.concatenate([[0], np.cumsum(splitCounts)])
+            splitIndex = (
+                np.concatenate(
+                    [
+                        np.arange(splitOffsets[row], splitOffsets[row + 1])
+                        for row in order
+                    ]
+                )
+                if data["split_row"].size
+                else np.empty(0, np.int64)
+            )
+
+            entry = self._writeSegment(
+                athleteId,
+                {name: data[name][order] for name in ACTIVITY_COLUMNS},
+                {name: data[name][splitIndex] for name in SPLIT_COLUMNS},
+                np.concatenate([[0], np.cumsum(splitCounts[order])]),
+                [[data["name"][row], data["description"][row]] for row in order],
+            )
+            self._replaceManifest(athleteId, [entry])
+
+            # segments left from the compaction before this one have no readers now
+            keep = {entry["segment"]} | {
+                old["segment"] for old in manifest if "segment" in old
+            }
+            athleteDir = self._athleteDir(athleteId)
+            for name in os.listdir(athleteDir):
+                if name.startswith("seg-") and name not in keep:
+                    shutil.rmtree(os.path.join(athleteDir, name), ignore_errors=True)
+
+        print(
+            f"Compacted {sum('segment' in old for old in manifest)} segments "
+            f"into {entry['segment']} for athlete {athleteId}"
+        )
+        return entry["segment"]
+
+    # Reading
+
+    def _column(self, athleteId, segment, name):
+        return np.load(
+            os.path.join(self._athleteDir(athleteId), segment, f"{name}.npy"),
+            mmap_mode="r",
+        )
+
+    def _text(self, athleteId, segment):
+        with open(os.path.join(self._athleteDir(athleteId), segment, "text.json")) as f:
+            return json.load(f)
+
+    def _selectRows(self, athleteId, start, end, ids=None):
+        """
+        (segment, rows) pairs holding the latest version of every live activity in
+        the date range, limited to `ids` when given. Only id and day columns are read
+        to decide, segments outside the range are skipped without reading their days.
+        """
+        startDay = None if start is None else _dayNumber(start)
+        endDay = None if end is None else _dayNumber(end)
+        wanted = None if ids is None else np.asarray(list(ids), np.int64)
+        seen = set()
+        selected = []
+
+        for entry in reversed(self._manifest(athleteId)):
+            if "tombstones" in entry:
+                seen.update(entry["tombstones"])
+                continue
+
+            segment = entry["segment"]
+            segmentIds = self._column(athleteId, segment, "id")
+            latest = ~np.isin(segmentIds, np.fromiter(seen, np.int64, len(seen)))
+            seen.update(segmentIds.tolist())
+
+            if startDay is not None and entry["maxDay"] < startDay:
+                continue
+            if endDay is not None and entry["minDay"] > endDay:
+                continue
+
+            mask = latest
+            if wanted is not None:
+                mask = mask & np.isin(segmentIds, wanted)
+            if startDay is not None or endDay is not None:
+                day = self._column(athleteId, segment, "day")
+                if startDay is not None:
+                    mask = mask & (day >= startDay)
+                if endDay is not None:
+                    mask = mask & (day <= endDay)
+
+            rows = np.nonzero(mask)[0]
+            if rows.size:
+                selected.append((segment, rows))
+
+        selected.reverse()
+        return selected
+
+    def query(self, athleteId, columns=("id", "day"), start=None, end=None, ids=None):
+        """
+        Loads only the requested columns for activities between start and end
+        ('dd-mm-YYYY', inclusive), and only those in `ids` when given. Split columns
+        come back flattened with a split_row column giving the index of the activity
+        each split belongs to, name and description come back as lists.
+        """
+        activityNames = [name for name in columns if name in ACTIVITY_COLUMNS]
+        splitNames = [name for name in columns if name in SPLIT_COLUMNS]
+        textNames = [name for name in columns if name in TEXT_COLUMNS]
+        result = {name: [] for name in activityNames + splitNames}
+        texts = {name: [] for name in textNames}
+        splitRows = []
+        rowOffset = 0
+
+        for segment, rows in self._selectRows(athleteId, start, end, ids):
+            for name in activityNames:
+                result[name].append(
+                    np.asarray(self._column(athleteId, segment, name)[rows])
+                )
+
+            if textNames:
+                text = self._text(athleteId, segment)
+                for name in textNames:
+                    position = TEXT_COLUMNS.index(name)
+                    texts[name].extend(text[row][position] for row in rows.tolist())
+
+            if splitNames:
+                splitStart = self._column(athleteId, segment, "split_start")
+                counts = splitStart[rows + 1] - splitStart[rows]
+                splitIndex = (
+                    np.concatenate(
+                        [
+                            np.arange(a, b)
+                            for a, b in zip(splitStart[rows], splitStart[rows + 1])
+                        ]
+                    )
+                    if rows.size
+                    else np.empty(0, np.int64)
+                )
+                for name in splitNames:
+                    result[name].append(
+                        np.asarray(self._column(athleteId, segment, name)[splitIndex])
+                    )
+                splitRows.append(np.repeat(np.arange(rows.size) + rowOffset, counts))
+
+            rowOffset += rows.size
+
+        allColumns = {**ACTIVITY_COLUMNS, **SPLIT_COLUMNS}
+        for name, parts in result.items():
+            result[name] = (
+                np.concatenate(parts) if parts else np.empty(0, allColumns[name])
+            )
+        if splitNames:
+            result["split_row"] = (
+                np.concatenate(splitRows) if splitRows else np.empty(0, np.int64)
+            )
+        result.update(texts)
+        return result
+
+    @traced("store.load")
+    def loadActivities(self, athleteId, limit=None, start=None, end=None, ids=None):
+        """
+        Rebuilds activity dicts in the users_running_data.json shape, newest first,
+        only those in `ids` when given. Picking which activities to return only reads
+        the id and day columns, the rest are then read for just those activities.
+        """
+        keys = self.query(athleteId, ("id", "day"), start, end, ids)
+        order = np.lexsort((keys["id"], keys["day"]))[::-1]
+        if limit is not None:
+            order = order[:limit]
+        if order.size == 0:
+            return []
+
+        # the chosen runs are the newest, their earliest day bounds the segments read
+        firstDay = _dayString(keys["day"][order].min())
+        data = self.query(athleteId, ALL_COLUMNS, firstDay, end, ids=keys["id"][order])
+        splitCounts = np.bincount(data["split_row"], minlength=data["id"].size)
+        splitOffsets = np.concatenate([[0], np.cumsum(splitCounts)])
+
+        dataOrder = np.lexsort((data["id"], data["day"]))[::-1]
+        return [self._rebuild(data, splitOffsets, row) for row in dataOrder.tolist()]
+
+    @staticmethod
+    def _rebuild(data, splitOffsets, row):
+        avgHr, maxHr = float(data["avg_hr"][row]), float(data["max_hr"][row])
+        splits = [
+            {
+                "id": int(data["split_no"][i]),
+                "distance": round(float(data["split_distance"][i]), 1),
+                "avgSpeed": _formatPace(data["split_pace_s"][i]),
+                "time": str(timedelta(seconds=int(data["split_time_s"][i]))),
+                "elevationDiff": round(float(data["split_elevation"][i]), 1),
+                "avgHr": int(data["split_hr"][i]),
+            }
+            for i in range(splitOffsets[row], splitOffsets[row + 1])
+        ]
+        return {
+            "id": int(data["id"][row]),
+            "name": data["name"][row],
+            "description": data["description"][row],
+            "averageSpeed": _formatPace(data["pace_s"][row]),
+            "date": _dayString(data["day"][row]),
+            "distanceTotal": f"{round(int(data['distance_dam'][row]) / 100, 2)} KM",
+            "movingTime": str(timedelta(seconds=int(data["moving_s"][row]))),
+            "avgHr": None if np.isnan(avgHr) else round(avgHr, 1),
+            "maxHr": None if np.isnan(maxHr) else round(maxHr, 1),
+            "splits": splits,
+        }
+
+    def readRunningData(
+        self,
+        athleteId,
+        count=10,
+        legacyOwner=None,
+        legacyPath="users_running_data.json",
+    ):
+        """
+        Latest runs as {"activities": [...]}, what the analysis prompt is built from.
+        The first read by the owner of the old json file migrates it into their store.
+        """
+        self.migrateLegacyFile(athleteId, legacyOwner, legacyPath)
+
+        activities = self.loadActivities(athleteId, limit=count)
+        if not activities:
+            return None
+        return {"activities": activities}
+
+    def migrateLegacyFile(
+        self, athleteId, legacyOwner, filePath="users_running_data.json"
+    ):
+        """
+        Imports the old single user json file once, only into the athlete who owns the
+        legacy token file and only while they have nothing stored, so one users runs
+        never end up in another users data. Returns True when it imported anything.
+        """
+        if legacyOwner is None or athleteId != legacyOwner:
+            return False
+
+        markerPath = os.path.join(self.rootDir, LEGACY_MARKER)
+        with self._migrateLock:
+            if os.path.exists(markerPath):
+                return False
+
+            migrated = not self.hasData(athleteId) and self.migrateJsonFile(
+                athleteId, filePath
+            )
+            os.makedirs(self.rootDir, exist_ok=True)
+            with open(markerPath, "w") as f:
+                json.dump(
+                    {"athlete_id": athleteId, "migrated": migrated, "at": time.time()},
+                    f,
+                )
+        return migrated
+
+    def migrateJsonFile(self, athleteId, filePath="users_running_data.json"):
+        """Imports a users_running_data.json file as one segment"""
+        try:
+            with open(filePath, "r") as f:
+                activities = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+
+        if not activities:
+            return False
+
+        self.append(athleteId, activities)
+        print(f"Migrated {len(activities)} activities from {filePath}")
+        return True
+
+
+activitySegments = ColumnarActivityStore()
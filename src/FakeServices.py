@@ -0,0 +1,457 @@
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import httplib2
+from google.genai.errors import ClientError, ServerError
+from googleapiclient.errors import HttpError
+from stravalib.exc import Fault, RateLimitExceeded
+
+# In process stand-ins for strava, gemini and google calendar, used by the benchmarks
+# so every stage can run without network access. Each fake takes a FaultInjector
+# that adds latency and fails a share of calls with the service's own error types.
+
+
+class FaultInjector:
+    """Latency, error rate, 429 rate and hang rate applied to every call a fake makes"""
+
+    def __init__(
+        self,
+        latency=0.0,
+        jitter=0.0,
+        errorRate=0.0,
+        throttleRate=0.0,
+        hangRate=0.0,
+        hangSeconds=30.0,
+        seed=0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.throttleRate = throttleRate
+        # a hung call stalls for hangSeconds before it answers, as an upstream that stops responding
+        self.hangRate = hangRate
+        self.hangSeconds = hangSeconds
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+        self.hung = 0
+
+    def _roll(self):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            roll = self._random.random()
+            if roll < self.throttleRate:
+                self.throttled += 1
+                return delay, "throttle"
+            if roll < self.throttleRate + self.errorRate:
+                self.errors += 1
+                return delay, "error"
+            if roll < self.throttleRate + self.errorRate + self.hangRate:
+                self.hung += 1
+                return delay + self.hangSeconds, None
+            return delay, None
+
+    def hit(self):
+        """Sleeps for the call latency, returns None, "throttle" or "error" """
+        delay, fault = self._roll()
+        if delay:
+            time.sleep(delay)
+        return fault
+
+    def hitBatch(self, size):
+        """One latency for a whole batch request, a fault roll for each call in it"""
+        faults = [self._roll() for _ in range(size)]
+        delay = max((delay for delay, _ in faults), default=0.0)
+        if delay:
+            time.sleep(delay)
+        return [fault for _, fault in faults]
+
+    async def hitAsync(self):
+        delay, fault = self._roll()
+        if delay:
+            await asyncio.sleep(delay)
+        return fault
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "hung": self.hung,
+        }
+
+
+# Strava
+
+
+def _fakeRun(activityId, startDate, rng):
+    kilometres = rng.randint(3, 15)
+    splitSpeeds = [rng.uniform(2.6, 3.6) for _ in range(kilometres)]
+    splits = [
+        SimpleNamespace(
+            split=i + 1,
+            distance=1000.0,
+            average_speed=speed,
+            moving_time=round(1000 / speed),
+            elevation_difference=round(rng.uniform(-8, 8), 1),
+            average_heartrate=rng.uniform(135, 175),
+        )
+        for i, speed in enumerate(splitSpeeds)
+    ]
+    movingTime = sum(split.moving_time for split in splits)
+    return SimpleNamespace(
+        id=activityId,
+        name=f"Run {activityId}",
+        description=rng.choice(["", "Easy", "Felt good, legs tired at the end"]),
+        type=SimpleNamespace(root="Run"),
+        start_date=startDate,
+        moving_time=movingTime,
+        distance=kilometres * 1000.0,
+        average_speed=kilometres * 1000.0 / movingTime,
+        has_heartrate=True,
+        average_heartrate=round(rng.uniform(140, 170), 1),
+        max_heartrate=round(rng.uniform(170, 190), 1),
+        splits_metric=splits,
+    )
+
+
+class _FakeActivityPages:
+    """Iterates like stravalib's BatchedResultsIterator, one fault roll per page"""
+
+    def __init__(self, client, activities):
+        self.client = client
+        self.activities = activities
+        self.per_page = 30
+
+    def __iter__(self):
+        for start in range(0, len(self.activities), self.per_page):
+            self.client._call()
+            yield from self.activities[start : start + self.per_page]
+
+
+class FakeStravaClient:
+    def __init__(self, activityCount=50, faults=None, athleteId=1, seed=0):
+        self.faults = faults or FaultInjector()
+        self.athleteId = athleteId
+        rng = random.Random(seed)
+        newest = datetime(2025, 8, 15, 7, 0, tzinfo=timezone.utc)
+        # newest first, as strava lists them
+        self.activities = [
+            _fakeRun(10_000 + activityCount - i, newest - timedelta(days=i), rng)
+            for i in range(activityCount)
+        ]
+        self._byId = {activity.id: activity for activity in self.activities}
+
+    def _call(self):
+        fault = self.faults.hit()
+        if fault == "throttle":
+            raise RateLimitExceeded("Rate limit exceeded", timeout=0.0)
+        if fault == "error":
+            raise Fault("500 Server Error: injected by FakeStravaClient")
+
+    def get_athlete(self):
+        self._call()
+        return SimpleNamespace(
+            id=self.athleteId, firstname="Bench", lastname="Runner", email=None
+        )
+
+    def get_activities(self, before=None, after=None, limit=None):
+        activities = [
+            activity
+            for activity in self.activities
+            if (before is None or activity.start_date < before)
+            and (after is None or activity.start_date > after)
+        ]
+        return _FakeActivityPages(self, activities[:limit])
+
+    def get_activity(self, activity_id):
+        self._call()
+        return self._byId[activity_id]
+
+    def get_activity_streams(
+        self, activity_id, types=None, resolution=None, series_type=None
+    ):
+        self._call()
+        activity = self._byId[activity_id]
+        seconds = list(range(activity.moving_time))
+        speed = activity.average_speed
+        streams = {
+            "time": seconds,
+            "distance": [second * speed for second in seconds],
+            "velocity_smooth": [speed] * len(seconds),
+            "altitude": [40.0] * len(seconds),
+            "heartrate": [activity.average_heartrate] * len(seconds),
+            "cadence": [86] * len(seconds),
+        }
+        return {
+            streamType: SimpleNamespace(data=data)
+            for streamType, data in streams.items()
+            if types is None or streamType in types
+        }
+
+
+# Gemini
+
+
+def fakeTrainingPlan(weeks=5, start=None):
+    """A schema valid TrainingPlan dict with four runs a week"""
+    start = start or datetime(2025, 8, 18)
+    runTypes = {0: "Intervals", 2: "Tempo", 4: "Easy Run", 6: "Long Run"}
+    plan = {"weeks": []}
+    for week in range(weeks):
+        workouts = []
+        for day in range(7):
+            date = start + timedelta(weeks=week, days=day)
+            runType = runTypes.get(day, "Rest")
+            isRun = runType != "Rest"
+            workouts.append(
+                {
+                    "day": date.strftime("%A"),
+                    "date": date.strftime("%Y-%m-%d"),
+                    "type": runType,
+                    "description": f"{runType} for week {week + 1}",
+                    "distance_km": 6.0 + week if isRun else None,
+                    "target_pace_min_km": "5:30" if isRun else None,
+                    "duration_minutes": 40 + 5 * week if isRun else None,
+                }
+            )
+        plan["weeks"].append({"week_number": week + 1, "workouts": workouts})
+    return plan
+
+
+def fakePlanOutline(weeks=5):
+    """A schema valid PlanOutline dict building volume each week"""
+    return {
+        "weeks": [
+            {
+                "week_number": week + 1,
+                "focus": "Recovery" if week % 4 == 3 else "Build",
+                "target_km": 30.0 + 3 * week,
+                "long_run_km": 10.0 + week,
+                "key_sessions": ["Intervals", "Tempo", "Long Run"],
+            }
+            for week in range(weeks)
+        ]
+    }
+
+
+_planWeeks = re.compile(r"(?:create|outline) a (\d+) week")
+_weekPrompt = re.compile(
+    r"week (\d+) of a running plan, the week starting monday (\d{4}-\d{2}-\d{2})"
+)
+
+
+def _fakeResponse(text, prompt):
+    return SimpleNamespace(
+        text=text,
+        usage_metadata=SimpleNamespace(
+            prompt_token_count=max(1, len(str(prompt)) // 4),
+            candidates_token_count=max(1, len(text) // 4),
+        ),
+    )
+
+
+class _FakeModels:
+    def __init__(self, client):
+        self.client = client
+
+    def _reply(self, contents, config):
+        schema = (
+            (config or {}).get("response_schema") if isinstance(config, dict) else None
+        )
+        name = getattr(schema, "__name__", None)
+        # plan prompts ask for a number of weeks, the client's planWeeks otherwise
+        weeks = _planWeeks.search(str(contents))
+        weeks = int(weeks[1]) if weeks else self.client.planWeeks
+        if name == "PlanOutline":
+            return json.dumps(fakePlanOutline(weeks))
+        if name == "Week":
+            # per week prompts name the week and the monday it starts on
+            match = _weekPrompt.search(str(contents))
+            weekNumber, start = int(match[1]), datetime.fromisoformat(match[2])
+            week = fakeTrainingPlan(1, start)["weeks"][0]
+            return json.dumps(dict(week, week_number=weekNumber))
+        if schema is not None:
+            return json.dumps(fakeTrainingPlan(weeks))
+        return self.client.analysisText
+
+    def generate_content(self, model, contents, config=None):
+        self.client._raise(self.client.faults.hit())
+        return _fakeResponse(self._reply(contents, config), contents)
+
+
+class _FakeAsyncModels(_FakeModels):
+    async def generate_content(self, model, contents, config=None):
+        self.client._raise(await self.client.faults.hitAsync())
+        return _fakeResponse(self._reply(contents, config), contents)
+
+    async def generate_content_stream(self, model, contents, config=None):
+        self.client._raise(await self.client.faults.hitAsync())
+        text = self._reply(contents, config)
+
+        async def chunks():
+            for start in range(0, len(text), self.client.chunkSize):
+                await asyncio.sleep(self.client.chunkDelay)
+                yield _fakeResponse(
+                    text[start : start + self.client.chunkSize], contents
+                )
+
+        return chunks()
+
+
+class FakeGenAiClient:
+    """Answers like genai.Client, plan requests get a generated TrainingPlan json"""
+
+    def __init__(
+        self, faults=None, planWeeks=5, chunkSize=64, chunkDelay=0.0, analysisText=None
+    ):
+        self.faults = faults or FaultInjector()
+        self.planWeeks = planWeeks
+        self.chunkSize = chunkSize
+        # seconds between streamed chunks, how quickly the fake model writes
+        self.chunkDelay = chunkDelay
+        self.analysisText = analysisText or (
+            "Effort has been steady with easy runs sitting around 150bpm. Pace on "
+            "tempo efforts is improving week on week, no concerning heart rate patterns."
+        )
+        self.models = _FakeModels(self)
+        self.aio = SimpleNamespace(models=_FakeAsyncModels(self))
+
+    def _raise(self, fault):
+        if fault == "throttle":
+            raise ClientError(429, {"error": {"message": "Resource exhausted"}})
+        if fault == "error":
+            raise ServerError(
+                503, {"error": {"message": "Injected by FakeGenAiClient"}}
+            )
+
+
+# Google calendar
+
+
+def _httpError(status):
+    return HttpError(
+        httplib2.Response({"status": status}), b"injected by FakeCalendarService"
+    )
+
+
+class _FakeRequest:
+    def __init__(self, service, action):
+        self.service = service
+        self.action = action
+
+    def _run(self, fault=None):
+        # batches roll their faults up front and pass "ok" for calls that succeed
+        fault = fault or self.service.faults.hit()
+        if fault == "throttle":
+            raise _httpError(429)
+        if fault == "error":
+            raise _httpError(503)
+        return self.action()
+
+    def execute(self):
+        return self._run()
+
+
+class _FakeEvents:
+    def __init__(self, service):
+        self.service = service
+
+    def insert(self, calendarId, body):
+        def action():
+            with self.service._lock:
+                self.service._nextId += 1
+                event = dict(body, id=f"evt{self.service._nextId}")
+                self.service.events_[event["id"]] = event
+                return event
+
+        return _FakeRequest(self.service, action)
+
+    def patch(self, calendarId, eventId, body):
+        def action():
+            with self.service._lock:
+                self.service.events_[eventId] = dict(body, id=eventId)
+                return self.service.events_[eventId]
+
+        return _FakeRequest(self.service, action)
+
+    def delete(self, calendarId, eventId):
+        def action():
+            with self.service._lock:
+                self.service.events_.pop(eventId, None)
+            return ""
+
+        return _FakeRequest(self.service, action)
+
+    def list(
+        self,
+        calendarId,
+        privateExtendedProperty=None,
+        maxResults=250,
+        pageToken=None,
+        **kwargs,
+    ):
+        def action():
+            key, _, value = (privateExtendedProperty or "").partition("=")
+            items = [
+                event
+                for event in self.service.events_.values()
+                if not key
+                or event.get("extendedProperties", {}).get("private", {}).get(key)
+                == value
+            ]
+            return {"items": items}
+
+        return _FakeRequest(self.service, action)
+
+
+class _FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        # one round trip for the whole batch, faults still land per call as they do in real batches
+        self.service.batches += 1
+        faults = self.service.faults.hitBatch(len(self.requests))
+        for (requestId, request), fault in zip(self.requests, faults):
+            try:
+                self.callback(requestId, request._run(fault or "ok"), None)
+            except HttpError as e:
+                self.callback(requestId, None, e)
+
+
+class FakeCalendarService:
+    """Stands in for build("calendar", "v3"), keeping inserted events in memory"""
+
+    def __init__(self, faults=None):
+        self.faults = faults or FaultInjector()
+        self.events_ = {}
+        self.batches = 0
+        self._nextId = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def events(self):
+        return _FakeEvents(self)
+
+    def new_batch_http_request(self, callback=None):
+        return _FakeBatch(self, callback)
@@ -1,10 +1,10 @@
 from pydantic import BaseModel
 from datetime import timedelta
 import math
-import json
 import time
 from stravalib.exc import Fault, RateLimitExceeded, AccessUnauthorized
 from StravaApiAuth import getAuthenticatedUser, getAthleteinfo
+from Telemetry import rateLimited, retries, traced
 
 # Our data models to be used when prompting the AI
 
@@ -31,6 +31,7 @@ class Activity(BaseModel):
     splits: list[Split]
 
 
+@traced("strava.activity_detail")
 def processActivityData(client, activity_id=None, max_retries=3):
     """
     Processes a single activity returning a single activity object with error handling
@@ -100,8 +101,10 @@ def processActivityData(client, activity_id=None, max_retries=3):
             return Activity(**tempDict)
 
         except RateLimitExceeded as e:
-            print(f"Rate limit exceeded. Waiting 60 seconds... : {e}")
-            time.sleep(60)
+            # the scheduler has seen the exhausted quota and holds the retry until it resets
+            print(f"Rate limit exceeded, retry deferred by the scheduler : {e}")
+            rateLimited.inc(service="strava")
+            retries.inc(service="strava", reason="rate_limit")
             continue
 
         except AccessUnauthorized as e:
@@ -115,6 +118,7 @@ def processActivityData(client, activity_id=None, max_retries=3):
                 if attempt < max_retries - 1:
                     wait_time = 2**attempt  # Exponential backoff: 1s, 2s, 4s
                     print(f"Retrying in {wait_time} seconds...")
+                    retries.inc(service="strava", reason="server_error")
                     time.sleep(wait_time)
                     continue
                 else:
@@ -158,35 +162,73 @@ def convertSpeed(speed):
     return total
 
 
-def gatherLastRunsFromTen(client):
+def parseDuration(duration):
+    """Turns a formatted time such as "0:37:26" back into seconds"""
+    seconds = 0.0
+    for part in duration.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def parseDistance(distance):
+    """Turns a formatted distance such as "6.21 KM" back into kilometres"""
+    return float(distance.split()[0])
+
+
+def parsePace(pace):
+    """Turns a formatted pace such as "6:47/km" back into seconds per kilometre"""
+    return parseDuration(pace.split("/")[0])
+
+
+def formatPace(secondsPerKm):
+    minutes, seconds = divmod(int(round(secondsPerKm)), 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+def iterActivitySummaries(client, before=None, pageSize=30):
     """
-    gets all activities between specified start and end date set to an event limit
+    Lazily pages through the athletes activities newest first, the next page is
+    only requested from strava once the previous one has been used up
     """
-    activities = list(client.get_activities(limit=200))
-
-    runListIds = []
-
-    if activities:
-        for acti in activities:
-            if acti.type == "Run":
-                runListIds.append(acti.id)
-                if len(runListIds) == 10:
-                    break
-
-        if runListIds:
-            return runListIds
-        else:
-            return (
-                "No runs found in your last 10 activities, get running to gather data"
-            )
-    else:
-        return "No Activities on this account"
+    activities = client.get_activities(before=before)
+    # the batched iterator requests this many summaries per page
+    activities.per_page = pageSize
+    return activities
 
 
-def dumpJsonFile(activityData, filePath="users_running_data.json"):
+def activityType(activity):
+    # stravalib wraps the type in a root model on newer versions
+    return getattr(activity.type, "root", activity.type)
+
+
+def iterRuns(
+    client, count=None, after=None, before=None, pageSize=30, sportTypes=("Run",)
+):
+    """
+    Yields matching activities newest first as pages arrive. Paging stops as soon as
+    `count` runs are found or the listing reaches activities started before `after`
+    """
+    found = 0
+
+    for acti in iterActivitySummaries(client, before=before, pageSize=pageSize):
+        if after is not None and acti.start_date <= after:
+            return
+
+        if activityType(acti) in sportTypes:
+            yield acti
+            found += 1
+            if count is not None and found >= count:
+                return
+
+
+@traced("strava.list")
+def gatherLastRunsFromTen(client, count=10, pageSize=30):
     """
-    save activities to a json file with the use of pydantic built in method
+    gets the ids of the latest `count` runs, only fetching as many pages of activities as needed
     """
-    with open(filePath, "w") as f:
-        activityDicts = [activity.model_dump() for activity in activityData]
-        json.dump(activityDicts, f, indent=2)
+    runListIds = [acti.id for acti in iterRuns(client, count=count, pageSize=pageSize)]
+
+    if runListIds:
+        return runListIds
+    else:
+        return "No runs found in your recent activities, get running to gather data"
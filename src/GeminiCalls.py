@@ -0,0 +1,266 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeout
+
+from google.genai.errors import APIError
+
+from Backoff import backoffDelay
+from Telemetry import carryContext, metrics, rateLimited, retries
+
+# Every gemini call goes through here. Each attempt gets a deadline so a hung call
+# can't hold a server worker forever, retryable failures are retried with jittered
+# backoff, and after repeated upstream failures a circuit breaker fails calls at once
+# until gemini has had time to recover.
+
+# Seconds one attempt may take before it is abandoned
+GEMINI_CALL_TIMEOUT = float(os.getenv("GEMINI_CALL_TIMEOUT", "60"))
+# Attempts per call, the first included
+GEMINI_MAX_ATTEMPTS = int(os.getenv("GEMINI_MAX_ATTEMPTS", "3"))
+# Backoff before retry n is a random wait up to base * 2^n seconds, capped
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "0.5"))
+GEMINI_BACKOFF_CAP = float(os.getenv("GEMINI_BACKOFF_CAP", "8"))
+# Consecutive failed calls that open the breaker, and seconds it stays open
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+breakerState = metrics.gauge(
+    "circuit_breaker_state",
+    "Circuit breaker state, 0 closed, 1 half open, 2 open",
+    ("service",),
+)
+breakerRejected = metrics.counter(
+    "circuit_breaker_rejected_total",
+    "Calls failed fast while the breaker was open",
+    ("service",),
+)
+callTimeouts = metrics.counter(
+    "call_timeouts_total", "Call attempts abandoned at their deadline", ("service",)
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling gemini while the breaker is open"""
+
+
+class CallTimeoutError(TimeoutError):
+    """An attempt ran past its deadline"""
+
+
+def isRetryable(error):
+    if isinstance(error, (CallTimeoutError, ConnectionError)):
+        return True
+    if isinstance(error, APIError):
+        return error.code in RETRYABLE_CODES
+    # transport errors from httpx, which the sdk lets through unwrapped
+    return type(error).__module__.startswith("httpx")
+
+
+class CircuitBreaker:
+    """
+    Closed lets every call through. After `threshold` consecutive failures it opens
+    and rejects calls for `cooldown` seconds, then half opens to let a single trial
+    call through, which closes it again on success or reopens it on failure.
+    """
+
+    _stateValues = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(
+        self,
+        name,
+        threshold=GEMINI_BREAKER_THRESHOLD,
+        cooldown=GEMINI_BREAKER_COOLDOWN,
+    ):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.openedAt = None
+        self.trialInFlight = False
+        self.opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        breakerState.set(0, service=name)
+
+    def _setState(self, state):
+        if state != self.state:
+            print(f"Circuit breaker {self.name} {self.state} -> {state}")
+        self.state = state
+        breakerState.set(self._stateValues[state], service=self.name)
+
+    def allow(self):
+        """Raises CircuitOpenError when the call should not be made"""
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.openedAt >= self.cooldown:
+                    self._setState(HALF_OPEN)
+                    self.trialInFlight = False
+
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and not self.trialInFlight:
+                self.trialInFlight = True
+                return
+
+            self.rejected += 1
+            breakerRejected.inc(service=self.name)
+            retryIn = max(0.0, self.cooldown - (time.monotonic() - self.openedAt))
+        raise CircuitOpenError(
+            f"{self.name} circuit breaker is open, retry in {retryIn:.0f}s"
+        )
+
+    def recordSuccess(self):
+        with self._lock:
+            self.failures = 0
+            self.trialInFlight = False
+            self._setState(CLOSED)
+
+    def recordFailure(self):
+        with self._lock:
+            self.failures += 1
+            self.trialInFlight = False
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                if self.state != OPEN:
+                    self.opened += 1
+                self.openedAt = time.monotonic()
+                self._setState(OPEN)
+
+    def release(self):
+        """A call that neither succeeded nor failed upstream, e.g. a bad request"""
+        with self._lock:
+            self.trialInFlight = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "times_opened": self.opened,
+                "rejected_calls": self.rejected,
+            }
+
+
+geminiBreaker = CircuitBreaker("gemini")
+
+# Attempts run on these threads so the caller can stop waiting at the deadline, a
+# hung attempt keeps its thread but no longer holds a server worker
+_callExecutor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("GEMINI_CALL_WORKERS", "16")),
+    thread_name_prefix="gemini-call",
+)
+
+
+def _retryOrRaise(error, attempt, maxAttempts, breaker):
+    """Records a failed attempt, returns how long to wait before the next one or re-raises"""
+    if not isRetryable(error):
+        breaker.release()
+        raise error
+
+    if isinstance(error, CallTimeoutError):
+        callTimeouts.inc(service=breaker.name)
+    if isinstance(error, APIError) and error.code == 429:
+        rateLimited.inc(service=breaker.name)
+
+    if attempt == maxAttempts - 1:
+        breaker.recordFailure()
+        raise error
+
+    delay = backoffDelay(attempt, GEMINI_BACKOFF_BASE, GEMINI_BACKOFF_CAP)
+    print(f"Gemini call failed ({error}), retrying in {delay:.1f}s")
+    retries.inc(service=breaker.name, reason=type(error).__name__)
+    return delay
+
+
+def callGemini(
+    fn,
+    *args,
+    timeout=GEMINI_CALL_TIMEOUT,
+    maxAttempts=GEMINI_MAX_ATTEMPTS,
+    breaker=geminiBreaker,
+    **kwargs,
+):
+    """
+    Calls fn(*args, **kwargs) with a deadline per attempt and retries, the whole
+    call counts as one success or failure for the breaker
+    """
+    breaker.allow()
+    for attempt in range(maxAttempts):
+        future = _callExecutor.submit(carryContext(fn), *args, **kwargs)
+        try:
+            result = future.result(timeout=timeout)
+        except FuturesTimeout:
+            # only stops an attempt still queued behind hung ones
+            future.cancel()
+            error = CallTimeoutError(f"Gemini call exceeded {timeout}s")
+        except Exception as e:
+            error = e
+        else:
+            breaker.recordSuccess()
+            return result
+
+        time.sleep(_retryOrRaise(error, attempt, maxAttempts, breaker))
+
+
+async def callGeminiAsync(
+    fn,
+    *args,
+    timeout=GEMINI_CALL_TIMEOUT,
+    maxAttempts=GEMINI_MAX_ATTEMPTS,
+    breaker=geminiBreaker,
+    **kwargs,
+):
+    """Async form of callGemini, fn returns an awaitable"""
+    breaker.allow()
+    for attempt in range(maxAttempts):
+        try:
+            result = await asyncio.wait_for(fn(*args, **kwargs), timeout)
+        except asyncio.TimeoutError:
+            error = CallTimeoutError(f"Gemini call exceeded {timeout}s")
+        except Exception as e:
+            error = e
+        else:
+            breaker.recordSuccess()
+            return result
+
+        await asyncio.sleep(_retryOrRaise(error, attempt, maxAttempts, breaker))
+
+
+async def streamGemini(
+    fn,
+    *args,
+    timeout=GEMINI_CALL_TIMEOUT,
+    breaker=geminiBreaker,
+    **kwargs,
+):
+    """
+    Yields the chunks of a streaming call. Opening the stream is retried like any
+    other call, once chunks have been handed on a failure can't be retried, so
+    it is raised, and a stream that goes quiet for `timeout` seconds is abandoned.
+    """
+    stream = await callGeminiAsync(
+        fn, *args, timeout=timeout, breaker=breaker, **kwargs
+    )
+    iterator = stream.__aiter__()
+    while True:
+        try:
+            chunk = await asyncio.wait_for(iterator.__anext__(), timeout)
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            callTimeouts.inc(service=breaker.name)
+            breaker.recordFailure()
+            raise CallTimeoutError(f"Gemini stream was silent for {timeout}s")
+        except Exception as e:
+            if isRetryable(e):
+                breaker.recordFailure()
+            raise
+        yield chunk
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+def makeCacheKey(model, promptVersion, payload):
+    """
+    Hashes everything that decides what gemini returns, the payload is normalised
+    so key order or whitespace in the input does not change the key
+    """
+    normalised = json.dumps(
+        {"model": model, "promptVersion": promptVersion, "payload": payload},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(normalised.encode("utf-8")).hexdigest()
+
+
+class GeminiResponseCache:
+    """
+    Two tier cache of gemini responses, a small in-memory LRU in front of one json
+    file per entry on disk so results survive a restart. Entries expire after ttl seconds.
+    """
+
+    def __init__(
+        self, cacheDir="gemini_cache", maxEntries=128, ttlSeconds=24 * 60 * 60
+    ):
+        self.cacheDir = cacheDir
+        self.maxEntries = maxEntries
+        self.ttlSeconds = ttlSeconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.cacheDir, f"{key}.json")
+
+    def _expired(self, storedAt):
+        return time.time() - storedAt > self.ttlSeconds
+
+    def get(self, key):
+        """Returns the cached value or None on a miss"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                storedAt, value = entry
+                if not self._expired(storedAt):
+                    self._memory.move_to_end(key)
+                    return value
+                del self._memory[key]
+
+        try:
+            with open(self._path(key), "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        if self._expired(entry["stored_at"]):
+            self._remove(key)
+            return None
+
+        self._remember(key, entry["stored_at"], entry["value"])
+        return entry["value"]
+
+    def set(self, key, value):
+        storedAt = time.time()
+        self._remember(key, storedAt, value)
+
+        # each writer gets its own temp file, concurrent sets of one key never share it
+        os.makedirs(self.cacheDir, exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(dir=self.cacheDir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"stored_at": storedAt, "value": value}, f)
+            os.replace(tmpPath, self._path(key))
+        except Exception:
+            os.remove(tmpPath)
+            raise
+
+    def _remember(self, key, storedAt, value):
+        with self._lock:
+            self._memory[key] = (storedAt, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.maxEntries:
+                self._memory.popitem(last=False)
+
+    def _remove(self, key):
+        with self._lock:
+            self._memory.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def invalidate(self):
+        """
+        Drops every entry, for benchmarks that time cold generations. New activities
+        don't need it, they change the data hash in the key so old entries just miss.
+        """
+        with self._lock:
+            self._memory.clear()
+
+        if not os.path.isdir(self.cacheDir):
+            return
+        for fileName in os.listdir(self.cacheDir):
+            if fileName.endswith(".json"):
+                os.remove(os.path.join(self.cacheDir, fileName))
+
+
+geminiCache = GeminiResponseCache(
+    ttlSeconds=int(os.getenv("GEMINI_CACHE_TTL", str(24 * 60 * 60)))
+)
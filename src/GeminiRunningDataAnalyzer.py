@@ -1,84 +1,109 @@
-import json
+import os
+import time
 import typing as t
+from concurrent.futures import ThreadPoolExecutor
 from google import genai
-from datetime import datetime
+from google.genai import types
+from datetime import datetime, timedelta
 from pydantic import BaseModel
+from GeminiCalls import GEMINI_CALL_TIMEOUT, callGemini, streamGemini
+from GeminiResponseCache import makeCacheKey
+from IncrementalJson import IncrementalJsonParser
+from PlanModels import TrainingPlan, Week, Workout
+from PromptEncoder import encodeRunningData
+from Telemetry import carryContext, recordGeminiUsage, span, stageDuration
 
+GEMINI_MODEL = "gemini-2.5-flash"
+# Bump these whenever a prompt changes so cached responses from the old prompt are not reused
+ANALYSIS_PROMPT_VERSION = 4
+PLAN_PROMPT_VERSION = 2
 
-def readRunningData(filePath: str = "users_running_data.json") -> t.Dict[str, t.Any]:
-    """
-    Reads running data from a json file and returns structured data for analysis
+# Weeks in a generated plan, and whether each week is generated by its own concurrent
+# call from a short outline rather than the whole plan in one long structured call,
+# the streamed plan is always a single call
+PLAN_WEEKS = int(os.getenv("GEMINI_PLAN_WEEKS", "5"))
+PLAN_FAN_OUT = os.getenv("GEMINI_PLAN_FAN_OUT", "1") == "1"
 
-    Args:
-        file_path: Path to the json file containing the data
 
-    Returns:
-        A dictionary containing the running data and basic stats
-    """
+def buildAnalysisPrompt(runningData):
+    encodedData, promptStats = encodeRunningData(runningData)
+    print(
+        f"Analysis prompt data ~{promptStats['tokensBefore']} tokens as json, "
+        f"~{promptStats['tokensAfter']} tokens encoded"
+    )
 
-    try:
-        with open(filePath, "r") as f:
-            activities = json.load(f)
+    return f"""
+        Analyse the following data, which represents the users last 10 runs,
+        provide a breif overview outlining percieved effort, any performance trends
+        and any concerning health patterns. Focus on metrics such as average pace
+        heart rate, distance and run descriptions to infer effor levels and identify trends.
+        The data is given as compact tables, each table starts with a line naming its columns.
+        Weekly volume covers a longer period than the individual runs, use it for training load.
+        Trends, cardiac drift, aerobic decoupling and grade adjusted pace are already worked out.
+        The data is as follows:
+        {encodedData}
+    """
 
-        if not activities:
-            return {"error": "No running activities found in the file"}
 
-        return {"activities": activities}
+def analysisCacheKey(runningData):
+    return makeCacheKey(GEMINI_MODEL, ANALYSIS_PROMPT_VERSION, runningData)
 
-    except FileNotFoundError:
-        return {"error": f"File {filePath} not Found"}
-    except json.JSONDecodeError:
-        return {"error": "Invalid JSON format in the file"}
-    except Exception as e:
-        return {"error": f"Error reading data: {str(e)}"}
 
+def runningAnalysis(client, runningData, cache=None):
+    if cache is not None:
+        cacheKey = analysisCacheKey(runningData)
+        cachedAnalysis = cache.get(cacheKey)
+        if cachedAnalysis is not None:
+            print("Using cached analysis")
+            return cachedAnalysis
 
-def runningAnalysis(client, runningData):
-    promptAnalysis = f"""
-        Analyse the following JSON data, which represents the users last 10 runs,
-        provide a breif overview outlining percieved effort, any performance trends
-        and any concerning health patterns. Focus on metrics such as average pace
-        heart rate, distance and run descriptions to infer effor levels and identify trends
-        the data is as follows: {json.dumps(runningData)}
-    """
+    promptAnalysis = buildAnalysisPrompt(runningData)
 
     print("Analysing...")
 
-    response = client.models.generate_content(
-        model="gemini-2.5-flash", contents=promptAnalysis
-    )
+    with span("gemini.generate", kind="analysis"):
+        response = callGemini(
+            client.models.generate_content,
+            model=GEMINI_MODEL,
+            contents=promptAnalysis,
+        )
+        recordGeminiUsage("analysis", response)
 
     analysisResult = response.text
 
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        print(f"Analysis prompt used {usage.prompt_token_count} tokens")
+
     print("Analysis of Runs:")
     print(analysisResult)
 
+    if cache is not None and analysisResult:
+        cache.set(cacheKey, analysisResult)
+
     return analysisResult
 
 
-class Workout(BaseModel):
-    day: str
-    date: str
-    type: str
-    description: str
-    distance_km: t.Optional[float] = None
-    target_pace_min_km: t.Optional[str] = None
-    duration_minutes: t.Optional[int] = None
+class WeekOutline(BaseModel):
+    week_number: int
+    focus: str
+    target_km: float
+    long_run_km: float
+    key_sessions: t.List[str]
 
 
-class Week(BaseModel):
-    week_number: int
-    workouts: t.List[Workout]
+class PlanOutline(BaseModel):
+    weeks: t.List[WeekOutline]
 
 
-class TrainingPlan(BaseModel):
-    weeks: t.List[Week]
+def planStartDate(now):
+    """The monday following now, every plan starts on it"""
+    return (now + timedelta(days=7 - now.weekday())).date()
 
 
-def runningPlan(client, runningAnalysis):
-    now = datetime.now()
-    promptPlan = f"""
-    Based on the following analysis of the user's recent running performance, create a 5 week running plan 
+def buildPlanPrompt(runningAnalysis, now, weeks=PLAN_WEEKS):
+    return f"""
+    Based on the following analysis of the user's recent running performance, create a {weeks} week running plan 
     training 4 days a week training and the others rest or light recovery, starting next week to help them 
     get quicker the plan should be structured to improve speed and endurace, incorporating different run 
     types such as: interval training, tempo runs, easy runs and long runs. While prioritising aduquete 
@@ -90,28 +115,239 @@ def runningPlan(client, runningAnalysis):
     {runningAnalysis}
     """
 
-    responsePlan = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=promptPlan,
-        config={
-            "response_mime_type": "application/json",
-            "response_schema": TrainingPlan,
-        },
+
+def buildOutlinePrompt(runningAnalysis, now, weeks=PLAN_WEEKS):
+    return f"""
+    Based on the following analysis of the user's recent running performance, outline a {weeks} week
+    running plan starting on {planStartDate(now)} to help them get quicker, improving speed and endurance
+    with 4 training days a week. For each week give only its focus, the target total distance in kilometers,
+    the long run distance in kilometers and the names of its key sessions (e.g. intervals, tempo run).
+    Build volume gradually and include a lighter recovery week where it makes sense. The analysis is as follows:
+    {runningAnalysis}
+    """
+
+
+def buildWeekPrompt(runningAnalysis, outline, weekNumber, weekStart):
+    weekOutline = outline.weeks[weekNumber - 1]
+    overview = "; ".join(
+        f"week {week.week_number}: {week.focus}, {week.target_km}km"
+        for week in outline.weeks
+    )
+    return f"""
+    Create week {weekNumber} of a running plan, the week starting monday {weekStart}. Give one workout for each
+    of the 7 days from {weekStart} to {weekStart + timedelta(days=6)} with its day name and YYYY-MM-DD date,
+    training 4 days and the others rest or light recovery. This week's focus is {weekOutline.focus} with
+    about {weekOutline.target_km}km in total, a long run of {weekOutline.long_run_km}km and these key
+    sessions: {", ".join(weekOutline.key_sessions)}. Pace should be a target time in minutes per kilometer,
+    distances in kilometers and give a rough duration in minutes for each activity so it can be added to a
+    calendar. The whole plan is: {overview}. The analysis of the runner is as follows:
+    {runningAnalysis}
+    """
+
+
+def planCacheKey(runningAnalysis, now, weeks=PLAN_WEEKS):
+    # the plan depends on the analysis, the week it starts from and its length
+    return makeCacheKey(
+        GEMINI_MODEL,
+        PLAN_PROMPT_VERSION,
+        {"analysis": runningAnalysis, "date": now.date().isoformat(), "weeks": weeks},
     )
 
-    trainingPlanJsonStr = responsePlan.text
-    trainingPlanDict = json.loads(trainingPlanJsonStr)
-    print("\n\n5-Week Training Plan:")
-    print(json.dumps(trainingPlanDict, indent=2))
 
-    filePath = "5_week_plan.json"
+PLAN_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": TrainingPlan,
+}
 
-    with open(filePath, "w") as f:
-        json.dump(trainingPlanDict, f, indent=2)
+OUTLINE_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": PlanOutline,
+}
+
+WEEK_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": Week,
+}
+
+
+def generatePlanSingleCall(client, runningAnalysis, now, weeks=PLAN_WEEKS):
+    """The whole plan in one structured call"""
+    with span("gemini.generate", kind="plan"):
+        responsePlan = callGemini(
+            client.models.generate_content,
+            model=GEMINI_MODEL,
+            contents=buildPlanPrompt(runningAnalysis, now, weeks),
+            config=PLAN_CONFIG,
+        )
+        recordGeminiUsage("plan", responsePlan)
+
+    return TrainingPlan.model_validate_json(responsePlan.text)
+
+
+def generatePlanFanOut(client, runningAnalysis, now, weeks=PLAN_WEEKS):
+    """
+    Asks for a short outline of the plan, then generates every week from it at the
+    same time with its own schema constrained call. The weeks are stitched back
+    together in order and validated as one TrainingPlan, so the wait is about one
+    outline plus one week rather than the whole plan.
+    """
+    with span("gemini.generate", kind="plan_outline"):
+        response = callGemini(
+            client.models.generate_content,
+            model=GEMINI_MODEL,
+            contents=buildOutlinePrompt(runningAnalysis, now, weeks),
+            config=OUTLINE_CONFIG,
+        )
+        recordGeminiUsage("plan_outline", response)
 
-    return json.dumps(trainingPlanDict, indent=2)
+    outline = PlanOutline.model_validate_json(response.text)
+    if len(outline.weeks) != weeks:
+        raise ValueError(
+            f"Plan outline has {len(outline.weeks)} weeks, expected {weeks}"
+        )
+    outline.weeks.sort(key=lambda week: week.week_number)
+
+    start = planStartDate(now)
+
+    def generateWeek(weekNumber):
+        weekStart = start + timedelta(weeks=weekNumber - 1)
+        with span("gemini.generate", kind="plan_week", week=weekNumber):
+            weekResponse = callGemini(
+                client.models.generate_content,
+                model=GEMINI_MODEL,
+                contents=buildWeekPrompt(
+                    runningAnalysis, outline, weekNumber, weekStart
+                ),
+                config=WEEK_CONFIG,
+            )
+            recordGeminiUsage("plan_week", weekResponse)
+
+        week = Week.model_validate_json(weekResponse.text)
+        # the position in the plan is ours to decide, not the model's
+        week.week_number = weekNumber
+        week.workouts.sort(key=lambda workout: workout.date)
+        return week
+
+    with ThreadPoolExecutor(max_workers=weeks) as executor:
+        planWeeks = list(executor.map(carryContext(generateWeek), range(1, weeks + 1)))
+
+    return TrainingPlan(weeks=planWeeks)
+
+
+def runningPlan(
+    client, runningAnalysis, cache=None, weeks=PLAN_WEEKS, fanOut=PLAN_FAN_OUT
+):
+    """Returns the validated TrainingPlan, it is up to the caller to store it"""
+    now = datetime.now()
+
+    cacheKey = planCacheKey(runningAnalysis, now, weeks)
+    cached = cache.get(cacheKey) if cache is not None else None
+    if cached is not None:
+        print("Using cached training plan")
+        return TrainingPlan.model_validate(cached)
+
+    generate = generatePlanFanOut if fanOut else generatePlanSingleCall
+    trainingPlan = generate(client, runningAnalysis, now, weeks)
+    workouts = sum(len(week.workouts) for week in trainingPlan.weeks)
+    print(f"\n\nGenerated {weeks}-Week Training Plan with {workouts} workouts")
+
+    if cache is not None:
+        cache.set(cacheKey, trainingPlan.model_dump(mode="json"))
+
+    return trainingPlan
+
+
+async def streamRunningAnalysis(client, runningData, cache=None):
+    """
+    Yields the analysis text chunk by chunk as gemini generates it, a cached
+    analysis is yielded as a single chunk
+    """
+    cacheKey = analysisCacheKey(runningData)
+    if cache is not None:
+        cachedAnalysis = cache.get(cacheKey)
+        if cachedAnalysis is not None:
+            yield cachedAnalysis
+            return
+
+    chunks = []
+    chunk = None
+    started = time.perf_counter()
+    stream = streamGemini(
+        client.aio.models.generate_content_stream,
+        model=GEMINI_MODEL,
+        contents=buildAnalysisPrompt(runningData),
+    )
+    async for chunk in stream:
+        if chunk.text:
+            chunks.append(chunk.text)
+            yield chunk.text
+
+    # a span can't be held open across yields, the whole stream is timed instead
+    stageDuration.observe(time.perf_counter() - started, stage="gemini.stream")
+    recordGeminiUsage("analysis", chunk)
+
+    if cache is not None and chunks:
+        cache.set(cacheKey, "".join(chunks))
+
+
+async def streamRunningPlan(client, runningAnalysis, cache=None):
+    """
+    Yields each Week of the plan as soon as it has been fully generated, rather than
+    waiting on the whole plan. Workouts are validated as they close so a bad one
+    fails the stream early. Once complete the plan is cached the same way as
+    runningPlan, the caller stitches and stores the weeks.
+
+    This is always one structured call whatever GEMINI_PLAN_FAN_OUT says. Parsing as
+    it streams needs the plan as one ordered json text, while fan out weeks arrive as
+    separate whole responses. Both share planCacheKey so either fills the cache.
+    """
+    now = datetime.now()
+    cacheKey = planCacheKey(runningAnalysis, now)
+    if cache is not None:
+        cached = cache.get(cacheKey)
+        if cached is not None:
+            for week in TrainingPlan.model_validate(cached).weeks:
+                yield week
+            return
+
+    parser = IncrementalJsonParser([("weeks", "*", "workouts", "*"), ("weeks", "*")])
+    weeks = []
+    chunk = None
+    started = time.perf_counter()
+    stream = streamGemini(
+        client.aio.models.generate_content_stream,
+        model=GEMINI_MODEL,
+        contents=buildPlanPrompt(runningAnalysis, now),
+        config=PLAN_CONFIG,
+    )
+    async for chunk in stream:
+        if not chunk.text:
+            continue
+        for path, text in parser.feed(chunk.text):
+            if len(path) == 4:
+                Workout.model_validate_json(text)
+                continue
+            week = Week.model_validate_json(text)
+            if not weeks:
+                stageDuration.observe(
+                    time.perf_counter() - started, stage="gemini.stream.first_week"
+                )
+            weeks.append(week)
+            yield week
+
+    stageDuration.observe(time.perf_counter() - started, stage="gemini.stream")
+    recordGeminiUsage("plan", chunk)
+
+    if not parser.complete:
+        raise ValueError("Plan stream ended before the plan json was complete")
+
+    if cache is not None:
+        cache.set(cacheKey, TrainingPlan(weeks=weeks).model_dump(mode="json"))
 
 
 def getGenAiClient():
-    client = genai.Client()
+    # the transport timeout is a backstop behind the per call deadlines in GeminiCalls
+    client = genai.Client(
+        http_options=types.HttpOptions(timeout=int(GEMINI_CALL_TIMEOUT * 1000))
+    )
     return client
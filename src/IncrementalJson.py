@@ -0,0 +1,96 @@
+import json
+
+# Scans json text as it streams in and hands back the text of objects and arrays at
+# chosen paths the moment they close, so a long structured response can be validated
+# and used piece by piece before it ends.
+# Paths are tuples of object keys and array indices, "*" in a pattern matches any
+# index or key, e.g. ("weeks", "*") for every week of a plan.
+
+_OPENERS = {"}": "{", "]": "["}
+
+
+class _Container:
+    __slots__ = ("kind", "start", "key", "index", "expectKey")
+
+    def __init__(self, kind, start):
+        self.kind = kind
+        self.start = start
+        self.key = None
+        self.index = 0
+        self.expectKey = kind == "{"
+
+    def slot(self):
+        """Where the value currently being read sits inside this container"""
+        return self.key if self.kind == "{" else self.index
+
+
+class IncrementalJsonParser:
+    def __init__(self, patterns):
+        self.patterns = [tuple(pattern) for pattern in patterns]
+        self.text = ""
+        self._pos = 0
+        self._stack = []
+        self._inString = False
+        self._escaped = False
+        self._stringStart = 0
+        self.started = False
+
+    @property
+    def complete(self):
+        """True once the top level value has closed"""
+        return self.started and not self._stack
+
+    def _matches(self, path):
+        return any(
+            len(pattern) == len(path)
+            and all(part == "*" or part == step for part, step in zip(pattern, path))
+            for pattern in self.patterns
+        )
+
+    def feed(self, chunk):
+        """
+        Adds more text, returns (path, json text) for every watched value it closed.
+        A closing bracket with nothing open to close raises json.JSONDecodeError.
+        """
+        self.text += chunk
+        closed = []
+        text = self.text
+        for pos in range(self._pos, len(text)):
+            char = text[pos]
+
+            if self._inString:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._inString = False
+                    top = self._stack[-1] if self._stack else None
+                    if top is not None and top.kind == "{" and top.expectKey:
+                        top.key = json.loads(text[self._stringStart : pos + 1])
+                continue
+
+            if char == '"':
+                self._inString = True
+                self._stringStart = pos
+            elif char in "{[":
+                self._stack.append(_Container(char, pos))
+                self.started = True
+            elif char in "}]":
+                if not self._stack or self._stack[-1].kind != _OPENERS[char]:
+                    raise json.JSONDecodeError(f"Unexpected '{char}'", text, pos)
+                container = self._stack.pop()
+                path = tuple(parent.slot() for parent in self._stack)
+                if self._matches(path):
+                    closed.append((path, text[container.start : pos + 1]))
+            elif char == ":" and self._stack:
+                self._stack[-1].expectKey = False
+            elif char == "," and self._stack:
+                top = self._stack[-1]
+                if top.kind == "{":
+                    top.expectKey = True
+                else:
+                    top.index += 1
+
+        self._pos = len(text)
+        return closed
@@ -0,0 +1,200 @@
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from GatherData import formatPace
+from GeminiRunningDataAnalyzer import PLAN_WEEKS, planStartDate
+from PlanModels import TrainingPlan, Week, Workout
+from RunAnalytics import computeRunAnalytics
+
+# A rule based plan built straight from the athletes recent runs, no model call, so
+# there is always a plan to serve when gemini is slow or down. Paces come from the
+# best recent sustained effort, volume from the last few weeks of training.
+
+# day of the week (monday 0) each session falls on, the other days are rest
+WEEK_LAYOUT = {1: "Intervals", 2: "Easy Run", 4: "Tempo Run", 6: "Long Run"}
+
+# share of the weeks distance each session takes
+SESSION_SHARE = {"Intervals": 0.2, "Easy Run": 0.2, "Tempo Run": 0.25, "Long Run": 0.35}
+
+# pace of each session as a multiple of threshold pace, slowest end first
+PACE_RANGES = {
+    "Intervals": (0.94, 0.90),
+    "Easy Run": (1.30, 1.20),
+    "Tempo Run": (1.02, 0.98),
+    "Long Run": (1.30, 1.22),
+}
+
+MIN_WEEKLY_KM = 15.0
+VOLUME_WEEKS = 4  # finished weeks averaged for the current weekly volume
+WEEKLY_BUILD = 1.08  # weekly increase while building, kept under the usual 10% rule
+RECOVERY_WEEK_SCALE = 0.8  # every fourth week drops back to let the build settle
+WARM_UP_KM = 1.0
+REP_KM = 0.8
+RECOVERY_JOG_KM = 0.4
+
+
+def _roundHalf(km):
+    return round(km * 2) / 2
+
+
+def _minimumKm(runType):
+    """Shortest session that still fits its warm-up, work and cool-down"""
+    if runType == "Intervals":
+        return 2 * WARM_UP_KM + 3 * (REP_KM + RECOVERY_JOG_KM)
+    if runType == "Tempo Run":
+        return 2 * WARM_UP_KM + 2.0
+    return 3.0
+
+
+def _averagePace(thresholdPace, runType):
+    slow, fast = PACE_RANGES[runType]
+    return thresholdPace * (slow + fast) / 2
+
+
+def _durationMinutes(distanceKm, thresholdPace, runType):
+    """Warm-up and cool-down are run at easy pace, the rest at the sessions pace"""
+    easyKm = 2 * WARM_UP_KM if runType in ("Intervals", "Tempo Run") else 0.0
+    seconds = easyKm * _averagePace(thresholdPace, "Easy Run") + (
+        distanceKm - easyKm
+    ) * _averagePace(thresholdPace, runType)
+    return round(seconds / 60)
+
+
+def _paceRange(thresholdPace, runType):
+    slow, fast = PACE_RANGES[runType]
+    return f"{formatPace(thresholdPace * fast)}-{formatPace(thresholdPace * slow)}"
+
+
+def completedWeeklyKm(volume, today, weeks=VOLUME_WEEKS):
+    """
+    Distance run in each of the last `weeks` finished weeks, oldest first. The volume
+    rollups leave out weeks without a run, those count as 0km, and the week today
+    falls in is still in progress so it is never one of them.
+    """
+    thisMonday = today - timedelta(days=today.weekday())
+    byWeek = {week["start"]: week["distanceKm"] for week in volume}
+    return [
+        byWeek.get((thisMonday - timedelta(weeks=n)).isoformat(), 0.0)
+        for n in range(weeks, 0, -1)
+    ]
+
+
+def athleteProfile(runningData, today=None):
+    """Threshold pace, heart rate cap and weekly volume worked out from recent runs"""
+    today = today or date.today()
+    activities = runningData.get("activities") or []
+    analytics = computeRunAnalytics(activities)
+    runs = [run for run in analytics["runs"] if run["paceSecondsPerKm"]]
+
+    # the quickest run of 5km or more is taken as close to threshold effort,
+    # shorter runs are only used when there is nothing longer
+    sustained = [run for run in runs if run["distanceKm"] >= 5] or runs
+    if sustained:
+        thresholdPace = min(run["paceSecondsPerKm"] for run in sustained) * 1.03
+    else:
+        thresholdPace = 360.0
+
+    maxHrs = [activity["maxHr"] for activity in activities if activity.get("maxHr")]
+    easyHrCap = round(max(maxHrs) * 0.78) if maxHrs else None
+
+    volume = runningData.get("volume")
+    if volume:
+        weeklyKm = float(np.mean(completedWeeklyKm(volume, today)))
+    else:
+        weeklyKm = analytics["trends"].get("weeklyKm")
+    longestKm = max((run["distanceKm"] for run in runs), default=0.0)
+
+    return {
+        "thresholdPace": thresholdPace,
+        "easyHrCap": easyHrCap,
+        "weeklyKm": max(weeklyKm or 0.0, MIN_WEEKLY_KM),
+        "longestKm": longestKm,
+    }
+
+
+def weeklyTargets(baseKm, weeks):
+    """Weekly distance for each week, building steadily with every fourth week easier"""
+    targets = []
+    buildKm = baseKm
+    for week in range(1, weeks + 1):
+        if week % 4 == 0:
+            targets.append(buildKm * RECOVERY_WEEK_SCALE)
+        else:
+            buildKm *= WEEKLY_BUILD
+            targets.append(buildKm)
+    return targets
+
+
+def _description(runType, distanceKm, profile, weekNumber):
+    hrNote = (
+        f" Keep your heart rate under {profile['easyHrCap']} bpm."
+        if profile["easyHrCap"]
+        else ""
+    )
+    if runType == "Intervals":
+        reps = max(3, int((distanceKm - 2 * WARM_UP_KM) / (REP_KM + RECOVERY_JOG_KM)))
+        return (
+            f"Warm-up ({WARM_UP_KM}km easy), {reps} x {int(REP_KM * 1000)}m at interval "
+            f"pace with {int(RECOVERY_JOG_KM * 1000)}m jogging recovery between reps, "
+            f"Cool-down ({WARM_UP_KM}km easy)."
+        )
+    if runType == "Tempo Run":
+        tempoKm = distanceKm - 2 * WARM_UP_KM
+        return (
+            f"Warm-up ({WARM_UP_KM}km easy), {tempoKm:g}km at a comfortably hard tempo "
+            f"pace, Cool-down ({WARM_UP_KM}km easy)."
+        )
+    if runType == "Long Run":
+        return f"Long easy run, steady throughout at a conversational pace.{hrNote}"
+    if weekNumber % 4 == 0:
+        return f"Easy recovery run, this is a lighter week.{hrNote}"
+    return f"Easy conversational pace for recovery and aerobic base.{hrNote}"
+
+
+def buildLocalPlan(runningData, weeks=PLAN_WEEKS, now=None):
+    """A complete TrainingPlan from the recent running data in a few milliseconds"""
+    now = now or datetime.now()
+    profile = athleteProfile(runningData, now.date())
+    start = planStartDate(now)
+    thresholdPace = profile["thresholdPace"]
+
+    planWeeks = []
+    for weekIndex, targetKm in enumerate(weeklyTargets(profile["weeklyKm"], weeks)):
+        weekNumber = weekIndex + 1
+        workouts = []
+        for dayIndex in range(7):
+            day = start + timedelta(weeks=weekIndex, days=dayIndex)
+            runType = WEEK_LAYOUT.get(dayIndex)
+            if runType is None:
+                workouts.append(
+                    Workout(
+                        day=day.strftime("%A"),
+                        date=day.isoformat(),
+                        type="Rest",
+                        description="Complete rest or light stretching.",
+                    )
+                )
+                continue
+
+            distanceKm = targetKm * SESSION_SHARE[runType]
+            if runType == "Long Run" and profile["longestKm"]:
+                # never more than a quarter longer than anything run recently
+                distanceKm = min(distanceKm, profile["longestKm"] * 1.25)
+            distanceKm = max(_roundHalf(distanceKm), _roundHalf(_minimumKm(runType)))
+            workouts.append(
+                Workout(
+                    day=day.strftime("%A"),
+                    date=day.isoformat(),
+                    type=runType,
+                    description=_description(runType, distanceKm, profile, weekNumber),
+                    distance_km=distanceKm,
+                    target_pace_min_km=_paceRange(thresholdPace, runType),
+                    duration_minutes=_durationMinutes(
+                        distanceKm, thresholdPace, runType
+                    ),
+                )
+            )
+        planWeeks.append(Week(week_number=weekNumber, workouts=workouts))
+
+    return TrainingPlan(weeks=planWeeks)
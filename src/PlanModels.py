@@ -0,0 +1,26 @@
+import typing as t
+
+from pydantic import BaseModel
+
+# The training plan as gemini is asked to return it. The same models are the response
+# schema, the in-memory plan, the api response body and the calendar export input, so
+# a plan is validated once when it arrives and never reparsed after that.
+
+
+class Workout(BaseModel):
+    day: str
+    date: str
+    type: str
+    description: str
+    distance_km: t.Optional[float] = None
+    target_pace_min_km: t.Optional[str] = None
+    duration_minutes: t.Optional[int] = None
+
+
+class Week(BaseModel):
+    week_number: int
+    workouts: t.List[Workout]
+
+
+class TrainingPlan(BaseModel):
+    weeks: t.List[Week]
@@ -0,0 +1,98 @@
+import itertools
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PlanModels import TrainingPlan
+from Telemetry import carryContext, span
+
+# The latest training plan for each user, held in memory as the validated model so
+# the api and the calendar export use it directly. Writing it to disk happens on a
+# background thread so it never holds up a request, the file is only read back when
+# a plan is asked for that is not in memory, e.g. after a restart.
+# Every plan stored gets a new version so a late write can check the plan it means
+# to replace is still the one there.
+
+
+class PlanStore:
+    def __init__(self, planDir="plans"):
+        self.planDir = planDir
+        self._plans = {}
+        self._versions = {}
+        self._nextVersion = itertools.count(1)
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._pending = {}
+
+    def _path(self, userId):
+        return os.path.join(
+            self.planDir, f"{userId if userId is not None else 'default'}.json"
+        )
+
+    def set(self, userId, plan, ifVersion=None):
+        """
+        Keeps the plan for the user, persisting it in the background, and returns its
+        version. With ifVersion it is only kept if that is still the stored version,
+        otherwise nothing changes and None is returned.
+        """
+        with self._lock:
+            if ifVersion is not None and self._versions.get(userId) != ifVersion:
+                return None
+            version = self._versions[userId] = next(self._nextVersion)
+            self._plans[userId] = plan
+            self._pending[userId] = self._writer.submit(
+                carryContext(self._persist), userId, plan
+            )
+        return version
+
+    def version(self, userId):
+        """Version of the user's stored plan, None if they have none"""
+        if self.get(userId) is None:
+            return None
+        with self._lock:
+            return self._versions.get(userId)
+
+    def get(self, userId):
+        """The user's plan, loaded from disk if it is not in memory, None if they have none"""
+        with self._lock:
+            plan = self._plans.get(userId)
+        if plan is not None:
+            return plan
+
+        try:
+            with open(self._path(userId), "rb") as f:
+                plan = TrainingPlan.model_validate_json(f.read())
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            if userId not in self._plans:
+                self._plans[userId] = plan
+                self._versions[userId] = next(self._nextVersion)
+            plan = self._plans[userId]
+        return plan
+
+    def _persist(self, userId, plan):
+        with self._lock:
+            # a newer plan was set while this one waited, only the latest is written
+            if self._plans.get(userId) is not plan:
+                return
+
+        with span("plan.persist"):
+            os.makedirs(self.planDir, exist_ok=True)
+            fd, tmpPath = tempfile.mkstemp(dir=self.planDir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(plan.model_dump_json(indent=2))
+            os.replace(tmpPath, self._path(userId))
+
+    def flush(self):
+        """Waits for pending writes, for shutdown and benchmarks"""
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future in pending:
+            future.result()
+
+
+planStore = PlanStore()
@@ -0,0 +1,155 @@
+import json
+import os
+
+from GatherData import formatPace, parseDistance, parseDuration
+from RunAnalytics import computeRunAnalytics
+
+# Rough token estimate for gemini, about 4 characters per token for english and numbers
+CHARS_PER_TOKEN = 4
+
+ANALYSIS_TOKEN_BUDGET = int(os.getenv("GEMINI_ANALYSIS_TOKEN_BUDGET", "2000"))
+
+# Tried in order until the encoded runs fit in the token budget
+DESCRIPTION_LIMITS = [200, 100, 40, 0]
+
+
+def estimateTokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def summariseRun(activity):
+    """Per run aggregates worked out once here rather than left for the model"""
+    splits = activity["splits"]
+    splitPaces = [
+        parseDuration(split["time"]) / (split["distance"] / 1000)
+        for split in splits
+        if split["distance"] > 0
+    ]
+    distanceKm = parseDistance(activity["distanceTotal"])
+    movingSeconds = parseDuration(activity["movingTime"])
+
+    return {
+        "distanceKm": distanceKm,
+        "pace": formatPace(movingSeconds / distanceKm) if distanceKm else "-",
+        "climb": round(
+            sum(s["elevationDiff"] for s in splits if s["elevationDiff"] > 0)
+        ),
+        "fastest": formatPace(min(splitPaces)) if splitPaces else "-",
+        "slowest": formatPace(max(splitPaces)) if splitPaces else "-",
+        "splitPaces": splitPaces,
+    }
+
+
+def encodeTrends(trends):
+    names = {
+        "weeklyKm": "weekly km",
+        "paceChangePerWeek": "pace change s/km per week",
+        "gradeAdjustedPaceChangePerWeek": "grade adjusted pace change s/km per week",
+        "hrChangePerWeek": "avg hr change per week",
+        "meanCardiacDriftPct": "mean cardiac drift %",
+        "meanDecouplingPct": "mean aerobic decoupling %",
+    }
+    values = [
+        f"{label} {trends[key]}"
+        for key, label in names.items()
+        if trends.get(key) is not None
+    ]
+    return "trends across runs: " + ", ".join(values)
+
+
+def encodeVolume(weeks):
+    """Weekly rollups from the volume index, far fewer tokens than the runs behind them"""
+    lines = ["weekly volume oldest first: week starting|runs|km|time|climb m|avgHr"]
+    for week in weeks:
+        avgHr = round(week["avgHr"]) if week["avgHr"] else "-"
+        lines.append(
+            f"{week['start']}|{week['runs']}|{week['distanceKm']}|{week['movingTime']}|"
+            f"{week['elevationGainM']}|{avgHr}"
+        )
+    return "\n".join(lines)
+
+
+def encodeRuns(activities, analytics, descriptionLimit, splitRuns):
+    """
+    One line per run, then the splits of the newest `splitRuns` runs as
+    pace-seconds/hr/elevation triples, then any descriptions
+    """
+    lines = [
+        "runs newest first: #|date|name|km|time|pace|grade adjusted pace|avgHr|maxHr"
+        "|climb m|fastest km|slowest km|cardiac drift %|aerobic decoupling %"
+    ]
+    splitLines = ["splits per run, each km as pace s/km,avg hr,elevation change m"]
+    descLines = ["descriptions"]
+    seenDescriptions = {}
+
+    for i, (activity, metrics) in enumerate(zip(activities, analytics["runs"]), 1):
+        summary = summariseRun(activity)
+        avgHr = round(activity["avgHr"]) if activity["avgHr"] else "-"
+        maxHr = round(activity["maxHr"]) if activity["maxHr"] else "-"
+        gap = metrics["gradeAdjustedPace"] or "-"
+        drift = metrics["cardiacDriftPct"]
+        decoupling = metrics["aerobicDecouplingPct"]
+        lines.append(
+            f"{i}|{activity['date']}|{activity['name']}|{summary['distanceKm']}|"
+            f"{activity['movingTime']}|{summary['pace']}|{gap}|{avgHr}|{maxHr}|"
+            f"{summary['climb']}|{summary['fastest']}|{summary['slowest']}|"
+            f"{'-' if drift is None else drift}|{'-' if decoupling is None else decoupling}"
+        )
+
+        if i <= splitRuns:
+            triples = [
+                f"{round(pace)},{split['avgHr']},{round(split['elevationDiff'])}"
+                for pace, split in zip(summary["splitPaces"], activity["splits"])
+            ]
+            splitLines.append(f"{i}: " + " ".join(triples))
+
+        description = (activity.get("description") or "").strip()
+        if descriptionLimit and description:
+            description = description[:descriptionLimit]
+            if description in seenDescriptions:
+                descLines.append(f"{i}: same as {seenDescriptions[description]}")
+            else:
+                seenDescriptions[description] = i
+                descLines.append(f"{i}: {description}")
+
+    sections = [[encodeTrends(analytics["trends"])], lines]
+    if len(splitLines) > 1:
+        sections.append(splitLines)
+    if len(descLines) > 1:
+        sections.append(descLines)
+
+    return "\n\n".join("\n".join(section) for section in sections)
+
+
+def encodeRunningData(runningData, tokenBudget=ANALYSIS_TOKEN_BUDGET):
+    """
+    Encodes the running data as compact tables instead of raw json. When the result
+    is over the token budget descriptions are cut down first, then split detail for
+    the oldest runs. Returns the encoded text and token counts before and after.
+    """
+    activities = runningData.get("activities", [])
+    analytics = computeRunAnalytics(activities)
+    tokensBefore = estimateTokens(json.dumps(runningData))
+
+    volume = encodeVolume(runningData["volume"]) if runningData.get("volume") else ""
+    runBudget = tokenBudget - estimateTokens(volume) if volume else tokenBudget
+
+    encoded = ""
+    for splitRuns in range(len(activities), -1, -1):
+        for descriptionLimit in DESCRIPTION_LIMITS:
+            encoded = encodeRuns(activities, analytics, descriptionLimit, splitRuns)
+            if estimateTokens(encoded) <= runBudget:
+                break
+        else:
+            continue
+        break
+
+    if volume:
+        encoded = volume + "\n\n" + encoded
+
+    stats = {
+        "tokensBefore": tokensBefore,
+        "tokensAfter": estimateTokens(encoded),
+        "tokenBudget": tokenBudget,
+    }
+    return encoded, stats
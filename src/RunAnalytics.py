@@ -0,0 +1,170 @@
+import numpy as np
+
+from GatherData import formatPace, parseDuration
+
+# Splits shorter than this (the leftover at the end of a run) are too noisy for pace metrics
+MIN_SPLIT_METRES = 200
+
+# Minetti et al. energy cost of running on a slope, J/kg/m, highest power first
+MINETTI_COEFFS = [155.4, -30.4, -43.3, 46.3, 19.5, 3.6]
+
+
+def loadSplitArrays(activities):
+    """
+    Flattens the splits of every activity into parallel arrays, runIndex maps each
+    split back to its activity so per run values can be reduced with bincount
+    """
+    runIndex, distance, seconds, hr, elevation = [], [], [], [], []
+    dates = []
+
+    for i, activity in enumerate(activities):
+        date = activity["date"]
+        dates.append(f"{date[6:10]}-{date[3:5]}-{date[0:2]}")
+        for split in activity["splits"]:
+            runIndex.append(i)
+            distance.append(split["distance"])
+            seconds.append(parseDuration(split["time"]))
+            hr.append(split["avgHr"])
+            elevation.append(split["elevationDiff"])
+
+    return {
+        "runIndex": np.asarray(runIndex, dtype=np.int64),
+        "distance": np.asarray(distance, dtype=np.float64),
+        "seconds": np.asarray(seconds, dtype=np.float64),
+        "hr": np.asarray(hr, dtype=np.float64),
+        "elevation": np.asarray(elevation, dtype=np.float64),
+        "dates": np.asarray(dates, dtype="datetime64[D]"),
+    }
+
+
+def gradeAdjustmentFactor(grade):
+    """How much harder a slope is than flat ground, divide pace by this for flat equivalent"""
+    grade = np.clip(grade, -0.45, 0.45)
+    return np.polyval(MINETTI_COEFFS, grade) / MINETTI_COEFFS[-1]
+
+
+def _perRun(runIndex, values, runCount):
+    return np.bincount(runIndex, weights=values, minlength=runCount)
+
+
+def _safeDivide(numerator, denominator):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = numerator / denominator
+    return np.where(denominator > 0, result, np.nan)
+
+
+def _slopePerWeek(days, values):
+    """Least squares slope of values against time, in units per week"""
+    mask = np.isfinite(values)
+    if mask.sum() < 2 or np.ptp(days[mask]) == 0:
+        return None
+    x = days[mask] - days[mask].mean()
+    y = values[mask] - values[mask].mean()
+    return round(float((x * y).sum() / (x * x).sum() * 7), 2)
+
+
+def _nanMean(values):
+    finite = values[np.isfinite(values)]
+    return finite.mean() if finite.size else np.nan
+
+
+def computeRunAnalytics(activities):
+    """
+    Works out pace, grade adjusted pace, pace variability, cardiac drift and aerobic
+    decoupling for every run in one pass over the split arrays, plus trends across runs
+    """
+    runCount = len(activities)
+    if runCount == 0:
+        return {"runs": [], "trends": {}}
+
+    arrays = loadSplitArrays(activities)
+    runIndex = arrays["runIndex"]
+    distance = arrays["distance"]
+    seconds = arrays["seconds"]
+    hr = arrays["hr"]
+
+    full = distance >= MIN_SPLIT_METRES
+    pace = _safeDivide(seconds, distance / 1000)
+    grade = _safeDivide(arrays["elevation"], distance)
+    gap = pace / gradeAdjustmentFactor(np.nan_to_num(grade))
+
+    # per run totals, heart rate is weighted by time spent in each split
+    runDistance = _perRun(runIndex, distance, runCount)
+    runSeconds = _perRun(runIndex, seconds, runCount)
+    runPace = _safeDivide(runSeconds, runDistance / 1000)
+    runHr = _safeDivide(_perRun(runIndex, hr * seconds, runCount), runSeconds)
+    flatSeconds = _perRun(runIndex, np.where(full, gap * distance / 1000, 0), runCount)
+    flatDistance = _perRun(runIndex, np.where(full, distance, 0), runCount)
+    runGap = _safeDivide(flatSeconds, flatDistance / 1000)
+
+    # pace variability as the coefficient of variation of full split paces
+    fullCount = _perRun(runIndex, full.astype(np.float64), runCount)
+    paceSum = _perRun(runIndex, np.where(full, pace, 0), runCount)
+    paceSqSum = _perRun(runIndex, np.where(full, pace**2, 0), runCount)
+    paceMean = _safeDivide(paceSum, fullCount)
+    paceVar = _safeDivide(paceSqSum, fullCount) - paceMean**2
+    paceCv = _safeDivide(np.sqrt(np.clip(paceVar, 0, None)), paceMean) * 100
+
+    # first and second half of each run by split position, the middle split is skipped
+    splitCount = np.bincount(runIndex, minlength=runCount)
+    starts = np.concatenate(([0], np.cumsum(splitCount)[:-1]))
+    position = np.arange(len(runIndex)) - starts[runIndex]
+    halfSize = (splitCount // 2)[runIndex]
+    firstHalf = position < halfSize
+    secondHalf = position >= splitCount[runIndex] - halfSize
+
+    def halfMeans(mask):
+        halfSeconds = _perRun(runIndex, np.where(mask, seconds, 0), runCount)
+        halfDistance = _perRun(runIndex, np.where(mask, distance, 0), runCount)
+        halfHr = _safeDivide(
+            _perRun(runIndex, np.where(mask, hr * seconds, 0), runCount), halfSeconds
+        )
+        halfSpeed = _safeDivide(halfDistance, halfSeconds)
+        return halfHr, halfSpeed
+
+    hr1, speed1 = halfMeans(firstHalf)
+    hr2, speed2 = halfMeans(secondHalf)
+    cardiacDrift = _safeDivide(hr2 - hr1, hr1) * 100
+    efficiency1 = _safeDivide(speed1, hr1)
+    efficiency2 = _safeDivide(speed2, hr2)
+    decoupling = _safeDivide(efficiency1 - efficiency2, efficiency1) * 100
+
+    days = arrays["dates"].astype(np.int64).astype(np.float64)
+    efficiency = _safeDivide(_safeDivide(runDistance, runSeconds), runHr)
+
+    def rounded(value, digits=1):
+        return None if not np.isfinite(value) else round(float(value), digits)
+
+    runs = []
+    for i, activity in enumerate(activities):
+        runs.append(
+            {
+                "id": activity["id"],
+                "date": activity["date"],
+                "distanceKm": round(float(runDistance[i]) / 1000, 2),
+                "paceSecondsPerKm": rounded(runPace[i]),
+                "pace": formatPace(runPace[i]) if np.isfinite(runPace[i]) else None,
+                "gradeAdjustedPace": (
+                    formatPace(runGap[i]) if np.isfinite(runGap[i]) else None
+                ),
+                "avgHr": rounded(runHr[i]),
+                "paceVariabilityPct": rounded(paceCv[i]),
+                "cardiacDriftPct": rounded(cardiacDrift[i]),
+                "aerobicDecouplingPct": rounded(decoupling[i]),
+            }
+        )
+
+    spanWeeks = max(float(np.ptp(days)) / 7, 1)
+    trends = {
+        "runs": runCount,
+        "totalKm": round(float(runDistance.sum()) / 1000, 1),
+        "weeklyKm": round(float(runDistance.sum()) / 1000 / spanWeeks, 1),
+        "paceChangePerWeek": _slopePerWeek(days, runPace),
+        "gradeAdjustedPaceChangePerWeek": _slopePerWeek(days, runGap),
+        "hrChangePerWeek": _slopePerWeek(days, runHr),
+        "efficiencyChangePerWeek": _slopePerWeek(days, efficiency * 1000),
+        "meanCardiacDriftPct": rounded(_nanMean(cardiacDrift)),
+        "meanDecouplingPct": rounded(_nanMean(decoupling)),
+    }
+
+    return {"runs": runs, "trends": trends}
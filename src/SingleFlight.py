@@ -0,0 +1,58 @@
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs a function at most once at a time per key. Callers arriving while a call
+    for their key is in flight wait for it and share its result or error instead
+    of starting their own.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.upstreamCalls = 0
+        self.coalescedCalls = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            isLeader = call is None
+            if isLeader:
+                call = self._calls[key] = _Call()
+                self.upstreamCalls += 1
+            else:
+                self.coalescedCalls += 1
+
+        if not isLeader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """How many calls ran upstream and how many were saved by sharing a result"""
+        with self._lock:
+            return {
+                "upstream_calls": self.upstreamCalls,
+                "coalesced_calls": self.coalescedCalls,
+                "in_flight": len(self._calls),
+            }
@@ -1,13 +1,33 @@
 import webbrowser
 import json
 import os
+import tempfile
+import threading
+import time
 from dotenv import load_dotenv
 from stravalib.client import Client
+from Backoff import backoffDelay
+from StravaRequestScheduler import makeStravaClient, setClientOwner
+from TokenStore import TokenStore
+from Telemetry import span
 
 load_dotenv()
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 CLIENT_ID = os.getenv("CLIENT_ID")
 
+# Tokens are refreshed this many seconds before they expire
+STRAVA_REFRESH_MARGIN = int(os.getenv("STRAVA_REFRESH_MARGIN", "300"))
+# After a failed refresh the next try waits at least base seconds, growing with jitter up to cap
+STRAVA_REFRESH_RETRY_BASE = float(os.getenv("STRAVA_REFRESH_RETRY_BASE", "5"))
+STRAVA_REFRESH_RETRY_CAP = float(os.getenv("STRAVA_REFRESH_RETRY_CAP", "600"))
+
+# Seconds before asking strava again who owns the legacy token file after a failed lookup
+LEGACY_OWNER_RETRY = int(os.getenv("LEGACY_OWNER_RETRY", "300"))
+
+stravaTokens = TokenStore("strava")
+_legacyLock = threading.Lock()
+_legacyRetryAt = {}
+
 
 def getInitialToken():
     # Handles initial auth flow to get access and refresh tokens, only run once
@@ -55,16 +75,18 @@ def getInitialToken():
 
 def get_code_for_tokens(auth_code):
     try:
-        client = Client()
+        client = makeStravaClient()
 
         token_response = client.exchange_code_for_token(
             client_id=CLIENT_ID, client_secret=CLIENT_SECRET, code=auth_code
         )
 
-        json_path = "token_response.json"
+        # tokens are stored per athlete so several athletes can use the server at once
+        client.access_token = token_response["access_token"]
+        token_response["athlete_id"] = client.get_athlete().id
+        setClientOwner(client, token_response["athlete_id"])
 
-        with open(json_path, "w") as f:
-            json.dump(token_response, f)
+        stravaTokens.save(token_response["athlete_id"], token_response)
 
         print("Tokens saved successfully ")
         return token_response
@@ -73,47 +95,254 @@ def get_code_for_tokens(auth_code):
         raise e
 
 
-def loadTokens():
-    # Loads tokens from the saved file
+def readLegacyTokens(json_path="token_response.json"):
+    """The token file saved by older single user versions, None when there isn't one"""
     try:
-        with open("token_response.json", "r") as f:
+        with open(json_path, "r") as f:
             return json.load(f)
-    except FileNotFoundError:
-        print("No token file found. Run get_initial_token() first.")
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def writeLegacyTokens(token_data, json_path="token_response.json"):
+    dirPath = os.path.dirname(os.path.abspath(json_path))
+    fd, tmpPath = tempfile.mkstemp(dir=dirPath, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(token_data, f)
+        os.replace(tmpPath, json_path)
+    except Exception:
+        os.remove(tmpPath)
+        raise
+
+
+def resolveLegacyOwner(token_data):
+    """The legacy tokens with their athlete added, refreshed first if they have expired"""
+    if token_data.get("expires_at", 0) - time.time() < STRAVA_REFRESH_MARGIN:
+        token_data = refreshStravaTokens(token_data)
+    client = makeStravaClient(token_data["access_token"], owner="legacy")
+    return {**token_data, "athlete_id": client.get_athlete().id}
+
+
+def legacyTokenOwner(json_path="token_response.json"):
+    """
+    The athlete the legacy token file belongs to, None when there is no file or it
+    can't be worked out. Older versions never saved the athlete id, so the first call
+    asks strava who the legacy tokens belong to and writes the answer into the file.
+    """
+    token_data = readLegacyTokens(json_path)
+    if token_data and token_data.get("athlete_id") is None:
+        with _legacyLock:
+            # another caller may have worked it out while this one waited
+            token_data = readLegacyTokens(json_path)
+            if (
+                token_data
+                and token_data.get("athlete_id") is None
+                and time.monotonic() >= _legacyRetryAt.get(json_path, 0)
+            ):
+                try:
+                    token_data = resolveLegacyOwner(token_data)
+                    writeLegacyTokens(token_data, json_path)
+                    print(f"Legacy tokens belong to athlete {token_data['athlete_id']}")
+                except Exception as e:
+                    print(f"Could not work out who the legacy tokens belong to: {e}")
+                    _legacyRetryAt[json_path] = time.monotonic() + LEGACY_OWNER_RETRY
+
+    athleteId = token_data.get("athlete_id") if token_data else None
+    return int(athleteId) if athleteId is not None else None
+
+
+def importLegacyTokens(athleteId, json_path="token_response.json"):
+    """
+    Moves the legacy tokens into the per athlete store, only for the athlete they
+    belong to, which is looked up on strava when the file doesn't say
+    """
+    if athleteId is None or legacyTokenOwner(json_path) != int(athleteId):
         return None
 
+    token_data = {**readLegacyTokens(json_path), "athlete_id": int(athleteId)}
+    stravaTokens.save(athleteId, token_data)
+    return token_data
 
-def getAuthenticatedUser():
-    # Will return an authenticated strava client
-    # will auto refresh access token if needed
 
-    # loading existing tokens
-    token_data = loadTokens()
+def loadTokens(athleteId):
+    # Loads an athletes tokens, every request says which athlete it is for
+    token_data = None
+    if athleteId is not None:
+        token_data = stravaTokens.get(athleteId) or importLegacyTokens(athleteId)
     if not token_data:
-        print("No Tokens found. Getting initial token...")
+        print("No tokens found. Authenticate with strava first.")
+    return token_data
 
-    client = Client()
-    client.access_token = token_data["access_token"]
 
-    # this code is used to refresh the access token once it has expired
-    # the .refresh_access_token will only return a fresh token if the current is expired
-    # or has less that an hour left on the duration
+class StravaAuthError(Exception):
+    """The athletes access token has expired and could not be refreshed"""
 
-    try:
-        refresh_response = client.refresh_access_token(
-            client_id=CLIENT_ID,
-            client_secret=CLIENT_SECRET,
-            refresh_token=token_data["refresh_token"],
-        )
 
-        if refresh_response != token_data:
-            with open("token_response.json", "w") as f:
-                json.dump(refresh_response, f)
-            client.access_token = refresh_response["access_token"]
-    except Exception as e:
-        print(f"Error refreshing token: {e}")
+def refreshStravaTokens(token_data):
+    client = makeStravaClient(owner=token_data.get("athlete_id", "default"))
+    refresh_response = client.refresh_access_token(
+        client_id=CLIENT_ID,
+        client_secret=CLIENT_SECRET,
+        refresh_token=token_data["refresh_token"],
+    )
+    return {**token_data, **refresh_response}
+
+
+class StravaTokenManager:
+    """
+    Hands out authenticated clients, reusing each athletes client and access token
+    until shortly before it expires. Tokens are refreshed in the background ahead of
+    expiry so requests normally never wait on a refresh. A failed refresh is retried
+    with a growing jittered delay, and no refresh is tried again before it is due.
+    """
+
+    def __init__(self, store, refreshMargin=STRAVA_REFRESH_MARGIN):
+        self.store = store
+        self.refreshMargin = refreshMargin
+        self._clients = {}
+        self._timers = {}
+        self._failures = {}
+        self._retryAt = {}
+        self._lock = threading.Lock()
+        self.refreshCount = 0
+        self.failedRefreshCount = 0
+        self.reuseCount = 0
+        self.refreshSeconds = 0.0
+
+    def _needsRefresh(self, token_data):
+        expiresAt = token_data.get("expires_at")
+        return expiresAt is None or expiresAt - time.time() < self.refreshMargin
+
+    def _refresh(self, owner, token_data):
+        started = time.perf_counter()
+        try:
+            with span("strava.token_refresh"):
+                refreshed = refreshStravaTokens(token_data)
+        except Exception:
+            with self._lock:
+                self.failedRefreshCount += 1
+                failures = self._failures[owner] = self._failures.get(owner, 0) + 1
+                self._retryAt[owner] = (
+                    time.monotonic()
+                    + STRAVA_REFRESH_RETRY_BASE
+                    + backoffDelay(
+                        failures, STRAVA_REFRESH_RETRY_BASE, STRAVA_REFRESH_RETRY_CAP
+                    )
+                )
+            raise
+        with self._lock:
+            self.refreshCount += 1
+            self.refreshSeconds += time.perf_counter() - started
+            self._failures.pop(owner, None)
+            self._retryAt.pop(owner, None)
+        return refreshed
+
+    def _retryWait(self, owner):
+        """Seconds until a refresh may be tried again after a failure, 0 when it may now"""
+        with self._lock:
+            retryAt = self._retryAt.get(owner)
+        return max(0.0, retryAt - time.monotonic()) if retryAt is not None else 0.0
+
+    def refresh(self, owner):
+        """Refreshes now, concurrent callers for the same athlete share one refresh"""
+        return self.store.refresh(
+            owner,
+            lambda tokens: self._refresh(owner, tokens),
+            isFresh=lambda tokens: not self._needsRefresh(tokens),
+        )
 
-    return client
+    def getClient(self, athleteId):
+        token_data = loadTokens(athleteId)
+        if not token_data:
+            return None
+
+        if self._needsRefresh(token_data):
+            if self._retryWait(athleteId) == 0:
+                try:
+                    token_data = self.refresh(athleteId)
+                except Exception as e:
+                    print(f"Error refreshing token: {e}")
+            # a token still inside the refresh margin is used until it really expires
+            if token_data.get("expires_at", 0) <= time.time():
+                raise StravaAuthError(
+                    f"Strava token for athlete {athleteId} expired and could not be refreshed"
+                )
+        else:
+            with self._lock:
+                self.reuseCount += 1
+
+        with self._lock:
+            cached = self._clients.get(athleteId)
+            if cached is not None and cached.access_token == token_data["access_token"]:
+                client = cached
+            else:
+                client = makeStravaClient(token_data["access_token"], owner=athleteId)
+                self._clients[athleteId] = client
+
+        self._scheduleRefresh(athleteId, token_data)
+        return client
+
+    def _scheduleRefresh(self, owner, token_data):
+        expiresAt = token_data.get("expires_at")
+        if expiresAt is None:
+            return
+
+        # never sooner than a failed refresh allows, so an outage is not retried in a loop
+        retryWait = self._retryWait(owner)
+        with self._lock:
+            current = self._timers.get(owner)
+            if current is not None and current.expiresAt == expiresAt:
+                return
+            if current is not None:
+                current.cancel()
+
+            delay = max(retryWait, expiresAt - self.refreshMargin - time.time())
+            timer = threading.Timer(delay, self._backgroundRefresh, args=(owner,))
+            timer.daemon = True
+            timer.expiresAt = expiresAt
+            self._timers[owner] = timer
+            timer.start()
+
+    def _backgroundRefresh(self, owner):
+        with self._lock:
+            self._timers.pop(owner, None)
+        try:
+            token_data = self.refresh(owner)
+            print(f"Refreshed strava token for athlete {owner} ahead of expiry")
+        except Exception as e:
+            print(
+                f"Background token refresh failed for athlete {owner}, "
+                f"retrying in {self._retryWait(owner):.0f}s: {e}"
+            )
+            token_data = loadTokens(owner)
+            if not token_data:
+                return
+        self._scheduleRefresh(owner, token_data)
+
+    def stats(self):
+        with self._lock:
+            averageRefresh = (
+                self.refreshSeconds / self.refreshCount if self.refreshCount else 0.0
+            )
+            return {
+                "refreshes": self.refreshCount,
+                "failed_refreshes": self.failedRefreshCount,
+                "reused_tokens": self.reuseCount,
+                "average_refresh_seconds": round(averageRefresh, 3),
+                # every reuse skipped a refresh round trip
+                "time_saved_seconds": round(self.reuseCount * averageRefresh, 3),
+                "cached_clients": len(self._clients),
+            }
+
+
+tokenManager = StravaTokenManager(stravaTokens)
+
+
+def getAuthenticatedUser(athleteId):
+    # Will return an authenticated strava client for the athlete, the access token
+    # and client are reused until the token is about to expire
+    return tokenManager.getClient(athleteId)
 
 
 def getAthleteinfo(client):
@@ -0,0 +1,171 @@
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from GatherData import iterRuns, processActivityData
+from Telemetry import carryContext, span
+
+# Activities fetched and appended to the store per step, only one batch is ever held in memory
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "50"))
+
+
+class BackfillCheckpoint:
+    """
+    Progress of an athletes history backfill, saved after every batch so an
+    interrupted or rate limited run carries on from the oldest run it wrote.
+    """
+
+    def __init__(self, athleteId, checkpointDir="backfill"):
+        self.path = os.path.join(checkpointDir, f"{athleteId}.json")
+        self.before = None  # start date of the oldest run written so far
+        self.done = 0
+        self.failed = []
+        self.complete = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+
+        self.before = (
+            datetime.fromisoformat(state["before"]) if state.get("before") else None
+        )
+        self.done = state.get("done", 0)
+        self.failed = state.get("failed", [])
+        self.complete = state.get("complete", False)
+
+    def save(self):
+        dirPath = os.path.dirname(self.path)
+        os.makedirs(dirPath, exist_ok=True)
+        state = {
+            "before": self.before.isoformat() if self.before else None,
+            "done": self.done,
+            "failed": self.failed,
+            "complete": self.complete,
+        }
+
+        fd, tmpPath = tempfile.mkstemp(dir=dirPath, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, self.path)
+
+    def reset(self):
+        self.before = None
+        self.done = 0
+        self.failed = []
+        self.complete = False
+        self.save()
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def backfillHistory(
+    client,
+    athleteId,
+    segments,
+    store=None,
+    volume=None,
+    checkpoint=None,
+    maxWorkers=4,
+    batchSize=BACKFILL_BATCH_SIZE,
+    pageSize=200,
+    onProgress=None,
+):
+    """
+    Ingests an athletes whole run history oldest page last, appending each batch to
+    the columnar store, recording it in the activity store's sync bookkeeping and
+    the volume index before moving the checkpoint past it. Runs
+    that failed on an earlier attempt are retried first. Returns a summary with the
+    throughput.
+    """
+    checkpoint = checkpoint or BackfillCheckpoint(athleteId)
+    onProgress = onProgress or (lambda **progress: None)
+    started = time.monotonic()
+    processed = 0
+    failed = []
+
+    def fetch(activityId):
+        return processActivityData(client, activityId)
+
+    def runBatch(executor, activityIds, startTimes=None):
+        nonlocal processed
+        results = list(executor.map(carryContext(fetch), activityIds))
+        activities = [activity for activity in results if activity]
+        failed.extend(
+            activityId
+            for activityId, activity in zip(activityIds, results)
+            if not activity
+        )
+        if activities:
+            segments.append(athleteId, activities)
+            if store is not None:
+                store.recordActivities(
+                    athleteId, [activity.id for activity in activities], startTimes
+                )
+            if volume is not None:
+                volume.recordActivities(athleteId, activities)
+        processed += len(activities)
+        checkpoint.done += len(activities)
+
+    with ThreadPoolExecutor(max_workers=max(1, maxWorkers)) as executor:
+        retry = checkpoint.failed
+        for start in range(0, len(retry), batchSize):
+            runBatch(executor, retry[start : start + batchSize])
+            checkpoint.failed = failed + retry[start + batchSize :]
+            checkpoint.save()
+
+        if not checkpoint.complete:
+            onProgress(stage="backfilling")
+            runs = iterRuns(client, before=checkpoint.before, pageSize=pageSize)
+            for batch in _batches(runs, batchSize):
+                with span("backfill.batch", activities=len(batch)):
+                    runBatch(
+                        executor,
+                        [run.id for run in batch],
+                        {run.id: run.start_date.timestamp() for run in batch},
+                    )
+
+                checkpoint.before = min(run.start_date for run in batch)
+                checkpoint.failed = list(failed)
+                checkpoint.save()
+
+                minutes = (time.monotonic() - started) / 60
+                print(
+                    f"Backfilled {checkpoint.done} activities, "
+                    f"{processed / minutes:.1f} per minute"
+                )
+                onProgress(done=processed)
+
+            checkpoint.complete = True
+
+    checkpoint.failed = failed
+    checkpoint.save()
+
+    elapsed = time.monotonic() - started
+    return {
+        "processed": processed,
+        "total_processed": checkpoint.done,
+        "failed": failed,
+        "complete": checkpoint.complete,
+        "elapsed_seconds": round(elapsed, 1),
+        "activities_per_minute": round(processed / (elapsed / 60), 1)
+        if elapsed
+        else 0.0,
+    }
@@ -0,0 +1,261 @@
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+from stravalib.client import Client
+from stravalib.protocol import ApiV3
+
+from Telemetry import rateLimited, routeLabel, span
+
+# Strava's default read quota, shared by every request the app makes
+SHORT_WINDOW_SECONDS = 15 * 60
+LONG_WINDOW_SECONDS = 24 * 60 * 60
+SHORT_READ_LIMIT = 100
+LONG_READ_LIMIT = 1000
+
+
+class TokenBucket:
+    """
+    Classic token bucket, tokens refill continuously at a fixed rate up to the
+    bucket capacity. Not thread safe on its own, callers hold a lock.
+    """
+
+    def __init__(self, capacity, refillPerSecond, clock=time.monotonic):
+        self.capacity = capacity
+        self.refillPerSecond = refillPerSecond
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.lastRefill = clock()
+
+    def _refill(self):
+        now = self.clock()
+        elapsed = now - self.lastRefill
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.refillPerSecond)
+        self.lastRefill = now
+
+    def waitTime(self, tokens=1):
+        """Seconds until `tokens` are available, 0 if they are available now"""
+        self._refill()
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.refillPerSecond
+
+    def consume(self, tokens=1):
+        self._refill()
+        self.tokens -= tokens
+
+
+def quotaBucket(limit, window, burst):
+    """
+    Builds a bucket that can never spend more than `limit` requests in any
+    `window` seconds: the burst plus everything refilled over the window adds up
+    to exactly the quota.
+    """
+    burst = min(burst, limit)
+    return TokenBucket(burst, (limit - burst) / window)
+
+
+def parseRateLimitHeaders(headers, method="GET"):
+    """
+    Reads strava's usage and limit headers, returning
+    (shortUsage, longUsage, shortLimit, longLimit) or None when they are missing.
+    Reads are checked against the read quota when strava sends it.
+    """
+    prefixes = ["X-RateLimit"]
+    if method == "GET":
+        prefixes.insert(0, "X-ReadRateLimit")
+
+    for prefix in prefixes:
+        usage = headers.get(f"{prefix}-Usage")
+        limit = headers.get(f"{prefix}-Limit")
+        if usage and limit:
+            try:
+                shortUsage, longUsage = (int(v) for v in usage.split(","))
+                shortLimit, longLimit = (int(v) for v in limit.split(","))
+            except ValueError:
+                continue
+            return shortUsage, longUsage, shortLimit, longLimit
+
+    return None
+
+
+class StravaRequestScheduler:
+    """
+    Single gate every strava request passes through. Requests are granted round
+    robin between owners (athletes or jobs) so one large sync can't starve the
+    others, paced by token buckets and held back before the quota reported in
+    strava's response headers runs out, rather than sleeping after a 429.
+    """
+
+    def __init__(
+        self,
+        shortLimit=SHORT_READ_LIMIT,
+        longLimit=LONG_READ_LIMIT,
+        shortBurst=20,
+        longBurst=100,
+        headroom=0.95,
+    ):
+        self.shortLimit = shortLimit
+        self.longLimit = longLimit
+        self.headroom = headroom
+        self.shortBurst = shortBurst
+        self.longBurst = longBurst
+        self.shortBucket = quotaBucket(shortLimit, SHORT_WINDOW_SECONDS, shortBurst)
+        self.longBucket = quotaBucket(longLimit, LONG_WINDOW_SECONDS, longBurst)
+
+        # usage as last reported by strava for the current windows
+        self.shortUsed = 0
+        self.longUsed = 0
+        self.inFlight = 0
+        self._shortWindow = self._windowId(SHORT_WINDOW_SECONDS)
+        self._longWindow = self._windowId(LONG_WINDOW_SECONDS)
+
+        self._waiting = {}
+        self._rotation = deque()
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _windowId(window):
+        # strava resets on the quarter hour and at midnight UTC
+        return int(time.time() // window)
+
+    @staticmethod
+    def _secondsUntilReset(window):
+        return window - (time.time() % window)
+
+    def _rollWindows(self):
+        shortWindow = self._windowId(SHORT_WINDOW_SECONDS)
+        if shortWindow != self._shortWindow:
+            self._shortWindow = shortWindow
+            self.shortUsed = 0
+
+        longWindow = self._windowId(LONG_WINDOW_SECONDS)
+        if longWindow != self._longWindow:
+            self._longWindow = longWindow
+            self.longUsed = 0
+
+    def _waitTime(self):
+        """Seconds before another request fits in the quota, 0 if one fits now"""
+        waits = [self.shortBucket.waitTime(), self.longBucket.waitTime()]
+
+        if self.shortUsed + self.inFlight >= self.shortLimit * self.headroom:
+            waits.append(self._secondsUntilReset(SHORT_WINDOW_SECONDS))
+        if self.longUsed + self.inFlight >= self.longLimit * self.headroom:
+            waits.append(self._secondsUntilReset(LONG_WINDOW_SECONDS))
+
+        return max(waits)
+
+    def acquire(self, owner="default"):
+        """Blocks until it is this owner's turn and the quota has room"""
+        with self._cond:
+            self._waiting[owner] = self._waiting.get(owner, 0) + 1
+            if owner not in self._rotation:
+                self._rotation.append(owner)
+
+            heldBack = False
+            while True:
+                self._rollWindows()
+                wait = self._waitTime()
+                if wait == 0 and self._rotation[0] == owner:
+                    break
+                if wait > 0 and not heldBack:
+                    heldBack = True
+                    rateLimited.inc(service="strava")
+                self._cond.wait(timeout=wait if wait > 0 else None)
+
+            self._rotation.popleft()
+            self._waiting[owner] -= 1
+            if self._waiting[owner]:
+                self._rotation.append(owner)
+            else:
+                del self._waiting[owner]
+
+            self.shortBucket.consume()
+            self.longBucket.consume()
+            self.inFlight += 1
+            self._cond.notify_all()
+
+    def release(self):
+        """Called once a granted request has finished, successful or not"""
+        with self._cond:
+            self.inFlight -= 1
+            self._cond.notify_all()
+
+    @staticmethod
+    def _resizedBucket(bucket, limit, window, burst):
+        """A bucket paced for the new limit that keeps the tokens already saved up"""
+        bucket._refill()
+        resized = quotaBucket(limit, window, burst)
+        resized.tokens = min(bucket.tokens, resized.capacity)
+        return resized
+
+    def __call__(self, responseHeaders, method="GET"):
+        """stravalib rate limiter hook, sees the headers of every response"""
+        rates = parseRateLimitHeaders(responseHeaders, method)
+        if rates is None:
+            return
+
+        shortUsage, longUsage, shortLimit, longLimit = rates
+        with self._cond:
+            self._rollWindows()
+            self.shortUsed = shortUsage
+            self.longUsed = longUsage
+            # apps with a raised or lowered quota are paced for the quota they have
+            if shortLimit != self.shortLimit:
+                self.shortLimit = shortLimit
+                self.shortBucket = self._resizedBucket(
+                    self.shortBucket, shortLimit, SHORT_WINDOW_SECONDS, self.shortBurst
+                )
+            if longLimit != self.longLimit:
+                self.longLimit = longLimit
+                self.longBucket = self._resizedBucket(
+                    self.longBucket, longLimit, LONG_WINDOW_SECONDS, self.longBurst
+                )
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "short_usage": self.shortUsed,
+                "short_limit": self.shortLimit,
+                "long_usage": self.longUsed,
+                "long_limit": self.longLimit,
+                "in_flight": self.inFlight,
+                "waiting": dict(self._waiting),
+            }
+
+
+class ScheduledApiV3(ApiV3):
+    """stravalib protocol that asks the scheduler before sending any request"""
+
+    def __init__(self, scheduler, owner="default", **kwargs):
+        super().__init__(rate_limiter=scheduler, **kwargs)
+        self.scheduler = scheduler
+        self.owner = owner
+
+    def _request(self, url, *args, **kwargs):
+        method = kwargs.get("method", args[4] if len(args) > 4 else "GET")
+        with span("strava.scheduler_wait"):
+            self.scheduler.acquire(self.owner)
+        try:
+            with span(f"strava {method} {routeLabel(urlparse(url).path)}"):
+                return super()._request(url, *args, **kwargs)
+        finally:
+            self.scheduler.release()
+
+
+# One scheduler for the whole process, every athlete and job shares the same quota
+stravaScheduler = StravaRequestScheduler()
+
+
+def makeStravaClient(accessToken=None, owner="default", scheduler=stravaScheduler):
+    """Returns a stravalib client whose requests all go through the scheduler"""
+    client = Client(access_token=accessToken, rate_limiter=scheduler)
+    client.protocol = ScheduledApiV3(scheduler, owner, access_token=accessToken)
+    return client
+
+
+def setClientOwner(client, owner):
+    """Requests made with this client are queued under `owner` from now on"""
+    client.protocol.owner = owner
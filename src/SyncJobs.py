@@ -0,0 +1,96 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETE = "complete"
+FAILED = "failed"
+
+
+class Job:
+    def __init__(self, key):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = QUEUED
+        self.stage = None
+        self.done = 0
+        self.total = 0
+        self.result = None
+        self.error = None
+        self.createdAt = time.time()
+        self.finishedAt = None
+
+    @property
+    def finished(self):
+        return self.status in (COMPLETE, FAILED)
+
+    def update(self, stage=None, done=None, total=None):
+        """Progress reporting hook handed to the work being run"""
+        if stage is not None:
+            self.stage = stage
+        if done is not None:
+            self.done = done
+        if total is not None:
+            self.total = total
+
+
+class JobManager:
+    """
+    Runs long pieces of work on a background thread pool and keeps their status
+    for polling. Submitting work for a key that already has a job running returns
+    that job instead of starting another.
+    """
+
+    def __init__(self, maxWorkers=2, keepFinished=100):
+        self.keepFinished = keepFinished
+        self._executor = ThreadPoolExecutor(max_workers=maxWorkers)
+        self._jobs = {}
+        self._activeByKey = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Queues fn(job, *args, **kwargs), returns the job tracking it"""
+        with self._lock:
+            active = self._activeByKey.get(key)
+            if active is not None and not active.finished:
+                return active
+
+            job = Job(key)
+            self._jobs[job.id] = job
+            self._activeByKey[key] = job
+            self._pruneFinished()
+
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, jobId):
+        with self._lock:
+            return self._jobs.get(jobId)
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = RUNNING
+        result, error, status = None, None, COMPLETE
+        try:
+            result = fn(job, *args, **kwargs)
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            error, status = str(e), FAILED
+        finally:
+            # a job only shows as finished once finishedAt is set, pruning sorts on it
+            with self._lock:
+                job.result = result
+                job.error = error
+                job.finishedAt = time.time()
+                job.status = status
+                if self._activeByKey.get(job.key) is job:
+                    del self._activeByKey[job.key]
+
+    def _pruneFinished(self):
+        finished = sorted(
+            (job for job in self._jobs.values() if job.finished),
+            key=lambda job: job.finishedAt,
+        )
+        for job in finished[: max(0, len(finished) - self.keepFinished)]:
+            del self._jobs[job.id]
@@ -0,0 +1,298 @@
+import contextvars
+import functools
+import inspect
+import itertools
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Spans, counters and latency histograms for the pipeline, rendered in the prometheus
+# text format on /metrics. Kept dependency free, a span is a timed block recorded in a
+# per stage histogram plus a ring buffer of recent spans so one slow request can be
+# followed stage by stage.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _formatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelNames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelNames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                labels = _formatLabels(zip(self.labelNames, key))
+                lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelNames)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelNames)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                labels = list(zip(self.labelNames, key))
+                for bound, count in zip(self.buckets, series):
+                    bucketLabels = _formatLabels(labels + [("le", bound)])
+                    lines.append(f"{self.name}_bucket{bucketLabels} {count}")
+                infLabels = _formatLabels(labels + [("le", "+Inf")])
+                lines.append(f"{self.name}_bucket{infLabels} {series[-1]}")
+                lines.append(f"{self.name}_sum{_formatLabels(labels)} {series[-2]}")
+                lines.append(f"{self.name}_count{_formatLabels(labels)} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, help, labelNames=()):
+        return self._register(Counter, name, help, labelNames)
+
+    def gauge(self, name, help, labelNames=()):
+        return self._register(Gauge, name, help, labelNames)
+
+    def histogram(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, labelNames, buckets)
+
+    def addCollector(self, fn):
+        """fn() runs before each render, for gauges read from other components"""
+        self._collectors.append(fn)
+
+    def render(self):
+        for collect in self._collectors:
+            try:
+                collect()
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+stageDuration = metrics.histogram(
+    "pipeline_stage_duration_seconds",
+    "Time spent in each traced stage and external call",
+    ("stage",),
+)
+stageErrors = metrics.counter(
+    "pipeline_stage_errors_total", "Traced stages that raised", ("stage",)
+)
+retries = metrics.counter(
+    "retries_total", "Calls retried after a failure", ("service", "reason")
+)
+rateLimited = metrics.counter(
+    "rate_limited_total", "Calls rejected or held back by a rate limit", ("service",)
+)
+geminiTokens = metrics.counter(
+    "gemini_tokens_total",
+    "Gemini prompt and response tokens as reported by usage metadata",
+    ("kind", "direction"),
+)
+
+
+# Spans
+
+_currentSpan = contextvars.ContextVar("currentSpan", default=None)
+_ids = itertools.count(1)
+_recentSpans = deque(maxlen=500)
+_recentLock = threading.Lock()
+
+
+class Span:
+    def __init__(self, name, attributes):
+        parent = _currentSpan.get()
+        self.id = next(_ids)
+        self.traceId = parent.traceId if parent else self.id
+        self.parentId = parent.id if parent else None
+        self.name = name
+        self.attributes = attributes
+        self.startedAt = time.time()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def asDict(self):
+        return {
+            "trace_id": self.traceId,
+            "span_id": self.id,
+            "parent_id": self.parentId,
+            "name": self.name,
+            "started_at": self.startedAt,
+            "duration_ms": round(self.duration * 1000, 2) if self.duration else None,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the block as one stage. Spans opened inside it, on this thread or task,
+    become its children and share its trace id.
+    """
+    current = Span(name, attributes)
+    token = _currentSpan.set(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        stageErrors.inc(stage=current.name)
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        _currentSpan.reset(token)
+        # the name can be changed inside the block, e.g. once a request's route is known
+        stageDuration.observe(current.duration, stage=current.name)
+        with _recentLock:
+            _recentSpans.append(current)
+
+
+def traced(name):
+    """Decorator form of span for plain and async functions"""
+
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def asyncWrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+
+            return asyncWrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def carryContext(fn):
+    """
+    Wraps fn to run with the caller's current span as its parent, for work handed
+    to a thread pool, which does not carry context variables over on its own
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+
+    return wrapper
+
+
+def recentTraces(limit=20):
+    """The most recent traces, each a list of its spans in the order they started"""
+    with _recentLock:
+        spans = list(_recentSpans)
+
+    traces = {}
+    for s in spans:
+        traces.setdefault(s.traceId, []).append(s)
+
+    latest = sorted(traces.values(), key=lambda t: max(s.startedAt for s in t))[-limit:]
+    return [
+        [s.asDict() for s in sorted(trace, key=lambda s: s.startedAt)]
+        for trace in reversed(latest)
+    ]
+
+
+def recordGeminiUsage(kind, response):
+    """Counts the prompt and response tokens gemini reports for a call"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    promptTokens = getattr(usage, "prompt_token_count", None) or 0
+    responseTokens = getattr(usage, "candidates_token_count", None) or 0
+    geminiTokens.inc(promptTokens, kind=kind, direction="prompt")
+    geminiTokens.inc(responseTokens, kind=kind, direction="response")
+
+    current = _currentSpan.get()
+    if current is not None:
+        current.set(promptTokens=promptTokens, responseTokens=responseTokens)
+
+
+_idPattern = re.compile(r"/\d+")
+
+
+def routeLabel(path):
+    """Strava api paths with ids folded so each endpoint is one label value"""
+    return _idPattern.sub("/{id}", path.split("?")[0])
@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+import threading
+
+from SingleFlight import SingleFlight
+
+
+class TokenStore:
+    """
+    Per user credentials for one provider (strava, google). Tokens are cached in
+    memory in front of one json file per user, files are replaced atomically so a
+    crash mid write never leaves a half written token behind.
+    """
+
+    def __init__(self, provider, tokenDir="tokens"):
+        self.provider = provider
+        self.dirPath = os.path.join(tokenDir, provider)
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._refreshes = SingleFlight()
+
+    def _path(self, userId):
+        return os.path.join(self.dirPath, f"{userId}.json")
+
+    def get(self, userId):
+        """Returns the users tokens or None if they have not authenticated"""
+        userId = str(userId)
+        with self._lock:
+            if userId in self._cache:
+                return self._cache[userId]
+
+        try:
+            with open(self._path(userId), "r") as f:
+                tokens = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        with self._lock:
+            self._cache[userId] = tokens
+        return tokens
+
+    def save(self, userId, tokens):
+        userId = str(userId)
+        os.makedirs(self.dirPath, exist_ok=True)
+
+        fd, tmpPath = tempfile.mkstemp(dir=self.dirPath, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(tokens, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpPath, self._path(userId))
+        except Exception:
+            os.remove(tmpPath)
+            raise
+
+        with self._lock:
+            self._cache[userId] = tokens
+
+    def delete(self, userId):
+        userId = str(userId)
+        with self._lock:
+            self._cache.pop(userId, None)
+        try:
+            os.remove(self._path(userId))
+        except FileNotFoundError:
+            pass
+
+    def refresh(self, userId, refreshFn, isFresh=None):
+        """
+        Refreshes a users tokens with refreshFn(currentTokens) -> newTokens. Concurrent
+        refreshes for the same user collapse into one call whose result all of them share.
+        With isFresh(tokens), a caller that read the tokens just before another refresh
+        saved new ones gets those instead of refreshing a second time.
+        """
+        userId = str(userId)
+
+        def doRefresh():
+            tokens = self.get(userId)
+            if tokens is not None and isFresh is not None and isFresh(tokens):
+                return tokens
+            tokens = refreshFn(tokens)
+            self.save(userId, tokens)
+            return tokens
+
+        return self._refreshes.do(userId, doRefresh)
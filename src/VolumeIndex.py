@@ -0,0 +1,244 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+from GatherData import parseDistance, parseDuration
+
+# Day, week and month training volume kept up to date as activities are ingested, so
+# date range questions never have to reparse every stored run. Each activity's
+# contribution is remembered so an edit or delete can take it back out again.
+
+PERIODS = ("day", "week", "month")
+
+
+def periodStarts(day):
+    """The day, monday of the week and first of the month an ISO date falls in"""
+    d = date.fromisoformat(day)
+    return {
+        "day": d.isoformat(),
+        "week": (d - timedelta(days=d.weekday())).isoformat(),
+        "month": d.replace(day=1).isoformat(),
+    }
+
+
+def activityContribution(activity):
+    """What one processed activity adds to the rollups"""
+    if hasattr(activity, "model_dump"):
+        activity = activity.model_dump()
+
+    movingSeconds = parseDuration(activity["movingTime"])
+    hasHr = activity["avgHr"] is not None
+    return {
+        "day": datetime.strptime(activity["date"], "%d-%m-%Y").date().isoformat(),
+        "distance_m": parseDistance(activity["distanceTotal"]) * 1000,
+        "moving_s": movingSeconds,
+        "elevation_m": sum(
+            split["elevationDiff"]
+            for split in activity["splits"]
+            if split["elevationDiff"] > 0
+        ),
+        "hr_weighted": activity["avgHr"] * movingSeconds if hasHr else 0.0,
+        "hr_seconds": movingSeconds if hasHr else 0,
+    }
+
+
+class VolumeIndex:
+    def __init__(self, dbPath="strava_activities.db"):
+        self.dbPath = dbPath
+        self._lock = threading.Lock()
+        self._createTables()
+
+    @contextmanager
+    def _connect(self):
+        with self._lock:
+            conn = sqlite3.connect(self.dbPath)
+            try:
+                yield conn
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _createTables(self):
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS volume_contributions (
+                    athlete_id INTEGER NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    day TEXT NOT NULL,
+                    distance_m REAL NOT NULL,
+                    moving_s INTEGER NOT NULL,
+                    elevation_m REAL NOT NULL,
+                    hr_weighted REAL NOT NULL,
+                    hr_seconds INTEGER NOT NULL,
+                    PRIMARY KEY (athlete_id, activity_id)
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS volume_contributions_day
+                ON volume_contributions (athlete_id, day, distance_m)
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS volume_rollups (
+                    athlete_id INTEGER NOT NULL,
+                    period TEXT NOT NULL,
+                    period_start TEXT NOT NULL,
+                    runs INTEGER NOT NULL,
+                    distance_m REAL NOT NULL,
+                    moving_s INTEGER NOT NULL,
+                    elevation_m REAL NOT NULL,
+                    hr_weighted REAL NOT NULL,
+                    hr_seconds INTEGER NOT NULL,
+                    PRIMARY KEY (athlete_id, period, period_start)
+                )
+                """
+            )
+
+    def _apply(self, conn, athleteId, contribution, sign):
+        """Adds (sign 1) or removes (sign -1) one contribution from its three rollups"""
+        values = (
+            sign,
+            sign * contribution["distance_m"],
+            sign * contribution["moving_s"],
+            sign * contribution["elevation_m"],
+            sign * contribution["hr_weighted"],
+            sign * contribution["hr_seconds"],
+        )
+        for period, start in periodStarts(contribution["day"]).items():
+            conn.execute(
+                """
+                INSERT INTO volume_rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(athlete_id, period, period_start) DO UPDATE SET
+                    runs = runs + excluded.runs,
+                    distance_m = distance_m + excluded.distance_m,
+                    moving_s = moving_s + excluded.moving_s,
+                    elevation_m = elevation_m + excluded.elevation_m,
+                    hr_weighted = hr_weighted + excluded.hr_weighted,
+                    hr_seconds = hr_seconds + excluded.hr_seconds
+                """,
+                (athleteId, period, start, *values),
+            )
+
+    def _takeOut(self, conn, athleteId, activityId):
+        row = conn.execute(
+            """
+            SELECT day, distance_m, moving_s, elevation_m, hr_weighted, hr_seconds
+            FROM volume_contributions WHERE athlete_id = ? AND activity_id = ?
+            """,
+            (athleteId, activityId),
+        ).fetchone()
+        if row is None:
+            return
+
+        keys = (
+            "day",
+            "distance_m",
+            "moving_s",
+            "elevation_m",
+            "hr_weighted",
+            "hr_seconds",
+        )
+        self._apply(conn, athleteId, dict(zip(keys, row)), -1)
+        conn.execute(
+            "DELETE FROM volume_contributions WHERE athlete_id = ? AND activity_id = ?",
+            (athleteId, activityId),
+        )
+
+    def recordActivities(self, athleteId, activities):
+        """Adds new activities, an activity seen before has its old figures replaced"""
+        with self._connect() as conn:
+            for activity in activities:
+                activityId = activity.id if hasattr(activity, "id") else activity["id"]
+                contribution = activityContribution(activity)
+                self._takeOut(conn, athleteId, activityId)
+                conn.execute(
+                    "INSERT INTO volume_contributions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        athleteId,
+                        activityId,
+                        contribution["day"],
+                        contribution["distance_m"],
+                        contribution["moving_s"],
+                        contribution["elevation_m"],
+                        contribution["hr_weighted"],
+                        contribution["hr_seconds"],
+                    ),
+                )
+                self._apply(conn, athleteId, contribution, 1)
+
+    def removeActivity(self, athleteId, activityId):
+        with self._connect() as conn:
+            self._takeOut(conn, athleteId, activityId)
+
+    def activityIds(self, athleteId):
+        """Ids of every activity the index holds figures for"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT activity_id FROM volume_contributions WHERE athlete_id = ?",
+                (athleteId,),
+            ).fetchall()
+        return {activityId for (activityId,) in rows}
+
+    # Queries, dates are ISO YYYY-MM-DD and inclusive
+
+    def rollups(self, athleteId, period="week", start=None, end=None):
+        """Rollups for every period starting in the range that has at least one run"""
+        if period not in PERIODS:
+            raise ValueError(f"period must be one of {PERIODS}")
+
+        # widen the start back to the beginning of the period it falls in
+        start = periodStarts(start)[period] if start else "0000-01-01"
+        end = end or "9999-12-31"
+        with self._connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT period_start, runs, distance_m, moving_s, elevation_m,
+                    hr_weighted, hr_seconds
+                FROM volume_rollups
+                WHERE athlete_id = ? AND period = ? AND period_start BETWEEN ? AND ?
+                    AND runs > 0
+                ORDER BY period_start
+                """,
+                (athleteId, period, start, end),
+            ).fetchall()
+
+        return [
+            {
+                "start": periodStart,
+                "runs": runs,
+                "distanceKm": round(distance / 1000, 2),
+                "movingTime": str(timedelta(seconds=int(moving))),
+                "elevationGainM": round(elevation),
+                "avgHr": round(hrWeighted / hrSeconds, 1) if hrSeconds else None,
+            }
+            for periodStart, runs, distance, moving, elevation, hrWeighted, hrSeconds in rows
+        ]
+
+    def longestRun(self, athleteId, start=None, end=None):
+        with self._connect() as conn:
+            row = conn.execute(
+                """
+                SELECT activity_id, day, distance_m FROM volume_contributions
+                WHERE athlete_id = ? AND day BETWEEN ? AND ?
+                ORDER BY distance_m DESC LIMIT 1
+                """,
+                (athleteId, start or "0000-01-01", end or "9999-12-31"),
+            ).fetchone()
+
+        if row is None:
+            return None
+        return {"id": row[0], "date": row[1], "distanceKm": round(row[2] / 1000, 2)}
+
+    def recentWeeks(self, athleteId, weeks=12, today=None):
+        """Weekly rollups for the last `weeks` weeks, the current week included"""
+        today = today or date.today()
+        start = today - timedelta(days=today.weekday(), weeks=weeks - 1)
+        return self.rollups(athleteId, "week", start.isoformat(), today.isoformat())
+
+
+volumeIndex = VolumeIndex()
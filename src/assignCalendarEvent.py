@@ -1,6 +1,8 @@
 import datetime as dt
+import hashlib
 import os.path
 import json
+import time
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -8,43 +10,59 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from pydantic import ValidationError
+
+from PlanModels import TrainingPlan
+from Telemetry import rateLimited, retries, span, traced
+
 SCOPES = ["https://www.googleapis.com/auth/calendar"]
 
+# Calls sent per batch request, google allows up to 1000 but recommends staying near 50
+CALENDAR_BATCH_SIZE = int(os.getenv("CALENDAR_BATCH_SIZE", "50"))
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# A 403 is only worth retrying when google says it was a rate limit, not a permission error
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+# Private extended property tagging every event created from a plan
+PLAN_KEY_PROPERTY = "runPlanKey"
+
 
+@traced("json.read")
 def gettrainingPlan(filePath: str = "5_week_plan.json"):
+    """Reads a saved plan file into a TrainingPlan, for plans not held in the PlanStore"""
     try:
-        with open(filePath, "r") as f:
-            plan = json.load(f)
+        with open(filePath, "rb") as f:
+            plan = TrainingPlan.model_validate_json(f.read())
 
-        if not plan:
+        if not plan.weeks:
             return {"error": "No plan found in file"}
         else:
             return {"plan": plan}
 
     except FileNotFoundError:
         return {"error": f"File {filePath} not Found"}
-    except json.JSONDecodeError:
-        return {"error": "Invalid JSON format in the file"}
+    except ValidationError:
+        return {"error": "Invalid training plan in the file"}
     except Exception as e:
         return {"error": f"Error reading data: {str(e)}"}
 
 
 def formatPlanForCal(workout, timeZone, startTime="09:00:00"):
-    description = workout["description"]
-    if workout["type"] != "Rest":
-        if workout["distance_km"]:
-            description += f" Total Distance: {workout['distance_km']} KM ."
-        if workout["target_pace_min_km"]:
-            description += f" Aim for {workout['target_pace_min_km']} as a successful pace for this workout."
-        if workout["duration_minutes"]:
+    description = workout.description
+    if workout.type != "Rest":
+        if workout.distance_km:
+            description += f" Total Distance: {workout.distance_km} KM ."
+        if workout.target_pace_min_km:
+            description += f" Aim for {workout.target_pace_min_km} as a successful pace for this workout."
+        if workout.duration_minutes:
             description += (
-                f" This should take you around {workout['duration_minutes']} minutes."
+                f" This should take you around {workout.duration_minutes} minutes."
             )
 
-    if workout["type"] == "Rest" or not workout["duration_minutes"]:
+    if workout.type == "Rest" or not workout.duration_minutes:
         minsToAdd = 10
     else:
-        minsToAdd = workout["duration_minutes"]
+        minsToAdd = workout.duration_minutes
 
     dtStartTime = dt.datetime.strptime(startTime, "%H:%M:%S")
     endTime = dtStartTime + dt.timedelta(minutes=minsToAdd)
@@ -52,15 +70,15 @@ def formatPlanForCal(workout, timeZone, startTime="09:00:00"):
     endTimeStr = endTime.strftime("%H:%M:%S")
 
     event = {
-        "summary": workout["type"],
+        "summary": workout.type,
         "description": description,
         "colorId": "6",  # Fixed typo: was "colourId"
         "start": {
-            "dateTime": f"{workout['date']}T{startTime}",
+            "dateTime": f"{workout.date}T{startTime}",
             "timeZone": timeZone,
         },
         "end": {
-            "dateTime": f"{workout['date']}T{endTimeStr}",
+            "dateTime": f"{workout.date}T{endTimeStr}",
             "timeZone": timeZone,
         },
     }
@@ -68,48 +86,257 @@ def formatPlanForCal(workout, timeZone, startTime="09:00:00"):
     return event
 
 
-def createCalendarEvents(dataSet, creds, timeZone, startTime):
-    """Create calendar events using a single service connection"""
+def isRetryable(exception):
+    status = getattr(getattr(exception, "resp", None), "status", None)
+    if status == 403:
+        details = getattr(exception, "error_details", None)
+        if not isinstance(details, list):
+            return False
+        return any(
+            isinstance(detail, dict) and detail.get("reason") in RATE_LIMIT_REASONS
+            for detail in details
+        )
+    return status in RETRYABLE_STATUSES
+
+
+def executeBatch(service, calls, batchSize=CALENDAR_BATCH_SIZE, maxRetries=3):
+    """
+    Sends calendar api calls in batch requests, `calls` maps a key to a function
+    building the request. Only calls that failed with a retryable error are sent
+    again. Returns the responses and the errors of calls that still failed, both by key.
+    """
+    with span("calendar.execute", calls=len(calls)) as executeSpan:
+        responses, failures, attempts = _executeBatch(
+            service, calls, batchSize, maxRetries
+        )
+        executeSpan.set(attempts=attempts, failed=len(failures))
+    return responses, failures
+
+
+def _executeBatch(service, calls, batchSize, maxRetries):
+    responses = {}
+    failures = {}
+    pending = list(calls)
+
+    for attempt in range(maxRetries):
+        retry = []
+
+        def callback(requestId, response, exception, retry=retry):
+            if exception is None:
+                responses[requestId] = response
+                failures.pop(requestId, None)
+            else:
+                failures[requestId] = exception
+                if isRetryable(exception):
+                    status = exception.resp.status
+                    if status in (403, 429):
+                        rateLimited.inc(service="calendar")
+                    retry.append(requestId)
+
+        for start in range(0, len(pending), batchSize):
+            batch = service.new_batch_http_request(callback=callback)
+            keys = pending[start : start + batchSize]
+            for key in keys:
+                batch.add(calls[key](), request_id=key)
+            with span("calendar.batch", calls=len(keys)):
+                batch.execute()
+
+        if not retry or attempt == maxRetries - 1:
+            break
+
+        wait_time = 2**attempt  # Exponential backoff: 1s, 2s, 4s
+        print(f"Retrying {len(retry)} failed calendar calls in {wait_time} seconds...")
+        retries.inc(len(retry), service="calendar", reason="batch_call")
+        time.sleep(wait_time)
+        pending = retry
+
+    return responses, failures, attempt + 1
+
+
+def planKeyFor(owner):
+    """
+    One key per athlete, so exporting a regenerated plan replaces the previous one
+    wherever it starts, workouts no longer in the plan are deleted by reconcile
+    """
+    return f"plan-{owner}" if owner is not None else "plan"
+
+
+def eventHash(event):
+    return hashlib.sha256(json.dumps(event, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def buildPlanEvents(weeks, timeZone, startTime, planKey):
+    """
+    Formats every workout into an event tagged with the plan key, a stable workout
+    key from the week number and date, and a hash of the event content
+    """
+    events = {}
+
+    for week in weeks:
+        for workout in week.workouts:
+            baseKey = f"{planKey}:w{week.week_number}:{workout.date}"
+            key, n = baseKey, 1
+            while key in events:
+                key, n = f"{baseKey}:{n}", n + 1
+
+            event = formatPlanForCal(
+                workout=workout, timeZone=timeZone, startTime=startTime
+            )
+            event["extendedProperties"] = {
+                "private": {
+                    PLAN_KEY_PROPERTY: planKey,
+                    "workoutKey": key,
+                    "contentHash": eventHash(event),
+                }
+            }
+            events[key] = event
+
+    return events
+
+
+@traced("calendar.list")
+def listPlanEvents(service, planKey):
+    """All events already tagged with this plan, grouped by workout key"""
+    existing = {}
+    pageToken = None
+
+    while True:
+        response = (
+            service.events()
+            .list(
+                calendarId="primary",
+                privateExtendedProperty=f"{PLAN_KEY_PROPERTY}={planKey}",
+                maxResults=2500,
+                pageToken=pageToken,
+            )
+            .execute()
+        )
+        for event in response.get("items", []):
+            private = event.get("extendedProperties", {}).get("private", {})
+            existing.setdefault(private.get("workoutKey"), []).append(event)
+
+        pageToken = response.get("nextPageToken")
+        if not pageToken:
+            return existing
+
+
+def reconcilePlanEvents(service, weeks, timeZone, startTime, batchSize, planKey):
+    """
+    Brings the calendar in line with the plan, inserting new workouts, patching
+    changed ones and deleting ones no longer in the plan. An unchanged plan makes no
+    writes. Returns how many of each were written and the calls that still failed.
+    """
+    events = buildPlanEvents(weeks, timeZone, startTime, planKey)
+    existing = listPlanEvents(service, planKey)
+    calls = {}
+    counts = {"inserted": 0, "patched": 0, "deleted": 0, "failed": {}}
+
+    def insert(event):
+        return lambda: service.events().insert(calendarId="primary", body=event)
+
+    def patch(eventId, event):
+        return lambda: service.events().patch(
+            calendarId="primary", eventId=eventId, body=event
+        )
+
+    def delete(eventId):
+        return lambda: service.events().delete(calendarId="primary", eventId=eventId)
+
+    for key, event in events.items():
+        matches = existing.pop(key, [])
+        if not matches:
+            calls[f"inserted:{key}"] = insert(event)
+            continue
+
+        current = matches[0]
+        currentHash = (
+            current.get("extendedProperties", {}).get("private", {}).get("contentHash")
+        )
+        if currentHash != event["extendedProperties"]["private"]["contentHash"]:
+            calls[f"patched:{key}"] = patch(current["id"], event)
+
+        # duplicates left behind by earlier exports
+        for duplicate in matches[1:]:
+            calls[f"deleted:{duplicate['id']}"] = delete(duplicate["id"])
+
+    for leftovers in existing.values():
+        for event in leftovers:
+            calls[f"deleted:{event['id']}"] = delete(event["id"])
+
+    if not calls:
+        print("Calendar already matches the plan, nothing to update")
+        return counts
+
+    done, failed = executeBatch(service, calls, batchSize)
+    for key in done:
+        counts[key.split(":", 1)[0]] += 1
+    for key, error in failed.items():
+        print(f"An error occurred syncing calendar event '{key}': {error}")
+        counts["failed"][key] = str(error)
+
+    print(
+        f"\nCalendar synced: {counts['inserted']} inserted, "
+        f"{counts['patched']} patched, {counts['deleted']} deleted, "
+        f"{len(failed)} failed"
+    )
+    return counts
+
+
+def createCalendarEvents(
+    dataSet,
+    creds,
+    timeZone,
+    startTime,
+    batchSize=CALENDAR_BATCH_SIZE,
+    reconcile=False,
+    owner=None,
+):
+    """
+    Create calendar events in batch requests over a single service connection,
+    with reconcile only the differences from the owner's previous export are written.
+    Returns the counts written with the calls that still failed by key, or False when
+    the calendar could not be reached at all.
+    """
     if not dataSet:
-        return "Cannot Create calendar events as dataSet is not available"
+        print("Cannot Create calendar events as dataSet is not available")
+        return False
 
-    weeks = dataSet["plan"]["weeks"]
+    weeks = dataSet["plan"].weeks
+    planKey = planKeyFor(owner)
 
     # Create service once and reuse it
     try:
         with build("calendar", "v3", credentials=creds) as service:
-            events_created = 0
-
-            for week in weeks:
-                days = week["workouts"]
-                for day in days:
-                    event = formatPlanForCal(
-                        workout=day, timeZone=timeZone, startTime=startTime
-                    )
-
-                    success = insertCalEvent(service, event)
-                    if success:
-                        events_created += 1
+            if reconcile:
+                return reconcilePlanEvents(
+                    service, weeks, timeZone, startTime, batchSize, planKey
+                )
 
-            print(f"\nSuccessfully created {events_created} calendar events!")
-            return True
+            events = buildPlanEvents(weeks, timeZone, startTime, planKey)
 
-    except HttpError as error:
-        print(f"An error occurred while creating calendar service: {error}")
-        return False
+            calls = {
+                key: lambda event=event: service.events().insert(
+                    calendarId="primary", body=event
+                )
+                for key, event in events.items()
+            }
+            created, failed = executeBatch(service, calls, batchSize)
 
+            for key, error in failed.items():
+                print(
+                    f"An error occurred creating event '{events[key]['summary']}': {error}"
+                )
 
-def insertCalEvent(service, event):
-    """Insert a single calendar event using existing service connection"""
-    try:
-        created_event = (
-            service.events().insert(calendarId="primary", body=event).execute()
-        )
-        print(f"Event created: {event['summary']} - {created_event.get('htmlLink')}")
-        return True
+            print(f"\nSuccessfully created {len(created)} calendar events!")
+            return {
+                "inserted": len(created),
+                "patched": 0,
+                "deleted": 0,
+                "failed": {key: str(error) for key, error in failed.items()},
+            }
 
     except HttpError as error:
-        print(f"An error occurred creating event '{event['summary']}': {error}")
+        print(f"An error occurred while creating calendar service: {error}")
         return False
 
 
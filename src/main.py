@@ -4,19 +4,31 @@ import time
 import json
 import asyncio
 import os
+import threading
 import webbrowser
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeout
 from pathlib import Path
-from typing import List, Optional, Dict, Any, Union
+from typing import List, Optional, Dict, Any
 
 # Third-party imports
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import (
+    HTMLResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, ValidationError
 
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request as GoogleRequest
 
 # Add the src directory to Python path before local imports
 current_dir = Path(__file__).resolve().parent
@@ -27,15 +39,41 @@ from StravaApiAuth import (
     getAuthenticatedUser,
     getAthleteinfo,
     get_code_for_tokens,
+    legacyTokenOwner,
+    tokenManager,
     CLIENT_ID,
 )  # noqa: E402
-from GatherData import gatherLastRunsFromTen, processActivityData, dumpJsonFile  # noqa: E402
+from GatherData import (  # noqa: E402
+    gatherLastRunsFromTen,
+    iterRuns,
+    processActivityData,
+)
+from ActivityStore import activityStore  # noqa: E402
+from ColumnarActivityStore import activitySegments  # noqa: E402
+from ActivityStreams import activityStreams, fetchActivityStreams  # noqa: E402
+from VolumeIndex import volumeIndex  # noqa: E402
+from Telemetry import carryContext, metrics, recentTraces, span  # noqa: E402
+from StravaBackfill import BackfillCheckpoint, backfillHistory  # noqa: E402
+from StravaRequestScheduler import stravaScheduler  # noqa: E402
+from TokenStore import TokenStore  # noqa: E402
+from SyncJobs import JobManager, COMPLETE  # noqa: E402
+from SingleFlight import SingleFlight  # noqa: E402
+from GeminiResponseCache import geminiCache  # noqa: E402
+from GeminiCalls import geminiBreaker  # noqa: E402
+from PlanModels import TrainingPlan  # noqa: E402
+from PlanStore import planStore  # noqa: E402
 from GeminiRunningDataAnalyzer import (  # noqa: E402
+    PLAN_WEEKS,
     getGenAiClient,
-    readRunningData,
+    analysisCacheKey,
+    planCacheKey,
     runningAnalysis,
     runningPlan,
+    streamRunningAnalysis,
+    streamRunningPlan,
 )
+from RunAnalytics import computeRunAnalytics  # noqa: E402
+from LocalPlanEngine import buildLocalPlan  # noqa: E402
 from assignCalendarEvent import (  # noqa: E402 s
     get_credentials,
     gettrainingPlan,
@@ -55,7 +93,39 @@ GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 GOOGLE_REDIRECT_URI = "http://localhost:8000/google-callback"
 SCOPES = ["https://www.googleapis.com/auth/calendar"]
 
-userTokens = {}  # Temporary for development purposes will be replaced with a database structure upon full deployment
+# Number of activity details fetched from strava in parallel, the request
+# scheduler keeps them inside the rate limit
+STRAVA_FETCH_WORKERS = int(os.getenv("STRAVA_FETCH_WORKERS", "4"))
+# Seconds cached activities are served before checking strava for new ones
+STRAVA_SYNC_INTERVAL = int(os.getenv("STRAVA_SYNC_INTERVAL", "900"))
+# Activity summaries requested per page when listing
+STRAVA_PAGE_SIZE = int(os.getenv("STRAVA_PAGE_SIZE", "30"))
+STRAVA_VERIFY_TOKEN = os.getenv("STRAVA_VERIFY_TOKEN")
+# Fetch per second streams alongside each newly synced activity, this doubles the
+# strava requests a sync makes so by default streams are only fetched the first
+# time a window of the activity is asked for
+STRAVA_FETCH_STREAMS = os.getenv("STRAVA_FETCH_STREAMS", "0") == "1"
+
+syncJobs = JobManager(maxWorkers=int(os.getenv("SYNC_JOB_WORKERS", "2")))
+# Full history backfills are long running, kept apart so they never hold up a sync
+backfillJobs = JobManager(maxWorkers=1)
+
+# Seconds /gemini-plan waits on gemini before serving the local rule based plan, 0 waits as long as it takes
+GEMINI_PLAN_LATENCY_BUDGET = float(os.getenv("GEMINI_PLAN_LATENCY_BUDGET", "20"))
+# Whether a gemini plan finishing after the local plan was served replaces it in the plan store
+GEMINI_PLAN_SWAP_IN = os.getenv("GEMINI_PLAN_SWAP_IN", "1") == "1"
+# gemini plan generations run here so a request can stop waiting without cancelling them
+planHedgeExecutor = ThreadPoolExecutor(max_workers=2)
+
+# Identical concurrent requests share one strava sync or gemini generation
+runnerFlight = SingleFlight()
+analysisFlight = SingleFlight()
+planFlight = SingleFlight()
+streamsFlight = SingleFlight()
+
+# Pending google oauth states, credentials themselves live in the per user token store
+oauthStates = {}
+googleTokens = TokenStore("google")
 
 
 class StravaUserDetails(BaseModel):
@@ -77,49 +147,14 @@ class ErrorResponse(BaseModel):
     details: Optional[Dict[str, Any]] = None
 
 
-class Workout(BaseModel):
-    day: str
-    date: str
-    type: str
-    description: str
-    distance_km: Optional[Union[float, int]] = None
-    target_pace_min_km: Optional[str] = None
-    duration_minutes: Optional[Union[int, float]] = None
-
-    class Config:
-        extra = "allow"
-
-
-class Week(BaseModel):
-    week_number: int
-    workouts: List[Workout]
-
-    class Config:
-        extra = "allow"
-
-
-class RunningPlan(BaseModel):
-    weeks: List[Week]
-
-    total_weeks: Optional[int] = None
-    plan_type: Optional[str] = None
-    fitness_level: Optional[str] = None
-
-    class Config:
-        extra = "allow"
-
-
 class AiSuccessResponse(BaseModel):
     success: bool = True
-    planData: RunningPlan
+    planData: TrainingPlan
     message: str = "Analysis and Generation Success"
-
-
-class AiRawResponse(BaseModel):
-    success: bool = True
-    planData: Dict[str, Any]
-    message: str = "Plan and Analysis generation Success"
-    validationWarnings: Optional[List[str]] = None
+    # "gemini", or "local" when the rule based plan was served in its place
+    source: str = "gemini"
+    # version of the plan in the plan store, GET /plan shows whether it has since been replaced
+    planVersion: Optional[int] = None
 
 
 class AiAnalysisResponse(BaseModel):
@@ -140,6 +175,42 @@ class AuthStatusResponse(BaseModel):
     error: Optional[str] = None
 
 
+class SyncProgress(BaseModel):
+    stage: Optional[str] = None
+    done: int = 0
+    total: int = 0
+
+
+class SyncJobStartResponse(BaseModel):
+    job_id: str
+    status: str
+
+
+class SyncJobStatusResponse(AuthStatusResponse):
+    job_id: str
+    status: str
+    progress: SyncProgress
+    data: Optional[StravaUserDetails] = None
+
+
+class BackfillSummary(BaseModel):
+    processed: int
+    total_processed: int
+    failed: List[int]
+    complete: bool
+    elapsed_seconds: float
+    activities_per_minute: float
+
+
+class BackfillStatusResponse(BaseModel):
+    job_id: str
+    status: str
+    error: Optional[str] = None
+    progress: SyncProgress
+    activities_per_minute: float
+    data: Optional[BackfillSummary] = None
+
+
 class AuthStartResponse(BaseModel):
     auth_url: str
     message: str
@@ -153,6 +224,72 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+httpRequests = metrics.counter(
+    "http_requests_total", "Requests handled per route", ("route", "method", "status")
+)
+planHedged = metrics.counter(
+    "gemini_plan_local_served_total",
+    "Plan requests answered with the local plan, by why gemini's was not used",
+    ("outcome",),
+)
+
+
+@app.middleware("http")
+async def traceRequests(request: Request, call_next):
+    """Root span for every request, stages called while handling it nest under it"""
+    with span(f"{request.method} {request.url.path}") as requestSpan:
+        response = await call_next(request)
+        # raw paths of unmatched requests would give every probed url its own label
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        requestSpan.name = f"{request.method} {route}"
+        requestSpan.set(status=response.status_code)
+    httpRequests.inc(route=route, method=request.method, status=response.status_code)
+    return response
+
+
+def collectServiceMetrics():
+    """Copies the scheduler, token and coalescing counters into gauges for /metrics"""
+    scheduler = stravaScheduler.stats()
+    quota = metrics.gauge(
+        "strava_quota_usage", "Strava requests used and allowed", ("window", "kind")
+    )
+    quota.set(scheduler["short_usage"], window="15m", kind="used")
+    quota.set(scheduler["short_limit"], window="15m", kind="limit")
+    quota.set(scheduler["long_usage"], window="daily", kind="used")
+    quota.set(scheduler["long_limit"], window="daily", kind="limit")
+    metrics.gauge("strava_requests_in_flight", "Strava requests in flight").set(
+        scheduler["in_flight"]
+    )
+
+    tokens = tokenManager.stats()
+    tokenGauge = metrics.gauge(
+        "strava_token_events", "Strava token refreshes and reuses", ("kind",)
+    )
+    for kind in ("refreshes", "failed_refreshes", "reused_tokens"):
+        tokenGauge.set(tokens[kind], kind=kind)
+
+    coalescing = metrics.gauge(
+        "coalesced_requests",
+        "Requests that ran upstream or shared a result",
+        ("flight", "kind"),
+    )
+    for flightName, flight in (
+        ("runner", runnerFlight),
+        ("gemini_analysis", analysisFlight),
+        ("gemini_plan", planFlight),
+        ("activity_streams", streamsFlight),
+    ):
+        flightStats = flight.stats()
+        coalescing.set(
+            flightStats["upstream_calls"], flight=flightName, kind="upstream"
+        )
+        coalescing.set(
+            flightStats["coalesced_calls"], flight=flightName, kind="coalesced"
+        )
+
+
+metrics.addCollector(collectServiceMetrics)
+
 
 @app.get("/start-auth", response_model=AuthStartResponse)
 async def start_stava_auth():
@@ -191,7 +328,9 @@ async def strava_callback(request: Request):
 
         tokens = get_code_for_tokens(code)
 
-        return RedirectResponse(url="http://localhost:5173/?auth=success")
+        return RedirectResponse(
+            url=f"http://localhost:5173/?auth=success&athlete_id={tokens['athlete_id']}"
+        )
 
     return HTMLResponse(
         content="<h1>Authorization Failed</h1><p>No authorization code received.</p>",
@@ -200,9 +339,9 @@ async def strava_callback(request: Request):
 
 
 @app.get("/runner", response_model=RunnerActivitiesSuccess)
-def get_runner_details():
+def get_runner_details(athlete_id: int):
     try:
-        strava_data = getStravaData()
+        strava_data = getStravaData(athlete_id)
         if not strava_data:
             raise HTTPException(
                 status_code=503,
@@ -212,18 +351,7 @@ def get_runner_details():
                 ).model_dump(),
             )
 
-        user = StravaUserDetails(
-            runnerId=strava_data["athlete_info"]["id"],
-            runnerName=(
-                strava_data["athlete_info"]["firstname"]
-                + " "
-                + strava_data["athlete_info"]["lastname"]
-            ),
-            activities=strava_data["user_data"],
-            failedActivites=strava_data["failed_activities"],
-        )
-
-        return RunnerActivitiesSuccess(data=user)
+        return RunnerActivitiesSuccess(data=buildRunnerDetails(strava_data))
 
     except HTTPException:
         raise
@@ -245,10 +373,233 @@ def get_runner_details():
         )
 
 
+@app.post("/runner/sync", response_model=SyncJobStartResponse, status_code=202)
+def start_runner_sync(athlete_id: int):
+    """Starts a strava sync in the background, poll the returned job for the result"""
+    # a sync already running for this athlete is returned rather than started again
+    job = syncJobs.submit(athlete_id, runStravaSync, athlete_id)
+    return SyncJobStartResponse(job_id=job.id, status=job.status)
+
+
+@app.get("/runner/sync/{job_id}", response_model=SyncJobStatusResponse)
+def get_runner_sync(job_id: str):
+    job = syncJobs.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=404,
+            detail=ErrorResponse(
+                message="Sync job not found", error_code="JOB_NOT_FOUND"
+            ).model_dump(),
+        )
+
+    return SyncJobStatusResponse(
+        job_id=job.id,
+        status=job.status,
+        auth_complete=job.stage not in (None, "authenticating"),
+        data_processing=not job.finished,
+        data_complete=job.status == COMPLETE,
+        error=job.error,
+        progress=SyncProgress(stage=job.stage, done=job.done, total=job.total),
+        data=job.result,
+    )
+
+
+@app.post("/runner/backfill", response_model=SyncJobStartResponse, status_code=202)
+def start_runner_backfill(athlete_id: int, restart: bool = False):
+    """Imports the athletes whole strava history, resuming from the last checkpoint"""
+    job = backfillJobs.submit(athlete_id, runStravaBackfill, athlete_id, restart)
+    return SyncJobStartResponse(job_id=job.id, status=job.status)
+
+
+@app.get("/runner/backfill/{job_id}", response_model=BackfillStatusResponse)
+def get_runner_backfill(job_id: str):
+    job = backfillJobs.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=404,
+            detail=ErrorResponse(
+                message="Backfill job not found", error_code="JOB_NOT_FOUND"
+            ).model_dump(),
+        )
+
+    elapsed = (job.finishedAt or time.time()) - job.createdAt
+    return BackfillStatusResponse(
+        job_id=job.id,
+        status=job.status,
+        error=job.error,
+        progress=SyncProgress(stage=job.stage, done=job.done, total=job.total),
+        activities_per_minute=round(job.done / (elapsed / 60), 1) if elapsed else 0.0,
+        data=job.result,
+    )
+
+
+def fetchMissingStreams(athleteId, activityId):
+    """
+    Fetches and stores an activities streams the first time they are asked for. An
+    activity recorded without streams is stored empty so strava is not asked again.
+    """
+    try:
+        client = getAuthenticatedUser(athleteId)
+        if client is None:
+            return
+        with span("strava.streams"):
+            streams = fetchActivityStreams(client, activityId)
+        activityStreams.save(athleteId, activityId, streams)
+    except Exception as e:
+        print(f"Failed to fetch streams for activity {activityId}: {e}")
+
+
+@app.get("/activities/{activity_id}/streams")
+def get_activity_streams(
+    activity_id: int,
+    athlete_id: int,
+    start: int = 0,
+    end: Optional[int] = None,
+    types: Optional[str] = None,
+):
+    """Per second streams for a time window of a synced activity, types comma separated"""
+    if not activityStreams.has(athlete_id, activity_id):
+        streamsFlight.do(
+            (athlete_id, activity_id), fetchMissingStreams, athlete_id, activity_id
+        )
+
+    streams = activityStreams.window(
+        athlete_id, activity_id, start, end, types.split(",") if types else None
+    )
+    if not streams:
+        raise HTTPException(
+            status_code=404,
+            detail=ErrorResponse(
+                message="No streams stored for this activity",
+                error_code="STREAMS_UNAVAILABLE",
+            ).model_dump(),
+        )
+
+    return {
+        "success": True,
+        "streams": {
+            streamType: values.tolist() for streamType, values in streams.items()
+        },
+    }
+
+
+@app.get("/strava-webhook")
+def verify_strava_webhook(request: Request):
+    """Strava calls this once when the webhook subscription is created"""
+    params = request.query_params
+    if params.get("hub.verify_token") != STRAVA_VERIFY_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid verify token")
+
+    return {"hub.challenge": params.get("hub.challenge")}
+
+
+@app.post("/strava-webhook")
+async def strava_webhook_event(request: Request):
+    """Keeps the activity cache in step with edits made on strava"""
+    event = await request.json()
+
+    if event.get("object_type") != "activity":
+        return {"received": True}
+
+    athleteId = event.get("owner_id")
+    activityId = event.get("object_id")
+    aspect = event.get("aspect_type")
+
+    if aspect == "update":
+        activityStore.invalidateActivity(athleteId, activityId)
+    elif aspect == "delete":
+        activityStore.deleteActivity(athleteId, activityId)
+        activitySegments.delete(athleteId, [activityId])
+        activityStreams.delete(athleteId, activityId)
+        volumeIndex.removeActivity(athleteId, activityId)
+    elif aspect == "create":
+        activityStore.markOutOfDate(athleteId)
+
+    return {"received": True}
+
+
+@app.get("/analytics")
+def get_run_analytics(athlete_id: int, limit: int = 1000):
+    """Pace, heart rate and efficiency metrics worked out locally over cached runs"""
+    activities = activitySegments.loadActivities(athlete_id, limit=limit)
+
+    if not activities:
+        runningData = loadRunningData(athlete_id)
+        activities = runningData.get("activities", [])
+
+    if not activities:
+        raise HTTPException(
+            status_code=404,
+            detail=ErrorResponse(
+                message="No running data to analyse",
+                error_code="USER_DATA_UNAVAILABLE",
+            ).model_dump(),
+        )
+
+    return {"success": True, "analytics": computeRunAnalytics(activities)}
+
+
+@app.get("/volume")
+def get_training_volume(
+    athlete_id: int,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    period: str = "week",
+):
+    """Distance, time, climb and heart rate rolled up per day, week or month (YYYY-MM-DD range)"""
+    index = getVolumeIndex(athlete_id)
+    try:
+        rollups = index.rollups(athlete_id, period, start, end)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=ErrorResponse(
+                message=str(e), error_code="VALIDATION_ERROR"
+            ).model_dump(),
+        )
+
+    return {
+        "success": True,
+        "period": period,
+        "rollups": rollups,
+        "longest_run": index.longestRun(athlete_id, start, end),
+    }
+
+
+@app.get("/stats")
+def get_stats():
+    """Counters for token reuse, strava quota usage, coalesced requests and the gemini breaker"""
+    return {
+        "strava_tokens": tokenManager.stats(),
+        "strava_scheduler": stravaScheduler.stats(),
+        "coalescing": {
+            "runner": runnerFlight.stats(),
+            "gemini_analysis": analysisFlight.stats(),
+            "gemini_plan": planFlight.stats(),
+            "activity_streams": streamsFlight.stats(),
+        },
+        "gemini_breaker": geminiBreaker.stats(),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Stage latency histograms, retry, rate limit and gemini token counters for prometheus"""
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/traces")
+def get_traces(limit: int = 20):
+    """The most recent request traces, each span with its parent and duration"""
+    return {"traces": recentTraces(limit)}
+
+
 @app.get("/gemini-analysis")
-def generate_ai_analysis():
+def generate_ai_analysis(athlete_id: int):
     try:
-        geminiData = getGeminiAnalysis()
+        geminiData = getGeminiAnalysis(athlete_id)
         if not geminiData:
             raise HTTPException(
                 status_code=503,
@@ -268,35 +619,31 @@ def generate_ai_analysis():
 
 
 @app.get("/gemini-plan")
-def generate_runner_plan(validate: bool = True):
+def generate_runner_plan(athlete_id: int):
     try:
-        geminiData = getGeminiPlan()
-        if not geminiData:
+        geminiData = getHedgedPlan(athlete_id)
+        if not geminiData["status"]:
             raise HTTPException(
                 status_code=503,
                 detail=ErrorResponse(
                     message=geminiData["message"], error_code=geminiData["error_code"]
-                ),
+                ).model_dump(),
             )
-        planDict = json.loads(geminiData["plan"])
-
-        if not validate:
-            return AiRawResponse(planData=planDict)
 
-        try:
-            plan = RunningPlan(**planDict)
-            return AiSuccessResponse(planData=plan)
-        except ValidationError as e:
-            warnings = [f"Validation warning: {error['msg']}" for error in e.errors()]
-            print(f"Plan validation warnings: {warnings}")
-
-            return AiRawResponse(
-                planData=planDict,
-                message="Plan and analaysis generated with validation warnings",
-                validationWarnings=warnings,
-            )
+        # the plan was validated when it was built, it is serialized once here
+        response = AiSuccessResponse(
+            planData=geminiData["plan"],
+            message=geminiData["message"],
+            source=geminiData["source"],
+            planVersion=geminiData["planVersion"],
+        )
+        return Response(
+            content=response.model_dump_json(), media_type="application/json"
+        )
 
-    except json.JSONDecodeError as e:
+    except HTTPException:
+        raise
+    except ValidationError as e:
         raise HTTPException(
             status_code=500,
             detail=ErrorResponse(
@@ -314,6 +661,143 @@ def generate_runner_plan(validate: bool = True):
         )
 
 
+def sseEvent(event, data):
+    """Formats one server sent event, data is sent as a single line of json"""
+    text = data.model_dump_json() if isinstance(data, BaseModel) else json.dumps(data)
+    return f"event: {event}\ndata: {text}\n\n"
+
+
+def sseResponse(events):
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/plan")
+def get_stored_plan(athlete_id: int):
+    """The athletes current plan and its version, a changed version means it was replaced"""
+    plan = planStore.get(athlete_id)
+    if plan is None:
+        raise HTTPException(
+            status_code=404,
+            detail=ErrorResponse(
+                message="No plan stored for this athlete", error_code="PLAN_NOT_FOUND"
+            ).model_dump(),
+        )
+
+    return {
+        "success": True,
+        "planData": plan.model_dump(mode="json"),
+        "planVersion": planStore.version(athlete_id),
+    }
+
+
+@app.get("/gemini-analysis/stream")
+async def stream_ai_analysis(athlete_id: int):
+    """Streams the analysis to the frontend as it is generated"""
+    generator = getPlanGenerator(athlete_id)
+    if not await run_in_threadpool(generator.initialise):
+        raise HTTPException(
+            status_code=503,
+            detail=ErrorResponse(
+                message="Could not gather user running data",
+                error_code="USER_DATA_UNAVAILABLE",
+            ).model_dump(),
+        )
+
+    async def events():
+        try:
+            async for text in generator.streamAnalysis():
+                yield sseEvent("chunk", {"text": text})
+        except Exception as e:
+            print(f"Analysis stream failed: {e}")
+            yield sseEvent(
+                "error",
+                {
+                    "message": "Data analysis failed",
+                    "error_code": "DATA_ANALYSIS_UNAVAILABLE",
+                },
+            )
+            return
+        yield sseEvent("done", {"success": True})
+
+    return sseResponse(events())
+
+
+@app.get("/gemini-plan/stream")
+async def stream_runner_plan(athlete_id: int):
+    """
+    Streams each week of the plan once generated and validated, the complete plan
+    follows in the done event. If gemini has not produced a week inside the latency
+    budget, or the stream fails, the local plan is sent as the done event instead.
+    """
+    generator = getPlanGenerator(athlete_id)
+    if generator.get_analysis() is None:
+        raise HTTPException(
+            status_code=503,
+            detail=ErrorResponse(
+                message="Could not find analysis",
+                error_code="PLAN_GENERATION_UNAVAILABLE",
+            ).model_dump(),
+        )
+
+    async def localPlanEvent(outcome):
+        localData = await run_in_threadpool(getLocalPlan, athlete_id)
+        if not localData["status"]:
+            return sseEvent(
+                "error",
+                {
+                    "message": "Plan Generation Failed",
+                    "error_code": "PLAN_GENERATION_UNAVAILABLE",
+                },
+            )
+
+        planHedged.inc(outcome=outcome)
+        version = planStore.set(athlete_id, localData["plan"])
+        return sseEvent(
+            "done",
+            AiSuccessResponse(
+                planData=localData["plan"],
+                message=localData["message"],
+                source="local",
+                planVersion=version,
+            ),
+        )
+
+    async def events():
+        weeks = generator.streamPlan().__aiter__()
+        try:
+            # the budget covers the wait for the first week, once weeks are arriving
+            # the client can see gemini making progress
+            week = await asyncio.wait_for(
+                anext(weeks, None), GEMINI_PLAN_LATENCY_BUDGET or None
+            )
+            while week is not None:
+                yield sseEvent("week", week)
+                week = await anext(weeks, None)
+        except asyncio.TimeoutError:
+            print(f"Plan stream missed the {GEMINI_PLAN_LATENCY_BUDGET}s budget")
+            yield await localPlanEvent("timeout")
+            return
+        except Exception as e:
+            print(f"Plan stream failed: {e}")
+            yield await localPlanEvent("failed")
+            return
+        finally:
+            await weeks.aclose()
+
+        yield sseEvent(
+            "done",
+            AiSuccessResponse(
+                planData=generator.get_plan(), planVersion=generator.planVersion
+            ),
+        )
+
+    return sseResponse(events())
+
+
 @app.get("/google-auth")
 async def google_auth(user_id: str):
     if not user_id:
@@ -346,7 +830,7 @@ async def google_auth(user_id: str):
     )
 
     # Store the state for validation (you can also store user_id here if needed)
-    userTokens[state] = {"user_id": user_id, "state": state}
+    oauthStates[state] = {"user_id": user_id, "state": state}
 
     return {"auth_url": auth_url}
 
@@ -367,7 +851,7 @@ async def google_callback(request: Request):
     user_id = state.split(":", 1)[1]
 
     # Validate that we have this state stored
-    if state not in userTokens:
+    if state not in oauthStates:
         raise HTTPException(
             status_code=400, detail="Invalid or expired state parameter"
         )
@@ -394,18 +878,10 @@ async def google_callback(request: Request):
     creds = flow.credentials
 
     # Store credentials under user_id
-    userTokens[user_id] = {
-        "token": creds.token,
-        "refresh_token": creds.refresh_token,
-        "token_uri": creds.token_uri,
-        "client_id": creds.client_id,
-        "client_secret": creds.client_secret,
-        "scopes": creds.scopes,
-    }
+    googleTokens.save(user_id, googleCredsToDict(creds))
 
     # Clean up the state entry
-    if state in userTokens:
-        del userTokens[state]
+    oauthStates.pop(state, None)
 
     return RedirectResponse(
         url=f"http://localhost:5173/?google=success&user_id={user_id}"
@@ -413,22 +889,84 @@ async def google_callback(request: Request):
 
 
 @app.post("/times")
-def valTimes(times: Times):
-    try:
-        print(times)
-        inputCalTimeTimeZone(times.startTime, times.timeZone)
-        print("success")
+def valTimes(times: Times, athlete_id: int):
+    """Exports the athletes plan to their google calendar, reporting every write that failed"""
+    calEventManager = calendarEventManager(str(athlete_id), athlete_id)
+    if not (
+        calEventManager.validatedStartTime(times.startTime)
+        and calEventManager.validatedUserTimeZone(times.timeZone)
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail=ErrorResponse(
+                message="Invalid start time or time zone",
+                error_code="VALIDATION_ERROR",
+            ).model_dump(),
+        )
+    if not calEventManager.loadUserCredentials():
+        raise HTTPException(
+            status_code=401,
+            detail=ErrorResponse(
+                message="Authenticate with google calendar first",
+                error_code="GOOGLE_AUTH_REQUIRED",
+            ).model_dump(),
+        )
+    if not calEventManager.loadTrainingPlan():
+        raise HTTPException(
+            status_code=404,
+            detail=ErrorResponse(
+                message="No training plan to export", error_code="PLAN_NOT_FOUND"
+            ).model_dump(),
+        )
 
-        return {
-            "message": "Calendar uploaded successfully to google calendar",
-            "data": times,
-        }
-    except Exception as e:
-        raise HTTPException(status_code=400, detail="Calendar upload failed")
+    result = calEventManager.createCalEvents()
+    if not result:
+        raise HTTPException(
+            status_code=502,
+            detail=ErrorResponse(
+                message="Calendar upload failed", error_code="CALENDAR_UNAVAILABLE"
+            ).model_dump(),
+        )
+    if result["failed"]:
+        raise HTTPException(
+            status_code=502,
+            detail=ErrorResponse(
+                message=f"{len(result['failed'])} calendar events could not be written",
+                error_code="CALENDAR_EXPORT_INCOMPLETE",
+                details=result,
+            ).model_dump(),
+        )
+
+    return {
+        "message": "Calendar uploaded successfully to google calendar",
+        "data": times,
+        "result": result,
+    }
 
 
 class StravaDataManager:
-    def __init__(self):
+    def __init__(
+        self,
+        athleteId=None,
+        onProgress=None,
+        maxWorkers=STRAVA_FETCH_WORKERS,
+        store=activityStore,
+        segments=activitySegments,
+        streams=activityStreams if STRAVA_FETCH_STREAMS else None,
+        volume=volumeIndex,
+        runCount=10,
+        pageSize=STRAVA_PAGE_SIZE,
+    ):
+        self.athleteId = athleteId
+        # called as onProgress(stage=..., done=..., total=...) by background syncs
+        self.onProgress = onProgress or (lambda **progress: None)
+        self.maxWorkers = maxWorkers
+        self.store = store
+        self.segments = segments
+        self.streams = streams
+        self.volume = volume
+        self.runCount = runCount
+        self.pageSize = pageSize
         self.stravaClient = None
         self.athleteInfo = None
         self.activityData = []
@@ -438,7 +976,9 @@ class StravaDataManager:
     def authenticate(self):
         """Handle Strava Authentication"""
         try:
-            self.stravaClient = getAuthenticatedUser()
+            self.stravaClient = getAuthenticatedUser(self.athleteId)
+            if self.stravaClient is None:
+                return False
             self.athleteInfo = getAthleteinfo(self.stravaClient)
 
             if self.athleteInfo:
@@ -457,7 +997,9 @@ class StravaDataManager:
             print("Please Authenticate First")
             return False
 
-        run_ids = gatherLastRunsFromTen(self.stravaClient)
+        run_ids = gatherLastRunsFromTen(
+            self.stravaClient, count=count, pageSize=self.pageSize
+        )
 
         if isinstance(run_ids, str):  # error message returned
             print(run_ids)
@@ -466,53 +1008,150 @@ class StravaDataManager:
         return run_ids
 
     def processActivities(self, run_ids):
-        """Process multiple activies giving progress reports"""
+        """Process multiple activies concurrently giving progress reports"""
         self.activityData = []
         self.failedActivities = []
 
-        print(f"Processing {len(run_ids)} runs...")
+        print(f"Processing {len(run_ids)} runs with {self.maxWorkers} workers...")
+        self.onProgress(stage="processing", done=0, total=len(run_ids))
 
-        for i, run in enumerate(run_ids, 1):
-            print(f"\n---Processing run {i}/{len(run_ids)} ---")
+        def fetch(run):
             activity = processActivityData(self.stravaClient, run)
-
-            if activity:
-                self.activityData.append(activity)
-                print(f"✓ Successfully processed activity {run}")
-            else:
-                self.failedActivities.append(run)
-                print(f"✗ Failed to process activity {run}")
-
-            # delay to help request rates on strava api
-            time.sleep(0.5)
+            if activity and self.streams is not None:
+                self.fetchStreams(run)
+            return activity
+
+        # map keeps the results in the same order as run_ids
+        with ThreadPoolExecutor(max_workers=max(1, self.maxWorkers)) as executor:
+            results = executor.map(carryContext(fetch), run_ids)
+
+            for i, (run, activity) in enumerate(zip(run_ids, results), 1):
+                print(f"\n---Processed run {i}/{len(run_ids)} ---")
+                self.onProgress(done=i)
+                if activity:
+                    self.activityData.append(activity)
+                    print(f"✓ Successfully processed activity {run}")
+                else:
+                    self.failedActivities.append(run)
+                    print(f"✗ Failed to process activity {run}")
 
         self._printProcessingSummary()
         return len(self.activityData) > 0
 
-    def saveDataToFile(self):
-        """dumps json data to an external JSON file"""
+    def fetchStreams(self, activityId):
+        """Stores an activities per second streams, a failure here keeps the activity"""
+        try:
+            streams = fetchActivityStreams(self.stravaClient, activityId)
+            if streams:
+                self.streams.save(self.athleteInfo["id"], activityId, streams)
+        except Exception as e:
+            print(f"Failed to fetch streams for activity {activityId}: {e}")
 
-        if not self.activityData:
-            print("No activities to save.")
+    def loadCachedData(self):
+        """Serves activities from the local store when it is fresh, no strava calls"""
+        athleteId = self.athleteId
+        if athleteId is None:
             return False
 
-        dumpJsonFile(self.activityData)
-        print(f"Successfully saved {len(self.activityData)} activities to JSON file")
+        if not self.store.isFresh(athleteId, STRAVA_SYNC_INTERVAL):
+            return False
+
+        self.athleteInfo = self.store.getAthlete(athleteId)
+        self.activityData = self.segments.loadActivities(athleteId, limit=self.runCount)
+        self.failedActivities = []
+
+        if self.athleteInfo and self.activityData:
+            print(f"Serving {len(self.activityData)} cached activities")
+            return True
+        return False
+
+    def syncActivities(self):
+        """Fetches only runs newer than the last sync plus any edited runs"""
+        if not self.isAuthenticated:
+            print("Please Authenticate First")
+            return False
+
+        athleteId = self.athleteInfo["id"]
+        self.store.saveAthlete(self.athleteInfo)
+
+        latest = self.store.latestStartTime(athleteId)
+        after = (
+            datetime.fromtimestamp(latest, tz=timezone.utc)
+            if latest is not None
+            else None
+        )
+
+        with span("strava.list"):
+            newRuns = iterRuns(
+                self.stravaClient,
+                count=self.runCount,
+                after=after,
+                pageSize=self.pageSize,
+            )
+            startTimes = {run.id: run.start_date.timestamp() for run in newRuns}
+
+        runIds = list(startTimes)
+        runIds += [
+            activityId
+            for activityId in self.store.getStaleActivityIds(athleteId)
+            if activityId not in startTimes
+        ]
+
+        # the old single user json file only ever goes to the athlete it belongs to
+        self.segments.migrateLegacyFile(athleteId, legacyTokenOwner())
+
+        if runIds:
+            self.processActivities(runIds)
+            self.onProgress(stage="saving")
+            self.saveActivities(athleteId, startTimes)
+        else:
+            print("No new activities since last sync")
+
+        failed = self.failedActivities
+        self.store.markSynced(athleteId)
+
+        self.activityData = self.segments.loadActivities(athleteId, limit=self.runCount)
+        self.failedActivities = failed
+
+        if not self.activityData:
+            print("No runs found, get running to gather data")
+            return False
         return True
 
+    def saveActivities(self, athleteId, startTimes):
+        """
+        Appends new and edited runs to the columnar activity store, which holds the
+        only copy of them, and records them as synced
+        """
+        if not self.activityData:
+            print("No activities to save.")
+            return
+
+        self.segments.append(athleteId, self.activityData)
+        self.store.recordActivities(
+            athleteId, [activity.id for activity in self.activityData], startTimes
+        )
+        self.volume.recordActivities(athleteId, self.activityData)
+        print(
+            f"Successfully saved {len(self.activityData)} activities to the activity store"
+        )
+
     def gatherAndProcessAllData(self):
         """Combines all function for ease of use in main function"""
-        if not self.authenticate():
-            return False
+        if self.loadCachedData():
+            self.onProgress(stage="complete")
+            return True
 
-        runsIds = self.gatherRecentRuns()
-        if not runsIds:
+        self.onProgress(stage="authenticating")
+        if not self.authenticate():
             return False
 
-        if not self.processActivities(runsIds):
+        self.onProgress(stage="listing")
+        if not self.syncActivities():
             return False
 
-        return self.saveDataToFile()
+        self.onProgress(stage="complete")
+        return True
 
     def _printProcessingSummary(self):
         """Private Method to print summary of process"""
@@ -535,18 +1174,20 @@ class StravaDataManager:
 
 
 class RunningPlanGeneratorManager:
-    def __init__(self):
+    def __init__(self, athleteId):
+        self.athleteId = athleteId
         self.geminiClient = None
         self.runningData = None
         self.analysis = None
         self.plan = None
+        self.planVersion = None
         self.isInitialised = None
 
     def initialise(self):
         """Initialise the ai agent with data from Strava"""
         try:
             self.geminiClient = getGenAiClient()
-            self.runningData = readRunningData()
+            self.runningData = loadRunningData(self.athleteId)
             if self.runningData and self.geminiClient:
                 self.isInitialised = True
                 return True
@@ -562,7 +1203,9 @@ class RunningPlanGeneratorManager:
             print("Please Initialise first")
             return False
 
-        self.analysis = runningAnalysis(self.geminiClient, self.runningData)
+        self.analysis = runningAnalysis(
+            self.geminiClient, self.runningData, cache=geminiCache
+        )
 
         if self.analysis is not None:  # ADD THIS CHECK
             return True
@@ -571,7 +1214,7 @@ class RunningPlanGeneratorManager:
             return False
 
     def generatePlan(self):
-        """Generates a 5 week running plan"""
+        """Generates a PLAN_WEEKS week running plan"""
         if not self.isInitialised:
             print("Please Initialise first")
             return False
@@ -581,13 +1224,47 @@ class RunningPlanGeneratorManager:
             return False
 
         print(
-            "I will now be generating a 5 week plan, based on the analysis for you to get quicker."
+            f"I will now be generating a {PLAN_WEEKS} week plan, based on the analysis for you to get quicker."
         )
         print("Generating...")
 
-        self.plan = runningPlan(self.geminiClient, self.analysis)
+        self.plan = runningPlan(self.geminiClient, self.analysis, cache=geminiCache)
         return self.plan is not None
 
+    async def streamAnalysis(self):
+        """Streaming version of Analyse, yields text chunks as they arrive"""
+        if not self.isInitialised:
+            print("Please Initialise first")
+            return
+
+        chunks = []
+        async for text in streamRunningAnalysis(
+            self.geminiClient, self.runningData, cache=geminiCache
+        ):
+            chunks.append(text)
+            yield text
+
+        self.analysis = "".join(chunks)
+
+    async def streamPlan(self):
+        """Streaming version of generatePlan, yields each week as soon as it is generated"""
+        if not self.analysis:
+            print("Please analyse data first")
+            return
+
+        if self.geminiClient is None:
+            self.geminiClient = getGenAiClient()
+
+        weeks = []
+        async for week in streamRunningPlan(
+            self.geminiClient, self.analysis, cache=geminiCache
+        ):
+            weeks.append(week)
+            yield week
+
+        self.plan = TrainingPlan(weeks=weeks)
+        self.planVersion = planStore.set(self.athleteId, self.plan)
+
     # data getters
 
     def get_analysis(self):
@@ -597,12 +1274,25 @@ class RunningPlanGeneratorManager:
         return self.plan
 
 
-runningPlanGenerator = RunningPlanGeneratorManager()
+# One generator per athlete, so one athlete's analysis never feeds another's plan
+planGenerators = {}
+planGeneratorsLock = threading.Lock()
+
+
+def getPlanGenerator(athleteId):
+    with planGeneratorsLock:
+        generator = planGenerators.get(athleteId)
+        if generator is None:
+            generator = planGenerators[athleteId] = RunningPlanGeneratorManager(
+                athleteId
+            )
+        return generator
 
 
 class calendarEventManager:
-    def __init__(self, user_id: str):
+    def __init__(self, user_id: str, athleteId=None):
         self.userId = user_id
+        self.athleteId = athleteId
         self.userCreds = None
         self.trainingPlan = None
         self.userTimeZone = None
@@ -620,7 +1310,9 @@ class calendarEventManager:
             return False
 
     def loadTrainingPlan(self):
-        self.trainingPlan = gettrainingPlan()
+        # the plan in memory is exported as is, the old plan file is only a fallback
+        plan = planStore.get(self.athleteId)
+        self.trainingPlan = {"plan": plan} if plan is not None else gettrainingPlan()
         if "error" in self.trainingPlan:
             print(f"Error loading training plan: {self.trainingPlan['error']}")
             return False
@@ -641,12 +1333,15 @@ class calendarEventManager:
         print(
             f"\nCreating calendar events for {self.activityStartTime} in {self.userTimeZone}..."
         )
-        if createCalendarEvents(
-            self.trainingPlan, self.userCreds, self.userTimeZone, self.activityStartTime
-        ):
-            return True
-        else:
-            return False
+        # the counts written and any calls that failed, False if google was unreachable
+        return createCalendarEvents(
+            self.trainingPlan,
+            self.userCreds,
+            self.userTimeZone,
+            self.activityStartTime,
+            reconcile=True,
+            owner=self.userId,
+        )
 
     def validatedUserTimeZone(self, inputtedTimeZone):
         if validate_timezone(inputtedTimeZone):
@@ -667,8 +1362,12 @@ class calendarEventManager:
         return self.userCreds
 
 
-def getStravaData():
-    stravaManager = StravaDataManager()
+def getStravaData(athleteId):
+    return runnerFlight.do(athleteId, _getStravaData, athleteId)
+
+
+def _getStravaData(athleteId):
+    stravaManager = StravaDataManager(athleteId)
     hasGatheredStravaData = stravaManager.gatherAndProcessAllData()
 
     if hasGatheredStravaData:
@@ -686,10 +1385,97 @@ def getStravaData():
         return "Failed to retrieve strava user details"
 
 
-def getGeminiAnalysis():
-    if runningPlanGenerator.initialise():
-        if runningPlanGenerator.Analyse():
-            runAnalysis = runningPlanGenerator.get_analysis()
+def buildRunnerDetails(strava_data):
+    return StravaUserDetails(
+        runnerId=strava_data["athlete_info"]["id"],
+        runnerName=(
+            strava_data["athlete_info"]["firstname"]
+            + " "
+            + strava_data["athlete_info"]["lastname"]
+        ),
+        activities=strava_data["user_data"],
+        failedActivites=strava_data["failed_activities"],
+    )
+
+
+def runStravaSync(job, athleteId):
+    """Background job body, the same pipeline as /runner reporting progress on the job"""
+    stravaManager = StravaDataManager(athleteId, onProgress=job.update)
+    if not stravaManager.gatherAndProcessAllData():
+        raise RuntimeError("Failed to retrieve strava user details")
+
+    return buildRunnerDetails(
+        {
+            "athlete_info": stravaManager.getAthleteInfo(),
+            "user_data": stravaManager.getActivityData(),
+            "failed_activities": stravaManager.getFailedActivities(),
+        }
+    )
+
+
+def runStravaBackfill(job, athleteId, restart=False):
+    """Background job body for a full history backfill"""
+    job.update(stage="authenticating")
+    client = getAuthenticatedUser(athleteId)
+    if client is None:
+        raise RuntimeError("Failed to authenticate with strava")
+
+    checkpoint = BackfillCheckpoint(athleteId)
+    if restart:
+        checkpoint.reset()
+
+    summary = backfillHistory(
+        client,
+        athleteId,
+        activitySegments,
+        store=activityStore,
+        volume=volumeIndex,
+        checkpoint=checkpoint,
+        maxWorkers=STRAVA_FETCH_WORKERS,
+        onProgress=job.update,
+    )
+    job.update(stage="complete")
+    return summary
+
+
+def getVolumeIndex(athleteId, index=volumeIndex, segments=activitySegments):
+    """
+    The volume index after indexing any stored run it has no figures for, such as
+    history synced or migrated before the index existed
+    """
+    stored = set(segments.query(athleteId, ("id",))["id"].tolist())
+    missing = stored - index.activityIds(athleteId)
+    if missing:
+        index.recordActivities(
+            athleteId, segments.loadActivities(athleteId, ids=missing)
+        )
+    return index
+
+
+def loadRunningData(athleteId):
+    """The athletes latest runs from the columnar store, empty when there are none"""
+    runningData = activitySegments.readRunningData(
+        athleteId, legacyOwner=legacyTokenOwner()
+    )
+    if runningData:
+        runningData["volume"] = getVolumeIndex(athleteId).recentWeeks(athleteId)
+        return runningData
+    return {}
+
+
+def getGeminiAnalysis(athleteId):
+    # keyed by the running data the analysis would be generated from
+    runningData = loadRunningData(athleteId)
+    fingerprint = (athleteId, analysisCacheKey(runningData))
+    return analysisFlight.do(
+        fingerprint, _getGeminiAnalysis, getPlanGenerator(athleteId)
+    )
+
+
+def _getGeminiAnalysis(generator):
+    if generator.initialise():
+        if generator.Analyse():
+            runAnalysis = generator.get_analysis()
             aiDict = {
                 "analysis": runAnalysis,
                 "message": "Analysis Generation successful",
@@ -711,10 +1497,20 @@ def getGeminiAnalysis():
     return aiDict
 
 
-def getGeminiPlan():
-    if runningPlanGenerator.get_analysis() is not None:
-        if runningPlanGenerator.generatePlan():
-            plan = runningPlanGenerator.get_plan()
+def getGeminiPlan(athleteId):
+    generator = getPlanGenerator(athleteId)
+    analysis = generator.get_analysis()
+    if analysis is None:
+        return _getGeminiPlan(generator)
+
+    fingerprint = (athleteId, planCacheKey(analysis, datetime.now()))
+    return planFlight.do(fingerprint, _getGeminiPlan, generator)
+
+
+def _getGeminiPlan(generator):
+    if generator.get_analysis() is not None:
+        if generator.generatePlan():
+            plan = generator.get_plan()
             aiDict = {
                 "plan": plan,
                 "message": "Analysis and plan Generation successful",
@@ -735,23 +1531,87 @@ def getGeminiPlan():
     return aiDict
 
 
-def inputCalTimeTimeZone(time, timeZone):
-    # Update function to post to google calendar,
-    calEventManager = calendarEventManager()
-    timeValid = calEventManager.validatedStartTime(time)
-    timeZoneValid = calEventManager.validatedUserTimeZone(timeZone)
+def getLocalPlan(athleteId):
+    """The rule based plan from the recent running data, no gemini involved"""
+    runningData = getPlanGenerator(athleteId).runningData or loadRunningData(athleteId)
+    if not runningData or not runningData.get("activities"):
+        return {
+            "message": "Could not gather user running data",
+            "status": False,
+            "error_code": "USER_DATA_UNAVAILABLE",
+        }
 
-    print(timeValid, timeZoneValid)
+    with span("plan.local"):
+        plan = buildLocalPlan(runningData)
+    return {
+        "plan": plan,
+        "message": "Gemini was unavailable, plan built from your recent runs",
+        "status": True,
+    }
 
-    return timeValid and timeZoneValid
 
+def getHedgedPlan(athleteId):
+    """
+    Gemini's plan when it arrives inside the latency budget, otherwise the local plan
+    at once while gemini carries on in the background. With GEMINI_PLAN_SWAP_IN the
+    gemini plan replaces the local one in the plan store when it does arrive, but only
+    if the local plan is still the one stored. The swap gives the plan a new version,
+    which is how the client sees it through GET /plan, and a later request is then
+    answered from the gemini cache.
+    """
+    future = planHedgeExecutor.submit(carryContext(getGeminiPlan), athleteId)
 
-def get_user_credentials(user_id: str) -> Credentials:
-    data = userTokens.get(user_id)
+    try:
+        geminiData = future.result(timeout=GEMINI_PLAN_LATENCY_BUDGET or None)
+    except FuturesTimeout:
+        print(f"Gemini plan missed the {GEMINI_PLAN_LATENCY_BUDGET}s budget")
+        geminiData = None
+    except Exception as e:
+        print(f"Gemini plan failed: {e}")
+        geminiData = None
 
-    if not data:
-        raise Exception("User not authenticated with google calendar")
+    if geminiData and geminiData["status"]:
+        version = planStore.set(athleteId, geminiData["plan"])
+        return dict(geminiData, source="gemini", planVersion=version)
+
+    localData = getLocalPlan(athleteId)
+    if not localData["status"]:
+        return geminiData or localData
+
+    planHedged.inc(outcome="timeout" if not future.done() else "failed")
+    localVersion = planStore.set(athleteId, localData["plan"])
+
+    if GEMINI_PLAN_SWAP_IN and not future.done():
+
+        def swapIn(done):
+            if done.exception() is not None or not done.result()["status"]:
+                return
+            # a plan stored since, e.g. from the stream, is newer than this one
+            if planStore.set(athleteId, done.result()["plan"], ifVersion=localVersion):
+                print("Gemini plan arrived, replacing the local plan")
+            else:
+                print(
+                    "Gemini plan arrived after a newer plan was stored, not swapped in"
+                )
+
+        future.add_done_callback(swapIn)
+
+    return dict(localData, source="local", planVersion=localVersion)
 
+
+def googleCredsToDict(creds):
+    return {
+        "token": creds.token,
+        "refresh_token": creds.refresh_token,
+        "token_uri": creds.token_uri,
+        "client_id": creds.client_id,
+        "client_secret": creds.client_secret,
+        "scopes": creds.scopes,
+        "expiry": creds.expiry.isoformat() if creds.expiry else None,
+    }
+
+
+def googleCredsFromDict(data):
     return Credentials(
         token=data["token"],
         refresh_token=data["refresh_token"],
@@ -759,8 +1619,36 @@ def get_user_credentials(user_id: str) -> Credentials:
         client_id=data["client_id"],
         client_secret=data["client_secret"],
         scopes=data["scopes"],
+        expiry=datetime.fromisoformat(data["expiry"]) if data.get("expiry") else None,
     )
 
 
+def refreshGoogleTokens(data):
+    creds = googleCredsFromDict(data)
+    with span("google.token_refresh"):
+        creds.refresh(GoogleRequest())
+    return googleCredsToDict(creds)
+
+
+def get_user_credentials(user_id: str) -> Credentials:
+    data = googleTokens.get(user_id)
+
+    if not data:
+        raise Exception("User not authenticated with google calendar")
+
+    creds = googleCredsFromDict(data)
+    if creds.expired:
+        # concurrent requests for this user share a single refresh
+        creds = googleCredsFromDict(
+            googleTokens.refresh(
+                user_id,
+                refreshGoogleTokens,
+                isFresh=lambda tokens: not googleCredsFromDict(tokens).expired,
+            )
+        )
+
+    return creds
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
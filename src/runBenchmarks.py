@@ -0,0 +1,337 @@
+"""
+End to end benchmarks against the in process fakes in FakeServices, no network or
+credentials needed. Every stage is repeated and timed and the results are written as
+json so runs can be compared for regressions:
+
+    python runBenchmarks.py --activities 200 --latency 0.02 --output bench.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+current_dir = Path(__file__).resolve().parent
+sys.path.insert(0, str(current_dir))
+
+from FakeServices import (  # noqa: E402
+    FakeCalendarService,
+    FakeGenAiClient,
+    FakeStravaClient,
+    FaultInjector,
+    fakeTrainingPlan,
+)
+
+# plan pipeline stages are too quick to time one at a time, each run is this many requests
+PLAN_PIPELINE_REQUESTS = 100
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--activities", type=int, default=100, help="runs in the fake history"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="timed runs of each stage"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.01, help="seconds added per call"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="extra random seconds per call"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="share of calls failing"
+    )
+    parser.add_argument(
+        "--throttle-rate", type=float, default=0.0, help="share of calls getting 429"
+    )
+    parser.add_argument(
+        "--hang-rate", type=float, default=0.0, help="share of calls that hang"
+    )
+    parser.add_argument(
+        "--hang-seconds", type=float, default=5.0, help="how long a hung call stalls"
+    )
+    parser.add_argument(
+        "--gemini-latency", type=float, default=None, help="override latency for gemini"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", default=None, help="json file for the results, stdout if unset"
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="keep the app's own print output"
+    )
+    return parser.parse_args()
+
+
+def legacyPlanPipeline(responseText, planPath):
+    """
+    What one plan request used to cost after gemini answered, kept as the baseline:
+    parsed, dumped to an indented string, written to the plan file, parsed again for
+    the response, validated, encoded, then read back from the file for the calendar
+    """
+    from fastapi.encoders import jsonable_encoder
+    from main import AiSuccessResponse
+    from PlanModels import TrainingPlan
+
+    planDict = json.loads(responseText)
+    planText = json.dumps(planDict, indent=2)
+    with open(planPath, "w") as f:
+        json.dump(planDict, f, indent=2)
+    plan = TrainingPlan(**json.loads(planText))
+    json.dumps(jsonable_encoder(AiSuccessResponse(planData=plan)))
+    with open(planPath, "r") as f:
+        json.load(f)
+
+
+def typedPlanPipeline(responseText, store):
+    """The same request now, validated once, kept in memory and serialized once"""
+    from main import AiSuccessResponse
+    from PlanModels import TrainingPlan
+
+    plan = TrainingPlan.model_validate_json(responseText)
+    store.set("bench", plan)
+    AiSuccessResponse(planData=store.get("bench")).model_dump_json()
+
+
+class Stage:
+    """Collects the timings and failures of one benchmarked stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.timings = []
+        self.errors = []
+
+    def run(self, fn, quiet=True):
+        output = io.StringIO() if quiet else None
+        started = time.perf_counter()
+        try:
+            with (
+                contextlib.redirect_stdout(output)
+                if quiet
+                else contextlib.nullcontext()
+            ):
+                ok = fn()
+            if ok is False:
+                self.errors.append("stage returned False")
+        except Exception as e:
+            self.errors.append(f"{type(e).__name__}: {e}")
+        self.timings.append(time.perf_counter() - started)
+
+    def summary(self):
+        ms = [timing * 1000 for timing in self.timings]
+        return {
+            "runs": len(ms),
+            "errors": len(self.errors),
+            "error_messages": sorted(set(self.errors))[:5],
+            "min_ms": round(min(ms), 2) if ms else None,
+            "median_ms": round(statistics.median(ms), 2) if ms else None,
+            "mean_ms": round(statistics.fmean(ms), 2) if ms else None,
+            "max_ms": round(max(ms), 2) if ms else None,
+        }
+
+
+def runBenchmarks(args):
+    faultArgs = {
+        "jitter": args.jitter,
+        "errorRate": args.error_rate,
+        "throttleRate": args.throttle_rate,
+        "hangRate": args.hang_rate,
+        "hangSeconds": args.hang_seconds,
+    }
+    # separate seeds so each service sees its own sequence of faults
+    stravaFaults = FaultInjector(latency=args.latency, seed=args.seed, **faultArgs)
+    geminiLatency = args.latency if args.gemini_latency is None else args.gemini_latency
+    geminiFaults = FaultInjector(latency=geminiLatency, seed=args.seed + 1, **faultArgs)
+    calendarFaults = FaultInjector(
+        latency=args.latency, seed=args.seed + 2, **faultArgs
+    )
+
+    stravaClient = FakeStravaClient(args.activities, stravaFaults, seed=args.seed)
+    genaiClient = FakeGenAiClient(geminiFaults)
+    athleteId = stravaClient.athleteId
+
+    # the app keeps its stores relative to the working directory, use a scratch one
+    workDir = tempfile.mkdtemp(prefix="strava-bench-")
+    os.chdir(workDir)
+
+    with contextlib.redirect_stdout(None if args.verbose else io.StringIO()):
+        import main
+        import assignCalendarEvent
+        from ActivityStore import ActivityStore
+        from ColumnarActivityStore import ColumnarActivityStore
+        from PlanStore import PlanStore
+        from VolumeIndex import VolumeIndex
+        from fastapi.testclient import TestClient
+
+    main.getAuthenticatedUser = lambda athleteId: stravaClient
+    main.getGenAiClient = lambda: genaiClient
+
+    stages = {}
+
+    def stage(name):
+        return stages.setdefault(name, Stage(name))
+
+    quiet = not args.verbose
+
+    for i in range(args.repeat):
+        # a cold sync starts from empty stores, a warm one finds everything cached
+        def coldSync(i=i):
+            manager = main.StravaDataManager(
+                athleteId,
+                store=ActivityStore(f"cold-{i}.db"),
+                segments=ColumnarActivityStore(f"cold-segments-{i}"),
+                volume=VolumeIndex(f"cold-{i}.db"),
+            )
+            return manager.gatherAndProcessAllData()
+
+        stage("strava_sync_cold").run(coldSync, quiet)
+
+    # fills the default stores so the warm and api stages have something cached
+    stage("strava_sync_initial").run(
+        lambda: main.StravaDataManager(athleteId).gatherAndProcessAllData(), quiet
+    )
+    for _ in range(args.repeat):
+        stage("strava_sync_warm").run(
+            lambda: main.StravaDataManager(athleteId).gatherAndProcessAllData(), quiet
+        )
+
+    generator = main.getPlanGenerator(athleteId)
+    for _ in range(args.repeat):
+        main.geminiCache.invalidate()
+        stage("gemini_initialise").run(generator.initialise, quiet)
+        stage("gemini_analyse").run(generator.Analyse, quiet)
+        stage("gemini_generate_plan").run(generator.generatePlan, quiet)
+        stage("local_plan").run(lambda: main.getLocalPlan(athleteId), quiet)
+    main.planStore.set(athleteId, generator.get_plan())
+    main.planStore.flush()
+
+    # parse and serialize cost per request, before and after the typed plan pipeline
+    responseText = json.dumps(fakeTrainingPlan(genaiClient.planWeeks))
+    benchStore = PlanStore("bench-plans")
+    for _ in range(args.repeat):
+        stage("plan_pipeline_legacy_x100").run(
+            lambda: [
+                legacyPlanPipeline(responseText, "bench_plan.json")
+                for _ in range(PLAN_PIPELINE_REQUESTS)
+            ],
+            quiet,
+        )
+        stage("plan_pipeline_typed_x100").run(
+            lambda: [
+                typedPlanPipeline(responseText, benchStore)
+                for _ in range(PLAN_PIPELINE_REQUESTS)
+            ],
+            quiet,
+        )
+    benchStore.flush()
+
+    def exported(result):
+        # an export that left calls failing counts as an error
+        return bool(result) and not result["failed"]
+
+    for _ in range(args.repeat):
+        service = FakeCalendarService(calendarFaults)
+        assignCalendarEvent.build = lambda *a, service=service, **kw: service
+        dataSet = {"plan": main.planStore.get(athleteId)}
+
+        stage("calendar_export").run(
+            lambda dataSet=dataSet: exported(
+                assignCalendarEvent.createCalendarEvents(
+                    dataSet,
+                    None,
+                    "Europe/London",
+                    "07:00:00",
+                    reconcile=True,
+                    owner=athleteId,
+                )
+            ),
+            quiet,
+        )
+        # the same plan again should be a single listing and no writes
+        stage("calendar_reconcile_unchanged").run(
+            lambda dataSet=dataSet: exported(
+                assignCalendarEvent.createCalendarEvents(
+                    dataSet,
+                    None,
+                    "Europe/London",
+                    "07:00:00",
+                    reconcile=True,
+                    owner=athleteId,
+                )
+            ),
+            quiet,
+        )
+
+    client = TestClient(main.app)
+    query = f"athlete_id={athleteId}"
+
+    def request(method, url):
+        def call():
+            response = client.request(method, url)
+            if response.status_code >= 400:
+                raise RuntimeError(f"{method} {url} returned {response.status_code}")
+
+        return call
+
+    for _ in range(args.repeat):
+        main.activityStore.markOutOfDate(athleteId)
+        stage("api_runner_sync").run(request("GET", f"/runner?{query}"), quiet)
+        stage("api_runner_cached").run(request("GET", f"/runner?{query}"), quiet)
+        main.geminiCache.invalidate()
+        stage("api_gemini_analysis").run(
+            request("GET", f"/gemini-analysis?{query}"), quiet
+        )
+        stage("api_gemini_plan").run(request("GET", f"/gemini-plan?{query}"), quiet)
+        stage("api_gemini_analysis_cached").run(
+            request("GET", f"/gemini-analysis?{query}"), quiet
+        )
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {
+            "activities": args.activities,
+            "repeat": args.repeat,
+            "latency_s": args.latency,
+            "gemini_latency_s": geminiLatency,
+            "jitter_s": args.jitter,
+            "error_rate": args.error_rate,
+            "throttle_rate": args.throttle_rate,
+            "hang_rate": args.hang_rate,
+            "hang_seconds": args.hang_seconds,
+            "seed": args.seed,
+            "strava_fetch_workers": main.STRAVA_FETCH_WORKERS,
+        },
+        "stages": {name: s.summary() for name, s in stages.items()},
+        "gemini_breaker": main.geminiBreaker.stats(),
+        "faults": {
+            "strava": stravaFaults.stats(),
+            "gemini": geminiFaults.stats(),
+            "calendar": calendarFaults.stats(),
+        },
+    }
+
+
+if __name__ == "__main__":
+    args = parseArgs()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    results = runBenchmarks(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+        print(f"Benchmark results written to {args.output}")
+    else:
+        print(text)
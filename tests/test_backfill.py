@@ -0,0 +1,33 @@
+from ActivityStore import ActivityStore
+from ColumnarActivityStore import ColumnarActivityStore
+from FakeServices import FakeStravaClient
+from StravaBackfill import BackfillCheckpoint, backfillHistory
+from VolumeIndex import VolumeIndex
+
+
+def test_backfilled_runs_are_recorded_everywhere(tmp_path):
+    client = FakeStravaClient(activityCount=12)
+    athleteId = client.athleteId
+    store = ActivityStore(str(tmp_path / "activities.db"))
+    segments = ColumnarActivityStore(str(tmp_path / "segments"))
+    volume = VolumeIndex(str(tmp_path / "activities.db"))
+
+    summary = backfillHistory(
+        client,
+        athleteId,
+        segments,
+        store=store,
+        volume=volume,
+        checkpoint=BackfillCheckpoint(athleteId, str(tmp_path / "backfill")),
+        maxWorkers=2,
+        batchSize=5,
+        pageSize=5,
+    )
+
+    ids = {activity.id for activity in client.activities}
+    assert summary["complete"]
+    assert {activity["id"] for activity in segments.loadActivities(athleteId)} == ids
+    assert volume.activityIds(athleteId) == ids
+    # the next incremental sync starts after the newest backfilled run
+    newest = max(activity.start_date for activity in client.activities)
+    assert store.latestStartTime(athleteId) == newest.timestamp()
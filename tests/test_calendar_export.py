@@ -0,0 +1,68 @@
+import assignCalendarEvent
+from FakeServices import FakeCalendarService, _FakeEvents, _FakeRequest, _httpError
+from FakeServices import fakeTrainingPlan
+from PlanModels import TrainingPlan
+
+PLAN = TrainingPlan.model_validate(fakeTrainingPlan(weeks=2))
+
+
+class RejectingEvents(_FakeEvents):
+    """Rejects inserts of rest days the way google rejects an invalid event"""
+
+    def insert(self, calendarId, body):
+        if body["summary"].startswith("Rest"):
+
+            def reject():
+                raise _httpError(400)
+
+            return _FakeRequest(self.service, reject)
+        return super().insert(calendarId, body)
+
+
+class RejectingCalendar(FakeCalendarService):
+    def events(self):
+        return RejectingEvents(self)
+
+
+def export(service, monkeypatch):
+    monkeypatch.setattr(assignCalendarEvent, "build", lambda *args, **kwargs: service)
+    return assignCalendarEvent.createCalendarEvents(
+        {"plan": PLAN},
+        None,
+        "Europe/London",
+        "07:00:00",
+        reconcile=True,
+        owner=1,
+    )
+
+
+def test_clean_export_reports_what_it_wrote(monkeypatch):
+    service = FakeCalendarService()
+
+    result = export(service, monkeypatch)
+
+    assert result == {"inserted": 14, "patched": 0, "deleted": 0, "failed": {}}
+    assert len(service.events_) == 14
+
+
+def test_failed_writes_are_reported(monkeypatch):
+    service = RejectingCalendar()
+
+    result = export(service, monkeypatch)
+
+    rest = sum(
+        workout.type == "Rest" for week in PLAN.weeks for workout in week.workouts
+    )
+    assert rest
+    assert len(result["failed"]) == rest
+    assert result["inserted"] == 14 - rest
+    assert all(key.startswith("inserted:") for key in result["failed"])
+
+
+def test_unchanged_plan_writes_nothing(monkeypatch):
+    service = FakeCalendarService()
+    export(service, monkeypatch)
+
+    result = export(service, monkeypatch)
+
+    assert result == {"inserted": 0, "patched": 0, "deleted": 0, "failed": {}}
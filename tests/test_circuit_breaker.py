@@ -0,0 +1,207 @@
+import threading
+
+import pytest
+
+import GeminiCalls
+from GeminiCalls import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    callGemini,
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(GeminiCalls.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def noBackoff(monkeypatch):
+    monkeypatch.setattr(GeminiCalls, "backoffDelay", lambda *args: 0)
+
+
+def openBreaker(breaker):
+    for _ in range(breaker.threshold):
+        breaker.allow()
+        breaker.recordFailure()
+
+
+def test_opens_after_threshold_consecutive_failures(clock):
+    breaker = CircuitBreaker("test-open", threshold=3, cooldown=30)
+
+    for _ in range(2):
+        breaker.allow()
+        breaker.recordFailure()
+    assert breaker.state == CLOSED
+
+    breaker.allow()
+    breaker.recordFailure()
+    assert breaker.state == OPEN
+    assert breaker.stats()["times_opened"] == 1
+
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    assert breaker.stats()["rejected_calls"] == 1
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = CircuitBreaker("test-reset", threshold=2, cooldown=30)
+
+    breaker.recordFailure()
+    breaker.recordSuccess()
+    breaker.recordFailure()
+
+    assert breaker.state == CLOSED
+
+
+def test_half_opens_after_cooldown_with_a_single_trial(clock):
+    breaker = CircuitBreaker("test-half-open", threshold=1, cooldown=30)
+    openBreaker(breaker)
+
+    clock.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+    clock.now += 1
+    breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # only the one trial is let through while it is in flight
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_successful_trial_closes(clock):
+    breaker = CircuitBreaker("test-close", threshold=1, cooldown=30)
+    openBreaker(breaker)
+    clock.now += 30
+
+    breaker.allow()
+    breaker.recordSuccess()
+
+    assert breaker.state == CLOSED
+    breaker.allow()
+
+
+def test_failed_trial_reopens_for_a_full_cooldown(clock):
+    breaker = CircuitBreaker("test-reopen", threshold=3, cooldown=30)
+    openBreaker(breaker)
+    clock.now += 30
+
+    breaker.allow()
+    breaker.recordFailure()
+
+    assert breaker.state == OPEN
+    assert breaker.stats()["times_opened"] == 2
+    clock.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_released_trial_lets_another_through(clock):
+    breaker = CircuitBreaker("test-release", threshold=1, cooldown=30)
+    openBreaker(breaker)
+    clock.now += 30
+
+    breaker.allow()
+    breaker.release()
+
+    assert breaker.state == HALF_OPEN
+    breaker.allow()
+
+
+def test_only_one_concurrent_trial(clock):
+    breaker = CircuitBreaker("test-concurrent", threshold=1, cooldown=30)
+    openBreaker(breaker)
+    clock.now += 30
+
+    allowed = []
+    lock = threading.Lock()
+
+    def attempt():
+        try:
+            breaker.allow()
+        except CircuitOpenError:
+            return
+        with lock:
+            allowed.append(True)
+
+    threads = [threading.Thread(target=attempt) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(allowed) == 1
+
+
+def test_call_that_exhausts_its_retries_counts_one_failure(noBackoff):
+    breaker = CircuitBreaker("test-retries", threshold=2, cooldown=30)
+    attempts = []
+
+    def failing():
+        attempts.append(1)
+        raise ConnectionError("reset")
+
+    with pytest.raises(ConnectionError):
+        callGemini(failing, maxAttempts=3, breaker=breaker)
+
+    assert len(attempts) == 3
+    assert breaker.failures == 1
+    assert breaker.state == CLOSED
+
+
+def test_non_retryable_error_does_not_count(noBackoff):
+    breaker = CircuitBreaker("test-bad-request", threshold=1, cooldown=30)
+
+    def badRequest():
+        raise ValueError("bad prompt")
+
+    with pytest.raises(ValueError):
+        callGemini(badRequest, breaker=breaker)
+
+    assert breaker.failures == 0
+    assert breaker.state == CLOSED
+
+
+def test_hung_attempt_times_out_and_is_retried(noBackoff):
+    breaker = CircuitBreaker("test-timeout", threshold=5, cooldown=30)
+    release = threading.Event()
+    calls = []
+
+    def sometimesHangs():
+        calls.append(1)
+        if len(calls) == 1:
+            release.wait(5)
+        return "ok"
+
+    try:
+        assert callGemini(sometimesHangs, timeout=0.1, breaker=breaker) == "ok"
+    finally:
+        release.set()
+
+    assert len(calls) == 2
+    assert breaker.failures == 0
+
+
+def test_open_breaker_fails_fast_without_calling(clock):
+    breaker = CircuitBreaker("test-fail-fast", threshold=1, cooldown=30)
+    openBreaker(breaker)
+
+    def call():
+        raise AssertionError("called through an open breaker")
+
+    with pytest.raises(CircuitOpenError):
+        callGemini(call, breaker=breaker)
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+from IncrementalJson import IncrementalJsonParser
+
+PLAN = {
+    "weeks": [
+        {"week_number": 1, "workouts": [{"day": "Monday"}, {"day": "Tuesday"}]},
+        {"week_number": 2, "workouts": [{"day": "Monday"}]},
+    ]
+}
+
+
+def feedAll(parser, chunks):
+    closed = []
+    for chunk in chunks:
+        closed.extend(parser.feed(chunk))
+    return closed
+
+
+def test_watched_values_close_in_order():
+    parser = IncrementalJsonParser([("weeks", "*", "workouts", "*"), ("weeks", "*")])
+    closed = parser.feed(json.dumps(PLAN))
+
+    assert [path for path, _ in closed] == [
+        ("weeks", 0, "workouts", 0),
+        ("weeks", 0, "workouts", 1),
+        ("weeks", 0),
+        ("weeks", 1, "workouts", 0),
+        ("weeks", 1),
+    ]
+    assert json.loads(closed[2][1]) == PLAN["weeks"][0]
+    assert parser.complete
+
+
+def test_one_character_at_a_time_matches_one_feed():
+    text = json.dumps(PLAN, indent=2)
+    whole = IncrementalJsonParser([("weeks", "*")]).feed(text)
+
+    parser = IncrementalJsonParser([("weeks", "*")])
+    assert feedAll(parser, text) == whole
+    assert parser.complete
+
+
+def test_week_is_handed_back_as_soon_as_it_closes():
+    text = json.dumps(PLAN)
+    firstWeekEnd = text.index("]}") + 2
+    parser = IncrementalJsonParser([("weeks", "*")])
+
+    closed = parser.feed(text[:firstWeekEnd])
+
+    assert closed == [(("weeks", 0), json.dumps(PLAN["weeks"][0]))]
+    assert not parser.complete
+
+
+def test_brackets_and_quotes_inside_strings_are_ignored():
+    value = {"items": [{"text": 'a "quoted" } ] { [ value \\'}, {"text": "b"}]}
+    parser = IncrementalJsonParser([("items", "*")])
+
+    closed = feedAll(parser, json.dumps(value))
+
+    assert [json.loads(text) for _, text in closed] == value["items"]
+
+
+def test_keys_split_across_chunks():
+    parser = IncrementalJsonParser([("we", "*")])
+    closed = feedAll(parser, ['{"w', 'e": [{"a', '": 1}]', ', "weeks": [{}]}'])
+
+    assert closed == [(("we", 0), '{"a": 1}')]
+
+
+def test_incomplete_text_is_not_complete():
+    parser = IncrementalJsonParser([("weeks", "*")])
+    parser.feed('{"weeks": [{"week_number": 1}')
+
+    assert parser.started
+    assert not parser.complete
+
+
+@pytest.mark.parametrize("text", ["}", '{"a": 1}]', '{"weeks": [}', "[1, 2}"])
+def test_stray_or_mismatched_closer_raises(text):
+    with pytest.raises(json.JSONDecodeError):
+        IncrementalJsonParser([()]).feed(text)
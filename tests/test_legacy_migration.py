@@ -0,0 +1,119 @@
+import json
+import os
+import time
+
+import pytest
+
+import StravaApiAuth
+from ColumnarActivityStore import ColumnarActivityStore
+from FakeServices import FakeStravaClient
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+@pytest.fixture
+def legacyInstall(tmp_path, monkeypatch):
+    """The files an older single user install left behind, shaped as it wrote them"""
+    tokenPath = tmp_path / "token_response.json"
+    tokenPath.write_text(
+        json.dumps(
+            {
+                "access_token": "legacy-access",
+                "refresh_token": "legacy-refresh",
+                "expires_at": time.time() + 3600,
+            }
+        )
+    )
+    with open(os.path.join(ROOT, "users_running_data.json")) as f:
+        (tmp_path / "users_running_data.json").write_text(f.read())
+
+    lookups = []
+
+    def makeClient(accessToken=None, owner="default"):
+        lookups.append(accessToken)
+        return FakeStravaClient(activityCount=1, athleteId=77)
+
+    monkeypatch.setattr(StravaApiAuth, "makeStravaClient", makeClient)
+    monkeypatch.setattr(StravaApiAuth, "_legacyRetryAt", {})
+    return tmp_path, lookups
+
+
+def test_owner_is_looked_up_once_and_saved(legacyInstall):
+    tmp_path, lookups = legacyInstall
+    tokenPath = str(tmp_path / "token_response.json")
+
+    assert StravaApiAuth.legacyTokenOwner(tokenPath) == 77
+    assert StravaApiAuth.legacyTokenOwner(tokenPath) == 77
+
+    assert lookups == ["legacy-access"]
+    saved = json.loads((tmp_path / "token_response.json").read_text())
+    assert saved["athlete_id"] == 77
+    assert saved["refresh_token"] == "legacy-refresh"
+
+
+def test_expired_legacy_tokens_are_refreshed_before_the_lookup(
+    legacyInstall, monkeypatch
+):
+    tmp_path, lookups = legacyInstall
+    tokenPath = tmp_path / "token_response.json"
+    tokenPath.write_text(
+        json.dumps({"access_token": "old", "refresh_token": "r", "expires_at": 0})
+    )
+    monkeypatch.setattr(
+        StravaApiAuth,
+        "refreshStravaTokens",
+        lambda tokens: {**tokens, "access_token": "new", "expires_at": 10**10},
+    )
+
+    assert StravaApiAuth.legacyTokenOwner(str(tokenPath)) == 77
+    assert lookups == ["new"]
+    assert json.loads(tokenPath.read_text())["access_token"] == "new"
+
+
+def test_failed_lookup_is_not_retried_at_once(legacyInstall, monkeypatch):
+    tmp_path, lookups = legacyInstall
+
+    def unreachable(*args, **kwargs):
+        lookups.append(None)
+        raise ConnectionError("strava is down")
+
+    monkeypatch.setattr(StravaApiAuth, "makeStravaClient", unreachable)
+    tokenPath = str(tmp_path / "token_response.json")
+
+    assert StravaApiAuth.legacyTokenOwner(tokenPath) is None
+    assert StravaApiAuth.legacyTokenOwner(tokenPath) is None
+    assert len(lookups) == 1
+
+
+def test_history_migrates_into_the_resolved_owner_only(legacyInstall):
+    tmp_path, _ = legacyInstall
+    store = ColumnarActivityStore(str(tmp_path / "segments"))
+    owner = StravaApiAuth.legacyTokenOwner(str(tmp_path / "token_response.json"))
+    legacyPath = str(tmp_path / "users_running_data.json")
+
+    assert store.readRunningData(5, legacyOwner=owner, legacyPath=legacyPath) is None
+    migrated = store.readRunningData(owner, legacyOwner=owner, legacyPath=legacyPath)
+
+    with open(legacyPath) as f:
+        legacy = json.load(f)
+    assert len(migrated["activities"]) == min(10, len(legacy))
+    assert store.loadActivities(5) == []
+    # the marker stops a second import after the owner deletes their runs
+    assert not store.migrateLegacyFile(owner, owner, legacyPath)
+
+
+def test_legacy_tokens_import_into_their_owner_with_the_athlete_id(
+    legacyInstall, monkeypatch
+):
+    tmp_path, lookups = legacyInstall
+    store = StravaApiAuth.TokenStore("strava", tokenDir=tmp_path / "tokens")
+    monkeypatch.setattr(StravaApiAuth, "stravaTokens", store)
+    tokenPath = str(tmp_path / "token_response.json")
+
+    assert StravaApiAuth.importLegacyTokens(5, tokenPath) is None
+    imported = StravaApiAuth.importLegacyTokens(77, tokenPath)
+
+    assert imported["access_token"] == "legacy-access"
+    assert store.get(77)["athlete_id"] == 77
+    assert store.get(5) is None
+    assert lookups == ["legacy-access"]
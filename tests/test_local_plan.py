@@ -0,0 +1,46 @@
+from datetime import date, datetime
+
+from LocalPlanEngine import athleteProfile, buildLocalPlan, completedWeeklyKm
+
+# a wednesday, so the week starting 2025-09-01 is still in progress
+TODAY = date(2025, 9, 3)
+
+
+def test_current_week_is_left_out_by_date():
+    volume = [
+        {"start": "2025-08-11", "distanceKm": 20.0},
+        {"start": "2025-08-18", "distanceKm": 30.0},
+        {"start": "2025-08-25", "distanceKm": 40.0},
+        {"start": "2025-09-01", "distanceKm": 5.0},
+    ]
+
+    assert completedWeeklyKm(volume, TODAY) == [0.0, 20.0, 30.0, 40.0]
+
+
+def test_last_finished_week_is_kept_when_this_week_has_no_runs():
+    volume = [
+        {"start": "2025-08-11", "distanceKm": 20.0},
+        {"start": "2025-08-18", "distanceKm": 30.0},
+        {"start": "2025-08-25", "distanceKm": 40.0},
+    ]
+
+    assert completedWeeklyKm(volume, TODAY)[-1] == 40.0
+
+
+def test_weeks_without_runs_count_as_zero():
+    volume = [
+        {"start": "2025-08-04", "distanceKm": 40.0},
+        {"start": "2025-08-25", "distanceKm": 40.0},
+    ]
+
+    profile = athleteProfile({"activities": [], "volume": volume}, TODAY)
+
+    assert completedWeeklyKm(volume, TODAY) == [40.0, 0.0, 0.0, 40.0]
+    assert profile["weeklyKm"] == 20.0
+
+
+def test_plan_builds_without_any_runs():
+    plan = buildLocalPlan({"activities": []}, weeks=2, now=datetime(2025, 9, 3))
+
+    assert [week.week_number for week in plan.weeks] == [1, 2]
+    assert all(len(week.workouts) == 7 for week in plan.weeks)
@@ -0,0 +1,55 @@
+from StravaRequestScheduler import (
+    SHORT_WINDOW_SECONDS,
+    StravaRequestScheduler,
+    parseRateLimitHeaders,
+)
+
+
+def headers(usage, limit):
+    return {"X-RateLimit-Usage": usage, "X-RateLimit-Limit": limit}
+
+
+def test_read_quota_is_preferred_for_gets():
+    rates = {
+        **headers("10,20", "200,2000"),
+        "X-ReadRateLimit-Usage": "5,6",
+        "X-ReadRateLimit-Limit": "100,1000",
+    }
+
+    assert parseRateLimitHeaders(rates, "GET") == (5, 6, 100, 1000)
+    assert parseRateLimitHeaders(rates, "POST") == (10, 20, 200, 2000)
+
+
+def test_reported_limits_replace_the_buckets():
+    scheduler = StravaRequestScheduler(shortBurst=20, longBurst=100)
+
+    scheduler(headers("0,0", "600,30000"))
+
+    assert scheduler.shortLimit == 600
+    assert scheduler.shortBucket.capacity == 20
+    assert scheduler.shortBucket.refillPerSecond == (600 - 20) / SHORT_WINDOW_SECONDS
+    assert scheduler.longBucket.refillPerSecond > 30000 / 2 / 24 / 3600
+
+
+def test_saved_up_tokens_are_capped_at_the_new_capacity():
+    scheduler = StravaRequestScheduler(shortBurst=20, longBurst=100)
+    for _ in range(5):
+        scheduler.acquire()
+        scheduler.release()
+
+    scheduler(headers("5,5", "10,1000"))
+
+    # 15 of the 20 burst tokens were left, the new bucket only holds 10
+    assert scheduler.shortBucket.capacity == 10
+    assert scheduler.shortBucket.tokens == 10
+
+
+def test_unchanged_limits_keep_the_same_buckets():
+    scheduler = StravaRequestScheduler()
+    shortBucket, longBucket = scheduler.shortBucket, scheduler.longBucket
+
+    scheduler(headers("3,3", "100,1000"))
+
+    assert scheduler.shortBucket is shortBucket
+    assert scheduler.longBucket is longBucket
+    assert scheduler.shortUsed == 3
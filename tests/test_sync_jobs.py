@@ -0,0 +1,48 @@
+import threading
+
+from SyncJobs import COMPLETE, FAILED, JobManager
+
+
+def waitFor(job):
+    for _ in range(200):
+        if job.finished:
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("job did not finish")
+
+
+def test_finished_jobs_always_have_a_finish_time():
+    manager = JobManager(maxWorkers=8, keepFinished=2)
+    jobs = [manager.submit(i, lambda job: job.id) for i in range(200)]
+
+    for job in jobs:
+        waitFor(job)
+        assert job.finishedAt is not None
+        assert job.status == COMPLETE
+        assert job.result == job.id
+
+
+def test_failed_job_keeps_its_error():
+    manager = JobManager()
+
+    def fail(job):
+        raise RuntimeError("strava is down")
+
+    job = manager.submit("sync", fail)
+    waitFor(job)
+
+    assert job.status == FAILED
+    assert job.error == "strava is down"
+
+
+def test_running_key_returns_the_same_job():
+    manager = JobManager()
+    release = threading.Event()
+
+    first = manager.submit("sync", lambda job: release.wait(5))
+    second = manager.submit("sync", lambda job: None)
+    release.set()
+    waitFor(first)
+
+    assert first is second
+    assert manager.submit("sync", lambda job: None) is not first
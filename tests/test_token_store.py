@@ -0,0 +1,98 @@
+import json
+import threading
+import time
+
+from TokenStore import TokenStore
+
+
+def test_concurrent_refreshes_share_one_call(tmp_path):
+    store = TokenStore("strava", tokenDir=tmp_path)
+    store.save(1, {"access_token": "old", "expires_at": 0})
+    calls = []
+
+    def refreshFn(tokens):
+        calls.append(tokens["access_token"])
+        time.sleep(0.2)
+        return {"access_token": "new", "expires_at": 100}
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(store.refresh(1, refreshFn)))
+        for _ in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == ["old"]
+    assert [tokens["access_token"] for tokens in results] == ["new"] * 10
+
+
+def test_refresh_skipped_when_tokens_already_fresh(tmp_path):
+    store = TokenStore("strava", tokenDir=tmp_path)
+    store.save(1, {"access_token": "old", "expires_at": 0})
+
+    def refreshFn(tokens):
+        return {"access_token": "new", "expires_at": 100}
+
+    def isFresh(tokens):
+        return tokens["expires_at"] > 0
+
+    store.refresh(1, refreshFn, isFresh=isFresh)
+
+    # a caller that read the expired tokens before the refresh above finished
+    def refreshAgain(tokens):
+        raise AssertionError("fresh tokens were refreshed again")
+
+    assert store.refresh(1, refreshAgain, isFresh=isFresh)["access_token"] == "new"
+
+
+def test_users_refresh_independently(tmp_path):
+    store = TokenStore("strava", tokenDir=tmp_path)
+    store.save(1, {"access_token": "a"})
+    store.save(2, {"access_token": "b"})
+
+    store.refresh(1, lambda tokens: {"access_token": tokens["access_token"] + "1"})
+
+    assert store.get(1)["access_token"] == "a1"
+    assert store.get(2)["access_token"] == "b"
+
+
+def test_saved_tokens_survive_a_new_store(tmp_path):
+    TokenStore("google", tokenDir=tmp_path).save("user", {"token": "t"})
+
+    store = TokenStore("google", tokenDir=tmp_path)
+    assert store.get("user") == {"token": "t"}
+    assert json.loads((tmp_path / "google" / "user.json").read_text()) == {"token": "t"}
+    assert not list((tmp_path / "google").glob("*.tmp"))
+
+
+def test_failed_refresh_reaches_every_waiting_caller(tmp_path):
+    store = TokenStore("strava", tokenDir=tmp_path)
+    store.save(1, {"access_token": "old"})
+    started = threading.Event()
+
+    def refreshFn(tokens):
+        started.set()
+        time.sleep(0.1)
+        raise RuntimeError("strava is down")
+
+    errors = []
+
+    def refresh():
+        try:
+            store.refresh(1, refreshFn)
+        except RuntimeError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=refresh)
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=refresh)
+    follower.start()
+    leader.join()
+    follower.join()
+
+    assert len(errors) == 2
+    assert store.get(1)["access_token"] == "old"